@@ -0,0 +1,11 @@
+
+
+__all__ = ['iter_blocks', 'iter_klv', 'iter_points']
+
+
+def __getattr__(name):
+    # resolved on first use: an eager import here would load gopro2gpx.gopro2gpx before "python -m" runs it
+    if name in __all__:
+        from . import api
+        return getattr(api, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
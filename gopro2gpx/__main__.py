@@ -1,3 +1,4 @@
-from .klv_extraction import main
+from .cli import main
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+streaming library API: generators over the GPMF data of a clip, without command line arguments and without keeping
+the whole clip in memory.
+
+    for klv in iter_klv('GH010198.MP4'): ...
+    for point in iter_points('GH010198.MP4', skip=True): ...
+    for key, times, values, meta in iter_blocks(open('dump.bin', 'rb')): ...
+
+a source is a path (an MP4 video, read by the first container backend installed, see backends.py, or a raw GPMF
+dump such as the .bin written by gopro2gpx -vv), a binary file object, bytes, or any iterable of bytes chunks (e.g. a
+socket or an HTTP response). raw data is split at the top level DEVC boundaries as it arrives, so the chunks can be
+cut anywhere. everything is lazy: stop iterating and nothing else is read.
+
+a top level header that can't be one (not a nested KLV, a label that isn't text, or longer than
+recovery.MAX_DEVC_LENGTH) is garbage: it is skipped up to the next plausible DEVC header (recovery.resync), instead
+of waiting for the gigabytes it claims. so at most one DEVC is ever buffered.
+"""
+
+import io
+import logging
+import os
+import random
+import struct
+import unittest
+from pathlib import Path
+
+from .gopro2gpx import GPSPointBuilder
+from .klv_extraction import parseStream
+from .recovery import _LABEL_BYTES, MAX_DEVC_LENGTH, resync
+
+CHUNK_SIZE = 1024 * 1024
+
+_HEADER = struct.Struct('>4sBBH')
+
+
+def _is_mp4(head):
+    return head[4:8] == b'ftyp'
+
+
+def _iter_file(fd, chunk_size):
+    while True:
+        chunk = fd.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _iter_mp4(source):
+    """
+    (bytes, time, duration) of every GPMF packet of a video. source is a path or a seekable file object
+    """
+    from .backends import iter_packets
+
+    yield from iter_packets(source)
+
+
+def _iter_raw(source, chunk_size):
+    """
+    (bytes, None, None) chunks of a raw source, or the packets of a video
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        data = bytes(source)
+        if _is_mp4(data[:8]):
+            yield from _iter_mp4(io.BytesIO(data))
+        else:
+            yield data, None, None
+        return
+
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as fd:
+            if _is_mp4(fd.read(8)):
+                fd.close()
+                yield from _iter_mp4(source)
+                return
+            fd.seek(0)
+            for chunk in _iter_file(fd, chunk_size):
+                yield chunk, None, None
+        return
+
+    if hasattr(source, 'read'):
+        head = source.read(8)
+        if _is_mp4(head):
+            source.seek(0)
+            yield from _iter_mp4(source)
+            return
+        yield head, None, None
+        for chunk in _iter_file(source, chunk_size):
+            yield chunk, None, None
+        return
+
+    for chunk in source:
+        yield bytes(chunk), None, None
+
+
+def _plausible(label, ktype, length):
+    # a top level KLV: nested, with a text label, and not longer than a DEVC can be
+    return ktype == 0 and length <= MAX_DEVC_LENGTH and all(c in _LABEL_BYTES for c in label)
+
+
+def iter_devc(source, chunk_size=CHUNK_SIZE):
+    """
+    yields (raw bytes, time, duration) for every top level KLV (normally a DEVC) of source. time and duration are
+    those of the MP4 packet the KLV starts in (seconds), None for raw sources
+    """
+    logger = logging.getLogger(__name__)
+    pending = bytearray()
+    # absolute offset of pending in the stream, and the garbage skipped since the last DEVC, for the log
+    position = 0
+    garbage = garbage_at = 0
+    time = duration = None
+    for chunk, chunk_time, chunk_duration in _iter_raw(source, chunk_size):
+        if not pending:
+            time, duration = chunk_time, chunk_duration
+        pending += chunk
+
+        offset = 0
+        while len(pending) - offset >= _HEADER.size:
+            label, ktype, size, repeat = _HEADER.unpack_from(pending, offset)
+            if not _plausible(label, ktype, size * repeat):
+                found = resync(pending, offset + 1)
+                if found < 0:
+                    # keep the end: the next DEVC header (and the one after it, see resync) may be cut in two
+                    found = max(offset, len(pending) - 2 * _HEADER.size + 1)
+                    if found == offset:
+                        break
+                if not garbage:
+                    garbage_at = position + offset
+                garbage += found - offset
+                offset = found
+                continue
+            end = offset + _HEADER.size + (-(-size * repeat // 4) * 4)
+            if end > len(pending):
+                break
+            if garbage:
+                logger.warning(f'Skipped {garbage} bytes of garbage at offset {garbage_at}')
+                garbage = 0
+            yield bytes(pending[offset:end]), time, duration
+            offset = end
+            time, duration = chunk_time, chunk_duration
+        del pending[:offset]
+        position += offset
+
+    label, ktype, size, repeat = _HEADER.unpack_from(pending.ljust(_HEADER.size, b'\xff'))
+    truncated = pending and _plausible(label, ktype, size * repeat)
+    if pending and not truncated:
+        garbage_at = garbage_at if garbage else position
+        garbage += len(pending)
+    if garbage:
+        logger.warning(f'Skipped {garbage} bytes of garbage at offset {garbage_at}')
+    if truncated:
+        # truncated at the end: let the parser deal with what is there
+        yield bytes(pending), time, duration
+
+
+def iter_klv(source, chunk_size=CHUNK_SIZE):
+    """
+    yields the KLVData of source, in stream order, as each DEVC is decoded
+    """
+    for raw, _, _ in iter_devc(source, chunk_size):
+        klvlist, _ = parseStream(raw)
+        yield from klvlist
+
+
+def iter_points(source, skip=False, chunk_size=CHUNK_SIZE):
+    """
+    yields the gpshelper.GPSPoint of source, the same ones BuildGPSPoints() returns
+    """
+    builder = GPSPointBuilder(skip=skip)
+    for raw, _, _ in iter_devc(source, chunk_size):
+        klvlist, _ = parseStream(raw)
+        yield from builder.add(klvlist)
+
+
+class _Blocks:
+    # a StreamExtractor store that hands the blocks back instead of writing them
+    def __init__(self):
+        self.blocks = []
+
+    def append(self, key, times, values, meta):
+        self.blocks.append((key, times, values, meta))
+
+
+def iter_blocks(source, chunk_size=CHUNK_SIZE):
+    """
+    yields (stream, times, values, meta) numpy blocks for every sensor stream of every DEVC, as streams.StreamExtractor
+    decodes them (times in seconds, values scaled)
+    """
+    from .streams import StreamExtractor
+
+    blocks = _Blocks()
+    extractor = StreamExtractor(blocks)
+    for raw, time, duration in iter_devc(source, chunk_size):
+        klvlist, _ = parseStream(raw)
+        extractor.add_klv(klvlist, time, duration or 1.0)
+        yield from blocks.blocks
+        blocks.blocks = []
+
+
+class ApiTest(unittest.TestCase):
+    SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+
+    def _chunks(self, data, n):
+        return (data[i:i + n] for i in range(0, len(data), n))
+
+    def _key(self, klvlist):
+        return [(klv.fourCC, klv.rawdata) for klv in klvlist]
+
+    def test_chunked(self):
+        for name in ('hero5.bin', 'hero6.bin', 'gopro7.bin'):
+            data = (self.SAMPLES / name).read_bytes()
+            expected = self._key(parseStream(data)[0])
+            for n in (1, 7, 4096):
+                with self.subTest(name=name, chunk=n):
+                    pieces = [raw for raw, _, _ in iter_devc(self._chunks(data, n))]
+                    self.assertEqual(b''.join(pieces), data)
+                    self.assertEqual(self._key(iter_klv(self._chunks(data, n))), expected)
+
+    def test_garbage(self):
+        data = (self.SAMPLES / 'hero6.bin').read_bytes()
+        devcs = [raw for raw, _, _ in iter_devc(data)]
+        # a header claiming ~16 MB, then random bytes, after the first DEVC
+        noise = random.Random(1).randbytes(5000).replace(b'DEVC', b'xxxx')
+        garbage = struct.pack('>4sBBH', b'DEVC', 0, 255, 65535) + noise
+        damaged = devcs[0] + garbage + b''.join(devcs[1:])
+
+        for n in (1, 7, 4096):
+            with self.subTest(chunk=n):
+                with self.assertLogs(__name__, 'WARNING') as logs:
+                    pieces = [raw for raw, _, _ in iter_devc(self._chunks(damaged, n))]
+                self.assertEqual(pieces, devcs)
+                self.assertEqual(logs.output, [f'WARNING:{__name__}:Skipped {len(garbage)} bytes of garbage at '
+                                               f'offset {len(devcs[0])}'])
+
+        # garbage at the end is dropped too, a truncated DEVC is kept
+        with self.assertLogs(__name__, 'WARNING'):
+            pieces = [raw for raw, _, _ in iter_devc(self._chunks(b''.join(devcs) + garbage, 7))]
+        self.assertEqual(pieces, devcs)
+        pieces = [raw for raw, _, _ in iter_devc(self._chunks(data[:-100], 7))]
+        self.assertEqual(pieces, devcs[:-1] + [devcs[-1][:-100]])
@@ -0,0 +1,377 @@
+"""
+container backends: the different ways of getting the GPMF track out of an MP4.
+
+  * native: a small MP4 box parser in pure python. it reads the sample table of the GPMF track (moov/trak/mdia/minf/
+    stbl) and then only the GPMF samples, so it needs nothing installed and skips the video data entirely
+  * pyav: demuxes the GPMF stream with PyAV (libav* in process)
+  * ffmpeg: runs ffprobe and ffmpeg (FFMpegTools), the way gopro2gpx always did. no per-packet timing
+
+every backend yields (bytes, time, duration) per GPMF packet, times in seconds (None when unknown). 'auto' tries the
+installed backends in the order of AUTO_ORDER and uses the first one that can read the file. the order is a fixed
+preference, not a measurement: benchmarks.measure_backends() times them on a clip.
+
+    for packet, time, duration in iter_packets('GH010198.MP4'): ...
+    raw = read_track('GH010198.MP4', backend='ffmpeg', config=config)
+"""
+
+import importlib.util
+import logging
+import os
+import shutil
+import struct
+import unittest
+from pathlib import Path
+
+# the one that reads the least first: the native parser reads a few KB per second of video and needs nothing
+# installed, PyAV demuxes every packet of the container, ffmpeg adds two process launches
+AUTO_ORDER = ('native', 'pyav', 'ffmpeg')
+
+
+class UnsupportedContainer(Exception):
+    """
+    the backend can't read this file (no GPMF track it understands, fragmented MP4, not a path...)
+    """
+
+
+class Backend:
+    name = None
+
+    def __init__(self, config=None):
+        self.config = config
+
+    @classmethod
+    def available(cls, config=None):
+        """
+        True if what the backend needs is installed
+        """
+        return True
+
+    def packets(self, source):
+        """
+        an iterator over the (bytes, time, duration) of every GPMF packet of source (a path or, for the backends
+        that support it, a seekable binary file object). raises UnsupportedContainer before yielding anything
+        """
+        raise NotImplementedError
+
+    def read(self, source):
+        """
+        the whole GPMF track of source
+        """
+        return b''.join(packet for packet, _, _ in self.packets(source))
+
+
+class NativeBackend(Backend):
+    name = 'native'
+
+    _CONTAINERS = (b'moov', b'trak', b'mdia', b'minf', b'stbl')
+    _TABLES = (b'hdlr', b'mdhd', b'stsd', b'stts', b'stsz', b'stsc', b'stco', b'co64')
+
+    @staticmethod
+    def _boxes(fd, start, end):
+        # (type, payload offset, payload end) of the boxes in fd[start:end]
+        offset = start
+        while offset + 8 <= end:
+            fd.seek(offset)
+            header = fd.read(16)
+            if len(header) < 8:
+                return
+            size, kind = struct.unpack_from('>I4s', header)
+            payload = offset + 8
+            if size == 1:
+                if len(header) < 16:
+                    return
+                size = struct.unpack_from('>Q', header, 8)[0]
+                payload = offset + 16
+            elif size == 0:
+                size = end - offset
+            if size < payload - offset:
+                raise UnsupportedContainer('invalid MP4 box size %d at offset %d' % (size, offset))
+            yield kind, payload, min(offset + size, end)
+            offset += size
+
+    def _tracks(self, fd, start, end):
+        # the tables of every trak, as {box type: payload bytes}
+        for kind, payload, box_end in self._boxes(fd, start, end):
+            if kind == b'trak':
+                found = {}
+                self._collect(fd, payload, box_end, found)
+                yield found
+            elif kind in self._CONTAINERS:
+                yield from self._tracks(fd, payload, box_end)
+
+    def _collect(self, fd, start, end, found):
+        for kind, payload, box_end in self._boxes(fd, start, end):
+            if kind in self._CONTAINERS:
+                self._collect(fd, payload, box_end, found)
+            elif kind in self._TABLES:
+                fd.seek(payload)
+                found[kind.decode()] = fd.read(box_end - payload)
+
+    @staticmethod
+    def _is_gpmf(tables):
+        hdlr = tables.get('hdlr', b'')
+        stsd = tables.get('stsd', b'')
+        # stsd: version/flags, entry count, then the first entry: size, format
+        return stsd[12:16] == b'gpmd' or b'GoPro MET' in hdlr[24:]
+
+    @staticmethod
+    def _samples(tables):
+        """
+        (offset, size, time, duration) of every sample, from the sample table boxes
+        """
+        mdhd = tables['mdhd']
+        timescale = struct.unpack_from('>I', mdhd, 20 if mdhd[0] == 1 else 12)[0] or 1
+
+        stsz = tables['stsz']
+        sample_size, count = struct.unpack_from('>II', stsz, 4)
+        sizes = [sample_size] * count if sample_size else list(struct.unpack_from('>%dI' % count, stsz, 12))
+
+        if 'co64' in tables:
+            n = struct.unpack_from('>I', tables['co64'], 4)[0]
+            chunks = struct.unpack_from('>%dQ' % n, tables['co64'], 8)
+        else:
+            n = struct.unpack_from('>I', tables['stco'], 4)[0]
+            chunks = struct.unpack_from('>%dI' % n, tables['stco'], 8)
+
+        stsc = tables['stsc']
+        n = struct.unpack_from('>I', stsc, 4)[0]
+        runs = [struct.unpack_from('>III', stsc, 8 + 12 * i)[:2] for i in range(n)]
+
+        stts = tables['stts']
+        n = struct.unpack_from('>I', stts, 4)[0]
+        deltas = []
+        for i in range(n):
+            sample_count, delta = struct.unpack_from('>II', stts, 8 + 8 * i)
+            deltas.extend([delta] * sample_count)
+
+        samples = []
+        sample = 0
+        ticks = 0
+        for run, (first_chunk, per_chunk) in enumerate(runs):
+            last_chunk = runs[run + 1][0] - 1 if run + 1 < len(runs) else len(chunks)
+            for chunk in range(first_chunk - 1, last_chunk):
+                offset = chunks[chunk]
+                for _ in range(per_chunk):
+                    if sample >= count:
+                        break
+                    delta = deltas[sample] if sample < len(deltas) else 0
+                    samples.append((offset, sizes[sample], ticks / timescale, delta / timescale or None))
+                    offset += sizes[sample]
+                    ticks += delta
+                    sample += 1
+        return samples
+
+    def sample_table(self, fd):
+        """
+        (offset, size, time, duration) of every GPMF sample of the open binary file fd, without reading them
+        """
+        try:
+            fd.seek(0, os.SEEK_END)
+            end = fd.tell()
+            tracks = [t for t in self._tracks(fd, 0, end) if self._is_gpmf(t)]
+            if not tracks:
+                raise UnsupportedContainer('no GPMF track in the sample tables')
+            tables = tracks[0]
+            if {'mdhd', 'stsz', 'stsc', 'stts'} - set(tables) or not {'stco', 'co64'} & set(tables):
+                raise UnsupportedContainer('incomplete sample table (fragmented MP4?)')
+            return self._samples(tables)
+        except (struct.error, KeyError) as e:
+            raise UnsupportedContainer('damaged sample table: %s' % e)
+
+    def packets(self, source):
+        fd = source if hasattr(source, 'read') else open(source, 'rb')
+        try:
+            samples = self.sample_table(fd)
+        except Exception:
+            if fd is not source:
+                fd.close()
+            raise
+        return self._read(fd, samples, fd is not source)
+
+    @staticmethod
+    def _read(fd, samples, close):
+        try:
+            for offset, size, time, duration in samples:
+                fd.seek(offset)
+                yield fd.read(size), time, duration
+        finally:
+            if close:
+                fd.close()
+
+
+class PyAVBackend(Backend):
+    name = 'pyav'
+
+    @classmethod
+    def available(cls, config=None):
+        return importlib.util.find_spec('av') is not None
+
+    def packets(self, source):
+        import av
+        from .klv_extraction import find_gpmf_stream
+
+        try:
+            container = av.open(source if hasattr(source, 'read') else str(source))
+        except av.FFmpegError as e:
+            if isinstance(e, FileNotFoundError):
+                raise
+            raise UnsupportedContainer(str(e))
+        try:
+            gpmf_stream = find_gpmf_stream(container)
+        except Exception as e:
+            container.close()
+            raise UnsupportedContainer(str(e))
+        return self._read(container, gpmf_stream)
+
+    @staticmethod
+    def _read(container, gpmf_stream):
+        with container:
+            for packet in container.demux(gpmf_stream):
+                if packet.dts is None:
+                    continue
+                duration = float(packet.duration * packet.time_base) if packet.duration else None
+                yield bytes(packet), float(packet.pts * packet.time_base), duration
+
+
+class FFmpegBackend(Backend):
+    name = 'ffmpeg'
+
+    def _config(self):
+        if self.config is not None:
+            return self.config
+        from .config import Config
+        return Config(*(('ffmpeg.exe', 'ffprobe.exe') if os.name == 'nt' else ('ffmpeg', 'ffprobe')))
+
+    @classmethod
+    def available(cls, config=None):
+        config = cls(config)._config()
+        return shutil.which(config.ffmpeg_cmd) is not None and shutil.which(config.ffprobe_cmd) is not None
+
+    def packets(self, source):
+        from .ffmpegtools import FFMpegTools
+
+        if hasattr(source, 'read'):
+            raise UnsupportedContainer('ffmpeg needs a path')
+        tools = FFMpegTools(self._config())
+        found = tools.getMetadataTrack(str(source))
+        if not found:
+            raise UnsupportedContainer("File %s doesn't have any metadata" % source)
+        track_number, _ = found
+        return iter([(tools.getMetadata(track_number, str(source)), None, None)])
+
+
+BACKENDS = {backend.name: backend for backend in (NativeBackend, PyAVBackend, FFmpegBackend)}
+
+
+def available_backends(config=None):
+    """
+    the names of the installed backends, in the order of AUTO_ORDER
+    """
+    return [name for name in AUTO_ORDER if BACKENDS[name].available(config)]
+
+
+def get_backend(name='auto', config=None):
+    """
+    the backend called name, or the first available one of AUTO_ORDER for 'auto'
+    """
+    if name == 'auto':
+        names = available_backends(config)
+        if not names:
+            raise RuntimeError('no container backend available')
+        name = names[0]
+    if name not in BACKENDS:
+        raise ValueError('unknown backend %r, use one of %s' % (name, ', '.join(('auto',) + AUTO_ORDER)))
+    return BACKENDS[name](config)
+
+
+def open_packets(source, backend='auto', config=None):
+    """
+    (backend, packet iterator) for source. with 'auto' every available backend is tried, in order, until one
+    can read the file
+    """
+    logger = logging.getLogger(__name__)
+    names = available_backends(config) if backend == 'auto' else [backend]
+    error = None
+    for name in names:
+        chosen = get_backend(name, config)
+        try:
+            if hasattr(source, 'seek'):
+                source.seek(0)
+            packets = chosen.packets(source)
+        except UnsupportedContainer as e:
+            logger.debug(f'{name} backend can not read {source}: {e}')
+            error = e
+            continue
+        logger.debug(f'Reading {source} with the {name} backend')
+        return chosen, packets
+    raise error or RuntimeError('no container backend available')
+
+
+def iter_packets(source, backend='auto', config=None):
+    """
+    yields (bytes, time, duration) for every GPMF packet of source
+    """
+    _, packets = open_packets(source, backend, config)
+    yield from packets
+
+
+def read_track(source, backend='auto', config=None):
+    """
+    the whole GPMF track of source, as bytes
+    """
+    _, packets = open_packets(source, backend, config)
+    return b''.join(packet for packet, _, _ in packets)
+
+
+class BackendsTest(unittest.TestCase):
+    SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+
+    def test_native(self):
+        import tempfile
+        from .testing import write_gpmf_mp4
+
+        gpmf = (self.SAMPLES / 'hero6.bin').read_bytes()
+        with tempfile.TemporaryDirectory() as tmp:
+            for co64 in (False, True):
+                with self.subTest(co64=co64):
+                    path = Path(tmp) / 'gpmf.mp4'
+                    devcs = write_gpmf_mp4(path, gpmf, timescale=90000, co64=co64)
+                    packets = list(NativeBackend().packets(path))
+                    self.assertEqual([p for p, _, _ in packets], devcs)
+                    self.assertEqual([(t, d) for _, t, d in packets], [(float(i), 1.0) for i in range(len(devcs))])
+                    with open(path, 'rb') as fd:
+                        self.assertEqual(NativeBackend().read(fd), b''.join(devcs))
+                        # only the GPMF samples are read
+                        self.assertEqual(sum(size for _, size, _, _ in NativeBackend().sample_table(fd)),
+                                         len(b''.join(devcs)))
+                    backend, packets = open_packets(path)
+                    self.assertEqual((backend.name, b''.join(p for p, _, _ in packets)), ('native', b''.join(devcs)))
+
+    def test_not_mp4(self):
+        import tempfile
+        from .testing import write_gpmf_mp4
+
+        self.assertRaises(UnsupportedContainer, NativeBackend().read, self.SAMPLES / 'hero6.bin')
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'cut.mp4'
+            write_gpmf_mp4(path, (self.SAMPLES / 'hero6.bin').read_bytes())
+            # the moov is at the end: without it there is no sample table
+            data = path.read_bytes()
+            path.write_bytes(data[:data.find(b'moov') - 4])
+            self.assertRaises(UnsupportedContainer, NativeBackend().read, path)
+        self.assertRaises(ValueError, get_backend, 'vlc')
+
+    def test_native_matches_pyav(self):
+        import tempfile
+        from .testing import can_write_test_video, write_test_video
+
+        if not can_write_test_video():
+            self.skipTest('needs PyAV 13 or later to write the test video')
+        with tempfile.TemporaryDirectory() as tmp:
+            video = Path(tmp) / 'hero6.mp4'
+            write_test_video(video, (self.SAMPLES / 'hero6.bin').read_bytes(), fps=5)
+            native = list(NativeBackend().packets(video))
+            pyav = list(PyAVBackend().packets(video))
+            self.assertEqual(b''.join(p for p, _, _ in native), b''.join(p for p, _, _ in pyav))
+            self.assertEqual(native, pyav)
+            self.assertEqual(read_track(video), read_track(video, 'pyav'))
@@ -0,0 +1,177 @@
+"""
+benchmarks of the command line entry points.
+
+batch schedulers launch one short-lived process per clip, so the cost of starting python and importing the package
+matters as much as the parsing itself. every measurement runs in a fresh interpreter.
+
+usage:
+    python -m gopro2gpx.benchmarks    # the timings are reported on stderr
+    BENCHMARK_CLIP=GH010198.MP4 python -m gopro2gpx.benchmarks BackendSpeed
+    BENCHMARK_REPEAT=30 python -m gopro2gpx.benchmarks ParallelSpeed
+"""
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+from pathlib import Path
+
+# dependencies that must only be imported by the modes that need them
+HEAVY_MODULES = ('numpy', 'scipy', 'av')
+
+_PROBE = """
+import json, sys, time
+t = time.perf_counter()
+%s
+elapsed = time.perf_counter() - t
+print(json.dumps({'seconds': elapsed, 'loaded': sorted(m for m in %r if m in sys.modules)}))
+"""
+
+
+def _env():
+    env = dict(os.environ)
+    root = str(Path(__file__).resolve().parent.parent)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (root, env.get('PYTHONPATH')) if p)
+    return env
+
+
+def measure_import(statement, repeat=3):
+    """
+    run statement in fresh interpreters. returns (best time in seconds, heavy modules it loaded)
+    """
+    best, loaded = None, []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', _PROBE % (statement, HEAVY_MODULES)], env=_env(),
+                             check=True, capture_output=True, text=True).stdout
+        result = json.loads(out.splitlines()[-1])
+        best = result['seconds'] if best is None else min(best, result['seconds'])
+        loaded = result['loaded']
+    return best, loaded
+
+
+def measure_python(*args, repeat=3):
+    """
+    wall time in seconds of `python args`, best of repeat
+    """
+    import time
+
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        subprocess.run([sys.executable] + list(args), env=_env(), check=True, capture_output=True)
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure_command(module, *args, repeat=3):
+    """
+    wall time in seconds of `python -m module args`, best of repeat
+    """
+    return measure_python('-m', module, *args, repeat=repeat)
+
+
+class ImportTime(unittest.TestCase):
+    ENTRY_POINTS = ('gopro2gpx.cli', 'gopro2gpx.gopro2gpx', 'gopro2gpx.klv_extraction', 'gopro2gpx.pipeline')
+
+    def test_entry_points_are_light(self):
+        for module in self.ENTRY_POINTS:
+            seconds, loaded = measure_import('import %s' % module)
+            print('import %-28s %6.1f ms' % (module, seconds * 1000), file=sys.stderr)
+            self.assertEqual(loaded, [], '%s imports %s at load time' % (module, ', '.join(loaded)))
+
+    def test_help(self):
+        import importlib.util
+
+        # starting python and importing the heavy modules that are installed: --help must be well under that
+        heavy = [m for m in HEAVY_MODULES if importlib.util.find_spec(m) is not None]
+        if not heavy:
+            self.skipTest('none of %s is installed' % ', '.join(HEAVY_MODULES))
+        bound = measure_python('-c', 'import %s' % ', '.join(heavy + ['sys']))
+        for module in self.ENTRY_POINTS:
+            seconds = measure_command(module, '--help')
+            print('%-28s --help %6.1f ms (python and %s: %.1f ms)' % (module, seconds * 1000, ', '.join(heavy),
+                                                                     bound * 1000), file=sys.stderr)
+            self.assertLess(seconds, bound, '%s --help is as slow as importing %s' % (module, ', '.join(heavy)))
+
+
+def measure_backends(clip, repeat=3, config=None):
+    """
+    {backend name: (best time in seconds, GPMF bytes read)} of every available container backend on the same clip
+    """
+    import time
+    from .backends import available_backends, read_track
+
+    results = {}
+    for name in available_backends(config):
+        best, size = None, None
+        for _ in range(repeat):
+            t = time.perf_counter()
+            size = len(read_track(clip, name, config))
+            elapsed = time.perf_counter() - t
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = (best, size)
+    return results
+
+
+class BackendSpeed(unittest.TestCase):
+    # any GoPro clip: the samples have none, point BENCHMARK_CLIP at one
+    CLIP = os.environ.get('BENCHMARK_CLIP')
+
+    def test_backends(self):
+        if not self.CLIP:
+            self.skipTest('set BENCHMARK_CLIP to a GoPro video')
+        from .backends import read_track
+
+        results = measure_backends(self.CLIP)
+        for name, (seconds, size) in results.items():
+            print('backend %-8s %8.1f ms  %d bytes' % (name, seconds * 1000, size), file=sys.stderr)
+        # every backend reads the same track
+        tracks = {name: read_track(self.CLIP, name) for name in results}
+        self.assertEqual(len(set(tracks.values())), 1)
+
+
+def measure_parallel(data, jobs=None, repeat=1):
+    """
+    {'serial': seconds, 'keep_klv': seconds, 'points': seconds} of parsing data in one process and with
+    parallel.parse_parallel() on jobs processes, with and without the KLVs coming back. best of repeat
+    """
+    import time
+    from .gopro2gpx import GPSPointBuilder
+    from .klv_extraction import parseStream
+    from .parallel import parse_parallel
+
+    def serial():
+        klvlist, _ = parseStream(data)
+        GPSPointBuilder().add(klvlist)
+
+    runs = {'serial': serial,
+            'keep_klv': lambda: parse_parallel(data, jobs=jobs),
+            'points': lambda: parse_parallel(data, jobs=jobs, keep_klv=False)}
+    results = {}
+    for name, run in runs.items():
+        for _ in range(repeat):
+            t = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - t
+            results[name] = min(results.get(name, elapsed), elapsed)
+    return results
+
+
+class ParallelSpeed(unittest.TestCase):
+    # how many times the hero6 sample is repeated, for a long track
+    REPEAT = os.environ.get('BENCHMARK_REPEAT')
+
+    def test_parallel(self):
+        if not self.REPEAT:
+            self.skipTest('set BENCHMARK_REPEAT to the number of copies of the hero6 sample to parse')
+        data = (Path(__file__).resolve().parent.parent / 'samples' / 'hero6.bin').read_bytes() * int(self.REPEAT)
+        jobs = os.cpu_count() or 1
+        results = measure_parallel(data, jobs)
+        for name, seconds in results.items():
+            print('parse %-8s jobs=%d %8.3f s' % (name, 1 if name == 'serial' else jobs, seconds), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+"""
+growable typed buffers for accumulating per-frame and per-point data without knowing the final length up front.
+
+GrowableArray is a numpy array with amortized O(1) appends. SpillingArray starts the same way, but once it holds more
+than its memory limit it moves its content to a temporary file and keeps appending there, so a multi-hour 240 fps
+clip is processed in fixed memory. when reading back, a spilled buffer is a read-only np.memmap of that file.
+"""
+
+import logging
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from . import gpshelper
+from .config import DEFAULT_MEMORY_LIMIT
+
+
+class GrowableArray:
+    def __init__(self, dtype=float, shape=(), capacity=1024):
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.length = 0
+        self.data = np.zeros((capacity,) + self.shape, dtype=self.dtype)
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def nbytes(self):
+        return self.length * self.data.itemsize * int(np.prod(self.shape, dtype=int))
+
+    def append(self, values):
+        values = np.asarray(values, dtype=self.dtype).reshape((-1,) + self.shape)
+        end = self.length + len(values)
+        if end > len(self.data):
+            grown = np.zeros((max(end, 2 * len(self.data)),) + self.shape, dtype=self.dtype)
+            grown[:self.length] = self.data[:self.length]
+            self.data = grown
+        self.data[self.length:end] = values
+        self.length = end
+
+    def array(self):
+        return self.data[:self.length]
+
+
+class SpillingArray(GrowableArray):
+    def __init__(self, dtype=float, shape=(), capacity=1024, memory_limit=DEFAULT_MEMORY_LIMIT, spill_dir=None):
+        GrowableArray.__init__(self, dtype, shape, min(capacity, 1024))
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self.spill = None
+        self.spilled = 0
+
+    def append(self, values):
+        GrowableArray.append(self, values)
+        if self.nbytes > self.memory_limit:
+            self._spill()
+
+    def _spill(self):
+        if self.spill is None:
+            fd, path = tempfile.mkstemp(prefix='gopro2gpx_', suffix='.bin', dir=self.spill_dir)
+            self.spill = os.fdopen(fd, 'w+b')
+            self.spill_path = path
+            logging.getLogger(__name__).debug(f'Spilling buffer to {path}')
+        self.spill.write(np.ascontiguousarray(self.data[:self.length]).tobytes())
+        self.spilled += self.length
+        self.length = 0
+        # don't keep the big in-memory buffer around once we are on disk
+        self.data = np.zeros((1024,) + self.shape, dtype=self.dtype)
+
+    def __len__(self):
+        return self.spilled + self.length
+
+    def array(self):
+        if self.spill is None:
+            return GrowableArray.array(self)
+        if self.length:
+            self._spill()
+        self.spill.flush()
+        return np.memmap(self.spill_path, dtype=self.dtype, mode='r', shape=(self.spilled,) + self.shape)
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            os.unlink(self.spill_path)
+            self.spill = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            # the memmap may still be open on some platforms, the file is in the temp dir anyway
+            pass
+
+
+class ColumnBuffers:
+    """
+    a dict of SpillingArray sharing one memory limit
+    """
+
+    def __init__(self, columns, memory_limit=DEFAULT_MEMORY_LIMIT, spill_dir=None):
+        per_column = max(memory_limit // max(len(columns), 1), 1024 * 1024)
+        self.columns = {name: SpillingArray(dtype, shape, memory_limit=per_column, spill_dir=spill_dir)
+                        for name, (dtype, shape) in columns.items()}
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return min(len(c) for c in self.columns.values())
+
+    def append(self, **values):
+        for name, v in values.items():
+            self.columns[name].append(v)
+
+    def pad(self, length):
+        """
+        append zeros to every column shorter than length
+        """
+        for c in self.columns.values():
+            if len(c) < length:
+                c.append(np.zeros((length - len(c),) + c.shape, dtype=c.dtype))
+
+    def arrays(self):
+        return {name: c.array() for name, c in self.columns.items()}
+
+
+POINT_COLUMNS = {
+    'time': ('datetime64[us]', ()),
+    'latitude': (float, ()),
+    'longitude': (float, ()),
+    'elevation': (float, ()),
+    'speed': (float, ()),
+}
+
+
+class PointBuffer(ColumnBuffers):
+    """
+    compact storage for gpshelper.GPSPoint: five typed columns instead of one python object per point.
+    iterating or indexing rebuilds GPSPoint objects on the fly, so the gpshelper writers can use it directly
+    """
+
+    def __init__(self, memory_limit=DEFAULT_MEMORY_LIMIT, spill_dir=None):
+        ColumnBuffers.__init__(self, POINT_COLUMNS, memory_limit, spill_dir)
+        self._arrays = None
+
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = ColumnBuffers.arrays(self)
+        return self._arrays
+
+    def extend(self, points):
+        if not points:
+            return
+        self._arrays = None
+        self.append(time=[np.datetime64(p.time, 'us') for p in points],
+                    latitude=[p.latitude for p in points],
+                    longitude=[p.longitude for p in points],
+                    elevation=[p.elevation for p in points],
+                    speed=[p.speed for p in points])
+
+    def _point(self, arrays, ix):
+        return gpshelper.GPSPoint(float(arrays['latitude'][ix]), float(arrays['longitude'][ix]),
+                                  float(arrays['elevation'][ix]), arrays['time'][ix].item(),
+                                  float(arrays['speed'][ix]))
+
+    def __getitem__(self, ix):
+        return self._point(self.arrays(), ix)
+
+    def __iter__(self):
+        arrays = self.arrays()
+        for ix in range(len(self)):
+            yield self._point(arrays, ix)
+
+
+class BuffersTest(unittest.TestCase):
+    def test_spill(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            buffer = SpillingArray(float, (3,), memory_limit=10000, spill_dir=spill_dir)
+            expected = np.arange(3000 * 3, dtype=float).reshape(-1, 3)
+            for chunk in np.array_split(expected, 70):
+                buffer.append(chunk)
+                # never much more than the limit in memory
+                self.assertLessEqual(buffer.nbytes, 10000)
+            self.assertEqual(len(buffer), 3000)
+            self.assertEqual(os.listdir(spill_dir), [os.path.basename(buffer.spill_path)])
+
+            array = buffer.array()
+            self.assertIsInstance(array, np.memmap)
+            np.testing.assert_array_equal(array, expected)
+            del array
+            buffer.close()
+            self.assertEqual(os.listdir(spill_dir), [])
+
+    def test_in_memory(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            buffer = SpillingArray(np.int32, memory_limit=10000, spill_dir=spill_dir)
+            buffer.append(range(100))
+            self.assertNotIsInstance(buffer.array(), np.memmap)
+            np.testing.assert_array_equal(buffer.array(), np.arange(100))
+            self.assertEqual(os.listdir(spill_dir), [])
+
+    def test_points(self):
+        t0 = datetime(2020, 1, 1)
+        points = [gpshelper.GPSPoint(40.0 + i * 1e-5, -3.0, 600.0 + i, t0 + timedelta(milliseconds=55 * i), 1.5)
+                  for i in range(100)]
+        buffer = PointBuffer()
+        buffer.extend(points[:60])
+        buffer.extend([])
+        buffer.extend(points[60:])
+        self.assertEqual(len(buffer), len(points))
+        self.assertEqual([(p.latitude, p.longitude, p.elevation, p.time, p.speed) for p in buffer],
+                         [(p.latitude, p.longitude, p.elevation, p.time, p.speed) for p in points])
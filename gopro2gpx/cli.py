@@ -0,0 +1,345 @@
+"""
+the gopro2gpx command: one parse pass over a clip, then any combination of outputs.
+
+    gopro2gpx GH010198.MP4                                # GH010198.gpx, .kml and .csv
+    gopro2gpx -f gpx -f pix4d -f mat GH010198.MP4 -o out/GH010198
+    gopro2gpx -f npz -f telemetry --recover GH010198.MP4
+    gopro2gpx -f gpx GH010198.bin                         # a raw GPMF dump
+    gopro2gpx --preview -f gpx GH010198.MP4               # a coarse track (one point per second), see preview.py
+
+the outputs are named after the output base (default: the input without its extension):
+
+    gpx, kml, csv        the GPS track (.gpx, .kml, .csv)
+    geojson              the GPS track as newline-delimited GeoJSON (.geojsonl), see tiles.py for vector tiles
+    pix4d, mat, frames   one row per video frame (_pix4d.csv, .mat, _frames.csv), as klv_extraction writes them
+    npz, telemetry       every GPMF stream (.streams.npz, .telemetry)
+
+the GPS track and the GPMF streams only need the GPMF track, read with the first container backend installed. the
+per-frame outputs (and --images) need the video frames, so the clip is then demuxed once with PyAV and everything,
+the GPS track included, comes out of that single pass.
+
+gopro2gpx.gopro2gpx remains as it was, running on this engine. the klv_extraction command is deprecated in favour of
+this one (-f mat -f frames -f pix4d -f kml); it stays for its per-output file names, --orientation_only and its KML
+without altitudes.
+"""
+
+import argparse
+import logging
+import unittest
+from pathlib import Path
+
+FORMATS = {
+    'gpx': '.gpx',
+    'kml': '.kml',
+    'csv': '.csv',
+    'geojson': '.geojsonl',
+    'pix4d': '_pix4d.csv',
+    'mat': '.mat',
+    'frames': '_frames.csv',
+    'npz': '.streams.npz',
+    'telemetry': '.telemetry',
+}
+TRACK_FORMATS = ('gpx', 'kml', 'csv', 'geojson')
+FRAME_FORMATS = ('pix4d', 'mat', 'frames')
+DEFAULT_FORMATS = ('gpx', 'kml', 'csv')
+
+# every option of the engine, for callers that build their own arguments (see options())
+DEFAULTS = dict(output=None, formats=DEFAULT_FORMATS, verbose=None, binary=False, skip=False, rate=None,
+                simplify=None, max_points=None, smooth=False, metrics=False, recover=False, backend='auto', jobs=1, preview=False,
+                max_frames=None, memory_limit=None, images=None, every=None, every_metres=None, every_seconds=None)
+
+
+def options(**kwargs):
+    """
+    an argparse.Namespace for run(), with the defaults of every option that is not given
+    """
+    values = dict(DEFAULTS)
+    values.update(kwargs)
+    return argparse.Namespace(**values)
+
+
+def is_video(path):
+    with open(path, 'rb') as fd:
+        return fd.read(8)[4:8] == b'ftyp'
+
+
+def output_path(base, fmt):
+    return Path(str(base) + FORMATS[fmt])
+
+
+def read_gpmf(args, base):
+    """
+    the parsed GPMF track of args.file, and its GPS points when they were built on the way (parallel parsing)
+    """
+    from . import gpmf
+    from .config import setup_environment
+
+    config = setup_environment(argparse.Namespace(verbose=args.verbose, file=args.file, outputfile=str(base),
+                                                  recover=args.recover, backend=args.backend))
+    parser = gpmf.Parser(config)
+    if args.jobs > 1 and not args.recover:
+        # the points are built in the worker processes too
+        from .parallel import parse_parallel
+        raw = parser.readRawFromBinary() if args.binary else parser.readRawFromMP4()
+        # the KLVs only come back from the workers when the stream outputs need them
+        keep_klv = bool({'npz', 'telemetry'} & set(args.formats))
+        return parse_parallel(raw, args.jobs, skip=args.skip, keep_klv=keep_klv)
+    return (parser.readFromBinary() if args.binary else parser.readFromMP4()), None
+
+
+def read_frames(args, base):
+    """
+    demux the video once: the per-frame metadata, the GPS points, and the GPMF streams written on the way
+    """
+    from .config import DEFAULT_MEMORY_LIMIT
+    from .klv_extraction import extract_frame_info
+
+    formats = args.formats
+    frame_args = argparse.Namespace(
+        video_file=Path(args.file), max_frames=args.max_frames, skip=args.skip, recover=args.recover,
+        memory_limit=args.memory_limit or DEFAULT_MEMORY_LIMIT // (1024 * 1024),
+        output_streams=output_path(base, 'npz') if 'npz' in formats else None,
+        output_sidecar=output_path(base, 'telemetry') if 'telemetry' in formats else None)
+    frame_info, all_points = extract_frame_info(frame_args)
+    return frame_info, list(all_points)
+
+
+def write_streams(args, base, klvlist):
+    from .streams import StreamExtractor, TimeseriesStore
+
+    if 'npz' in args.formats:
+        with TimeseriesStore(output_path(base, 'npz')) as store:
+            StreamExtractor(store).add_klv(klvlist)
+    if 'telemetry' in args.formats:
+        from .sidecar import SidecarWriter
+        with SidecarWriter(output_path(base, 'telemetry')) as sidecar:
+            StreamExtractor(sidecar).add_klv(klvlist)
+
+
+def process_points(points, args):
+    """
+    the optional track processing, in order: smoothing, resampling, derived metrics, simplification
+    """
+    if args.smooth:
+        from .smoothing import smooth_points
+        smooth_points(points)
+
+    if args.rate:
+        from .geodesy import resample_points
+        points = resample_points(points, args.rate)
+
+    if args.metrics:
+        # before simplifying: the distance has to follow every point of the track
+        from .metrics import apply_metrics
+        apply_metrics(points)
+
+    if args.simplify or args.max_points:
+        from .simplify import simplify_points
+        points = simplify_points(points, args.simplify, args.max_points)
+    return points
+
+
+def _write_text(path, text):
+    with open(path, "w+") as fd:
+        fd.write(text)
+
+
+def output_writers(args, base, points, frame_info):
+    """
+    the (description, function, arguments) of every output of args, like klv_extraction.output_writers()
+    """
+    from . import gpshelper
+    from .klv_extraction import write_full_csv, write_mat, write_pix4d_csv
+
+    formats = args.formats
+    writers = []
+    if points:
+        if 'csv' in formats:
+            writers.append(('CSV track', _write_text, (output_path(base, 'csv'), gpshelper.generate_CSV(points))))
+        if 'kml' in formats:
+            writers.append(('KML track', _write_text, (output_path(base, 'kml'), gpshelper.generate_KML(points))))
+        if 'gpx' in formats:
+            writers.append(('GPX track', _write_text,
+                            (output_path(base, 'gpx'), gpshelper.generate_GPX(points, trk_name=Path(args.file).stem))))
+        if 'geojson' in formats:
+            writers.append(('GeoJSON track', _write_text,
+                            (output_path(base, 'geojson'),
+                             gpshelper.generate_GeoJSONSeq(points, name=Path(args.file).stem))))
+    if frame_info is not None:
+        if 'mat' in formats:
+            writers.append(('.MAT file', write_mat, (output_path(base, 'mat'), frame_info)))
+        if 'frames' in formats:
+            writers.append(('per-frame .CSV file', write_full_csv, (output_path(base, 'frames'), frame_info)))
+        if 'pix4d' in formats:
+            writers.append(('PIX4D .CSV file', write_pix4d_csv, (output_path(base, 'pix4d'), frame_info)))
+        if args.images:
+            from .frames import write_images
+            writers.append(('geotagged images', write_images,
+                            (args.images, Path(args.file), frame_info, args.every, args.every_metres,
+                             args.every_seconds, args.jobs if args.jobs > 1 else None)))
+    return writers
+
+
+def run(args):
+    """
+    parse args.file once and write every output of args.formats. returns the GPS points
+    """
+    logger = logging.getLogger(__name__)
+    unknown = set(args.formats) - set(FORMATS)
+    if unknown:
+        raise ValueError('unknown output formats: %s' % ', '.join(sorted(unknown)))
+    base = Path(args.output) if args.output else Path(args.file).with_suffix('')
+    args.binary = args.binary or not is_video(args.file)
+
+    frame_info = None
+    if args.preview:
+        # the coarse track only: one point per DEVC, see preview.py
+        from .preview import preview
+        if set(args.formats) - set(TRACK_FORMATS) or args.images:
+            logger.warning('--preview only writes the GPS track (gpx, kml, csv, geojson)')
+        points = preview(args.file, skip=args.skip, backend=args.backend).points
+    elif (set(args.formats) & set(FRAME_FORMATS) or args.images) and not args.binary:
+        frame_info, points = read_frames(args, base)
+    else:
+        if set(args.formats) & set(FRAME_FORMATS) or args.images:
+            logger.warning(f'{args.file} is not a video: no per-frame outputs')
+        klvlist, points = read_gpmf(args, base)
+        write_streams(args, base, klvlist)
+        if points is None:
+            from .gopro2gpx import BuildGPSPoints
+            points = BuildGPSPoints(klvlist, skip=args.skip)
+
+    if set(args.formats) & set(TRACK_FORMATS):
+        if len(points) == 0:
+            print("Can't create file. No GPS info in %s" % args.file)
+        else:
+            points = process_points(points, args)
+
+    for description, writer, writer_args in output_writers(args, base, points, frame_info):
+        logger.info(f'Writing {description}: {str(writer_args[0])}')
+        writer(*writer_args)
+    return points
+
+
+class CliTest(unittest.TestCase):
+    SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+
+    def setUp(self):
+        import tempfile
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+
+    def _expected_csv(self, name):
+        from . import gpshelper
+        from .gopro2gpx import BuildGPSPoints
+        from .klv_extraction import parseStream
+
+        klvlist, _ = parseStream((self.SAMPLES / name).read_bytes())
+        return gpshelper.generate_CSV(BuildGPSPoints(klvlist))
+
+    def test_one_pass(self):
+        from unittest import mock
+        from . import gpmf
+        from .streams import stream_names
+
+        base = self.tmp / 'hero6'
+        # not -b: a .bin is recognized as a GPMF dump
+        args = parseArgs([str(self.SAMPLES / 'hero6.bin'), '-o', str(base), '-f', 'gpx', '-f', 'csv', '-f', 'npz'])
+        with mock.patch.object(gpmf.Parser, 'readFromBinary', autospec=True,
+                               side_effect=gpmf.Parser.readFromBinary) as parse:
+            points = run(args)
+        self.assertEqual(parse.call_count, 1)
+        self.assertTrue(args.binary)
+
+        self.assertEqual(sorted(p.name for p in self.tmp.iterdir()), ['hero6.csv', 'hero6.gpx', 'hero6.streams.npz'])
+        self.assertEqual(output_path(base, 'csv').read_text(), self._expected_csv('hero6.bin'))
+        self.assertEqual(output_path(base, 'gpx').read_text().count('<trkpt'), len(points))
+        self.assertIn('GPS5', stream_names(output_path(base, 'npz')))
+
+    def test_no_frames_in_dump(self):
+        base = self.tmp / 'gopro7'
+        with self.assertLogs(__name__, 'WARNING') as logs:
+            run(options(file=str(self.SAMPLES / 'gopro7.bin'), output=str(base), formats=['csv', 'mat']))
+        self.assertIn('is not a video: no per-frame outputs', logs.output[0])
+        self.assertEqual([p.name for p in self.tmp.iterdir()], ['gopro7.csv'])
+        self.assertEqual(output_path(base, 'csv').read_text(), self._expected_csv('gopro7.bin'))
+
+    def test_preview(self):
+        base = self.tmp / 'gopro7'
+        with self.assertLogs(__name__, 'WARNING') as logs:
+            points = run(options(file=str(self.SAMPLES / 'gopro7.bin'), output=str(base), formats=['gpx', 'npz'],
+                                 preview=True))
+        self.assertIn('--preview only writes the GPS track', logs.output[0])
+        self.assertEqual([p.name for p in self.tmp.iterdir()], ['gopro7.gpx'])
+        # one point per DEVC
+        self.assertLess(len(points), len(self._expected_csv('gopro7.bin').splitlines()) / 10)
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            run(options(file=str(self.SAMPLES / 'hero6.bin'), output=str(self.tmp / 'x'), formats=['gpx', 'shp']))
+        self.assertEqual(list(self.tmp.iterdir()), [])
+
+    def test_video(self):
+        from .streams import stream_names
+        from .testing import can_write_test_video, write_test_video
+
+        if not can_write_test_video():
+            self.skipTest('needs PyAV 13 or later to write the test video')
+        video = self.tmp / 'hero6.mp4'
+        frames = write_test_video(video, (self.SAMPLES / 'hero6.bin').read_bytes(), fps=5)
+        base = self.tmp / 'out'
+        # track, frame and stream outputs from the one demux of the video
+        points = run(options(file=str(video), output=str(base), formats=['gpx', 'csv', 'frames', 'npz']))
+        self.assertFalse(is_video(self.SAMPLES / 'hero6.bin'))
+        self.assertTrue(is_video(video))
+        self.assertEqual(output_path(base, 'csv').read_text(), self._expected_csv('hero6.bin'))
+        self.assertEqual(len(output_path(base, 'frames').read_text().splitlines()), frames + 1)
+        self.assertIn('GPS5', stream_names(output_path(base, 'npz')))
+        self.assertEqual(output_path(base, 'gpx').read_text().count('<trkpt'), len(points))
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(prog="gopro2gpx",
+                                     description="extract the GPS track and metadata of a GoPro video in one pass")
+    parser.add_argument("file", help="GoPro video file (.mp4) or binary metadata dump (.bin)")
+    parser.add_argument("-o", "--output", help="output base name (default: the input without its extension)")
+    parser.add_argument("-f", "--format", dest="formats", action="append", choices=list(FORMATS),
+                        help="output format, repeat for several (default: %s)" % ", ".join(DEFAULT_FORMATS))
+    parser.add_argument("-v", "--verbose", help="increase output verbosity (-vv dumps the raw GPMF track)", action="count")
+    parser.add_argument("-b", "--binary", help="the input is a binary metadata dump", action="store_true")
+    parser.add_argument("-s", "--skip", help="Skip bad points (GPSFIX=0)", action="store_true", default=False)
+    parser.add_argument("-r", "--rate", help="resample the track to a fixed rate in Hz (e.g. 1, 10, 30)", type=float)
+    parser.add_argument("--simplify", help="simplify the track to this tolerance in metres", type=float, metavar="METRES")
+    parser.add_argument("--max_points", help="limit the track to N points", type=int)
+    parser.add_argument("--smooth", help="reject GPS outliers and smooth the track (Kalman filter, using the DOP)", action="store_true")
+    parser.add_argument("-m", "--metrics", help="add distance, grade, vertical speed, heading and acceleration to the GPX and CSV", action="store_true")
+    parser.add_argument("--preview", help="quick look: a coarse track (one point per second) read from a few bytes of the clip", action="store_true")
+    parser.add_argument("--recover", help="skip damaged GPMF blocks (bad sectors, truncated files) instead of failing", action="store_true")
+    parser.add_argument("--backend", help="how to read the GPMF track of a video (default: the first installed of native, pyav, ffmpeg)", choices=("auto", "native", "pyav", "ffmpeg"), default="auto")
+    parser.add_argument("-j", "--jobs", help="parse the GPMF track (or decode the --images) with N processes", type=int, default=1)
+    parser.add_argument("-n", "--max_frames", type=int, help="per-frame outputs: stop after N frames")
+    parser.add_argument("--memory_limit", type=int, metavar="MB",
+                        help="per-frame outputs: spill the metadata to temporary files past this many MB")
+    parser.add_argument("--images", type=Path, metavar="DIR",
+                        help="save geotagged IMG_xxxx.JPG frames (and their PIX4D CSV) to this directory")
+    spacing = parser.add_mutually_exclusive_group()
+    spacing.add_argument("--every", type=int, metavar="N", help="with --images, save every Nth frame")
+    spacing.add_argument("--every_metres", type=float, metavar="METRES", help="with --images, save a frame every METRES")
+    spacing.add_argument("--every_seconds", type=float, metavar="SECONDS", help="with --images, save a frame every SECONDS")
+    parser.add_argument('-l', '--loglevel', default='warning',
+                        help='Provide logging level. Example --loglevel debug')
+    args = parser.parse_args(argv)
+    args.formats = args.formats or list(DEFAULT_FORMATS)
+    return args
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    logging.basicConfig(level=args.loglevel.upper())
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
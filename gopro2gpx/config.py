@@ -11,6 +11,9 @@ import configparser
 import platform
 import sys
 
+# default memory budget (bytes) for the metadata accumulated while reading one video
+DEFAULT_MEMORY_LIMIT = 256 * 1024 * 1024
+
 class Config:
     def __init__(self, ffmpeg, ffprobe):
         self.ffmpeg_cmd = ffmpeg
@@ -50,6 +53,8 @@ def setup_environment(args):
     config.verbose = args.verbose
     config.file = args.file
     config.outputfile = args.outputfile
+    config.recover = getattr(args, 'recover', False)
+    config.backend = getattr(args, 'backend', 'auto')
     return config
 
 
@@ -11,7 +11,11 @@ import struct
 import time
 import collections
 import copy
+import functools
+import re
+import unittest
 from datetime import datetime
+from pathlib import Path
 
 maptype = { 'c': 'c',
 			'L': 'L',
@@ -42,6 +46,64 @@ GPSData = collections.namedtuple("GPSData","lat lon alt speed speed3d")
 KARMAGPSData = collections.namedtuple("KARMAGPSData", "tstamp lat lon alt speed speed3d unk1 unk2 unk3 unk4")
 SYSTData = collections.namedtuple("SYSTData", "seconds miliseconds")
 
+# big-endian numpy equivalents of the GPMF type chars, used for the complex ('?') structures described by TYPE
+complex_types = { 'b': 'i1',
+			'B': 'u1',
+			'c': 'S1',
+			'd': '>f8',
+			'f': '>f4',
+			'F': 'S4',
+			'G': 'V16',
+			'j': '>i8',
+			'J': '>u8',
+			'l': '>i4',
+			'L': '>u4',
+			'q': '>i4',
+			'Q': '>i8',
+			's': '>i2',
+			'S': '>u2',
+			'U': 'S16'
+	}
+
+@functools.lru_cache(maxsize=None)
+def compile_type(type_string):
+	"""
+	compile a TYPE string such as 'JlllSSSSBB' (or with arrays, 'Lf[4]') into a packed big-endian numpy
+	structured dtype. fields are named f0, f1, ... in order. results are cached: a clip repeats the same few
+	TYPEs in every DEVC. returns None if the string uses an unknown type char
+	"""
+	import numpy as np
+
+	fields = []
+	for ctype, count in re.findall(r'(.)(?:\[(\d+)\])?', type_string.strip('\0')):
+		if ctype not in complex_types:
+			return None
+		if count:
+			fields.append(('f%d' % len(fields), complex_types[ctype], (int(count),)))
+		else:
+			fields.append(('f%d' % len(fields), complex_types[ctype]))
+	if not fields:
+		return None
+	return np.dtype(fields)
+
+def decode_complex(klvdata, default_type=None):
+	"""
+	decode every sample of a complex ('?') payload at once, using the sticky TYPE of its stream (or default_type
+	for the streams that are known to come without one). returns a numpy structured array, or None when the
+	structure is unknown or doesn't match the payload size
+	"""
+	import numpy as np
+
+	if not klvdata.rawdata:
+		return None
+	type_string = klvdata.complex_type or default_type
+	if not type_string:
+		return None
+	dtype = compile_type(type_string)
+	if dtype is None or dtype.itemsize != klvdata.size:
+		return None
+	return np.frombuffer(klvdata.rawdata, dtype=dtype, count=klvdata.repeat)
+
 class LabelBase:
 	def __init__(self):
 		pass
@@ -63,6 +125,20 @@ class LabelEmpty(LabelBase):
 			return None
 		return klvdata.rawdata[0:10]
 
+class LabelComplex(LabelBase):
+	"""
+	any stream stored as a complex type ('?'), described by the TYPE that precedes it in the STRM.
+	decoded in bulk to a numpy structured array, one record per sample
+	"""
+	def __init__(self):
+		LabelBase.__init__(self)
+
+	def Build(self, klvdata):
+		data = decode_complex(klvdata)
+		if data is None:
+			return LabelEmpty().Build(klvdata)
+		return data
+
 class Label_TypecString(LabelBase):
 	"c 1 X"
 	def __init__(self):
@@ -102,6 +178,13 @@ class LabelSIUN(Label_TypecString):
 	def __init__(self):
 		Label_TypecString.__init__(self)
 
+class LabelTYPE(Label_TypecString):
+	"""
+	structure of the complex ('?') samples of the stream, one type char per field (e.g. 'JlllSSSSBB')
+	"""
+	def __init__(self):
+		Label_TypecString.__init__(self)
+
 class LabelSCAL(LabelBase):
 	def __init__(self):
 		LabelBase.__init__(self)
@@ -263,17 +346,12 @@ class LabelGPRI(LabelBase):
 		GPRI ? 30 4 {b'\x00\x00\x00\x00\tI\xb4\xde\x13\xbe'} |b'\x00\x00\x00\x00\tI\xb4\xde\x13\xbe'| [	
 		
 		"""
-		karma_type = 'JlllSSSSBB'
-		s_karma_type = "".join( [map_type(ord(x)) for x in karma_type ])
-
-		if not klvdata.rawdata:
+		records = decode_complex(klvdata, default_type='JlllSSSSBB')
+		if records is None:
 			# empty point
 			data = GPSData(0,0,0,0,0)
 		else:
-			stype = map_type(klvdata.type)
-			s = struct.Struct('>' + s_karma_type )
-			data_tuple = s.unpack_from(klvdata.rawdata)
-			data = KARMAGPSData._make( data_tuple )
+			data = KARMAGPSData._make( records[0].tolist() )
 		return(data)
 
 class LabelSYST(LabelBase):
@@ -291,16 +369,11 @@ class LabelSYST(LabelBase):
 		SCAL l 4 2 {(1000000, 1000)} |b'\x00\x0fB@\x00\x00\x03\xe8'| [00 0f 42 40 00 00 03 e8]
 		SYST ? 16 1 {b'\x00\x00\x00\x00\tc\xec\x92\x00\x00'} |b'\x00\x00\x00\x00\tc\xec\x92\x00\x00'| [00 00 00 00 09 63 ec 92 00 00 01 5b 7d 62 f5 28]
 		"""
-		if not klvdata.rawdata:
+		records = decode_complex(klvdata, default_type='JJ')
+		if records is None or len(records) == 0:
 			data = SYSTData(0,0)
 		else:
-			karma_type = 'JJ'
-			s_karma_type = "".join( [map_type(ord(x)) for x in karma_type ])
-			stype = map_type(klvdata.type)
-
-			s = struct.Struct('>' + s_karma_type )
-			data_tuple = s.unpack_from(klvdata.rawdata)
-			data = SYSTData._make( data_tuple )
+			data = SYSTData._make( records[0].tolist() )
 		return(data)
 
 class LabelTMPC(LabelBase):
@@ -359,7 +432,7 @@ labels = {
 		"STNM" : LabelSTNM,
 		"ISOG" : LabelEmpty,
 		"SHUT" : LabelEmpty,
-		"TYPE" : LabelEmpty,
+		"TYPE" : LabelTYPE,
 		"FACE" : LabelEmpty,
 		"FCNM" : LabelEmpty,
 		"ISOE" : LabelEmpty,
@@ -433,6 +506,9 @@ labels = {
 }
 
 def Manage(klvdata):
+	if klvdata.type == ord('?') and labels.get(klvdata.fourCC, LabelEmpty) is LabelEmpty:
+		# no hand-written decoder for this stream, but its TYPE describes the structure
+		return LabelComplex().Build(klvdata)
 	if klvdata.fourCC in labels.keys():
 		return labels[klvdata.fourCC]().Build(klvdata)
 	else:
@@ -440,3 +516,58 @@ def Manage(klvdata):
 		print("Warning. fourCC Label '%s' not found. Please summit a issue to: %s" % (klvdata.fourCC,issue_url ))
 		return False
 
+
+class ComplexTypeTest(unittest.TestCase):
+	SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+
+	def klv(self, label, type_string, sample_format, samples):
+		from .klvdata import KLVData
+
+		payload = b''.join(struct.pack(sample_format, *sample) for sample in samples)
+		size = struct.calcsize(sample_format)
+		raw = struct.pack('>4sBBH', label, ord('?'), size, len(samples)) + payload + b'\0' * (-len(payload) % 4)
+		return KLVData(raw, 0, type_string)
+
+	def test_compile_type(self):
+		dtype = compile_type('Lf[2]qQbc\0')
+		self.assertEqual(dtype.names, ('f0', 'f1', 'f2', 'f3', 'f4', 'f5'))
+		self.assertEqual(dtype.itemsize, 4 + 8 + 4 + 8 + 1 + 1)
+		self.assertEqual(dtype['f1'].shape, (2,))
+		# the fixed point types stay raw integers: q is Q15.16 in 32 bits, Q is Q31.32 in 64 bits
+		self.assertEqual((dtype['f2'].str, dtype['f3'].str), ('>i4', '>i8'))
+		self.assertIs(compile_type('Lf[2]qQbc'), compile_type('Lf[2]qQbc'))
+		self.assertIsNone(compile_type('Lz'))
+		self.assertIsNone(compile_type(''))
+
+	def test_decode_complex(self):
+		# 1.5 and -2.25 in Q15.16, 1.5 in Q31.32
+		samples = [(7, 0.5, -1.0, int(1.5 * 2 ** 16), int(1.5 * 2 ** 32), -3, b'x'),
+				   (8, 2.0, 4.0, int(-2.25 * 2 ** 16), -1, 127, b'y')]
+		klv = self.klv(b'KBAT', 'Lf[2]qQbc', '>L2fiqbc', samples)
+		data = klv.data
+		self.assertEqual(len(data), 2)
+		self.assertEqual(list(data['f0']), [7, 8])
+		self.assertEqual(data['f1'].tolist(), [[0.5, -1.0], [2.0, 4.0]])
+		self.assertEqual(data['f2'].tolist(), [98304, -147456])
+		self.assertEqual(data['f2'][0] / 2 ** 16, 1.5)
+		self.assertEqual(data['f3'].tolist(), [6442450944, -1])
+		self.assertEqual(data['f4'].tolist(), [-3, 127])
+		self.assertEqual(data['f5'].tolist(), [b'x', b'y'])
+
+		# a TYPE that doesn't match the sample size, or no TYPE at all
+		self.assertIsNone(decode_complex(self.klv(b'KBAT', 'Lf', '>L2fiqbc', samples)))
+		self.assertIsNone(decode_complex(self.klv(b'KBAT', None, '>L2fiqbc', samples)))
+		self.assertIsNotNone(decode_complex(self.klv(b'KBAT', None, '>L2fiqbc', samples), 'Lf[2]qQbc'))
+
+	def test_karma_battery(self):
+		from .klv_extraction import parseStream
+
+		klvlist, _ = parseStream((self.SAMPLES / 'karma.bin').read_bytes())
+		# the empty ones (no sample in that DEVC) decode to None
+		kbat = [klv for klv in klvlist if klv.fourCC == 'KBAT' and klv.rawdata]
+		self.assertTrue(kbat)
+		self.assertEqual(kbat[0].complex_type, 'lLlsSSSSSSSBBBb')
+		for klv in kbat:
+			expected = struct.unpack('>lLlhHHHHHHHBBBb', klv.rawdata[:klv.size])
+			self.assertEqual(klv.data.dtype.itemsize, klv.size)
+			self.assertEqual(tuple(klv.data[0].tolist()), expected)
@@ -0,0 +1,372 @@
+"""
+geotagged still images from a GoPro video, e.g. for photogrammetry (PIX4D, OpenDroneMap).
+
+the frames are picked before anything is decoded: every Nth frame, or one frame every so many metres (from the GPS
+track) or seconds. the selected frames are sorted and cut into runs handed to a thread pool; each run seeks to the
+keyframe before its first frame and decodes forward, seeking again when the next selected frame is more than a
+second ahead. frames in between are decoded (the codec needs them) but never converted to images, and the GOPs
+without a selected frame are not decoded at all.
+
+every image is a JPEG with the EXIF GPS tags (position, altitude, time, speed) of its frame, named IMG_xxxx.JPG like
+the rows of the PIX4D CSV of klv_extraction. a PIX4D CSV of the extracted images is written next to them.
+
+the positions come from the frame_info of klv_extraction, or, standalone, from the GPMF track alone: the frame times
+are computed from the frame rate, so no frame is decoded just to be counted.
+
+usage:
+    python -m gopro2gpx.frames GH010198.MP4 images/ --every_metres 2
+    python -m gopro2gpx.frames GH010198.MP4 images/ --every 30 -j 4
+    python -m gopro2gpx.klv_extraction --output_images images/ --every_seconds 0.5 GH010198.MP4
+
+needs Pillow (frame.to_image()).
+"""
+
+import argparse
+import concurrent.futures
+import logging
+import math
+import os
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+# frames per task: long enough that seeking is rare, short enough to spread the work over the threads
+TASKS_PER_JOB = 4
+
+# seconds: decode forward to the next selected frame if it is closer than this, seek if it is further
+SEEK_AHEAD = 1.0
+
+JPEG_QUALITY = 95
+
+
+def select_frames(frame_info, every=None, metres=None, seconds=None):
+    """
+    sorted indices (rows of frame_info) of the frames to extract: every Nth frame, the first frame after every
+    `metres` of track, or the first frame after every `seconds` of video. frames without a position are left out
+    """
+    times = np.asarray(frame_info['presentation_time'], dtype=float)
+    lat = np.asarray(frame_info['latitude'], dtype=float)
+    lon = np.asarray(frame_info['longitude'], dtype=float)
+    # the frames after the last GPMF chunk of klv_extraction are padded with zeros
+    candidates = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon) & np.isfinite(times) & ((lat != 0) | (lon != 0)))
+    if not len(candidates):
+        return candidates
+
+    if metres:
+        from .metrics import step_distances
+        distance = np.concatenate([[0.0], np.cumsum(step_distances(lat[candidates], lon[candidates]))])
+        marks = np.arange(0.0, distance[-1] + metres / 2, metres)
+        return np.unique(candidates[np.minimum(np.searchsorted(distance, marks), len(candidates) - 1)])
+    if seconds:
+        t = times[candidates]
+        marks = np.arange(t[0], t[-1] + seconds / 2, seconds)
+        return np.unique(candidates[np.minimum(np.searchsorted(t, marks), len(candidates) - 1)])
+    return candidates[::every or 1]
+
+
+def image_names(frame_info):
+    """
+    the IMG_xxxx.JPG name of every row of frame_info, the same as in the PIX4D CSV
+    """
+    from .klv_extraction import pix4d_image_name
+
+    frame_count = len(frame_info['index'])
+    return [pix4d_image_name(index, frame_count) for index in frame_info['index']]
+
+
+def _rational(value):
+    # degrees, minutes, seconds
+    value = abs(value)
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = (value - degrees - minutes / 60.0) * 3600
+    return (degrees, minutes, round(seconds, 6))
+
+
+def gps_exif(latitude, longitude, elevation=None, gps_time=None, speed=None):
+    """
+    a PIL.Image.Exif holding the GPS tags of one image. gps_time is a numpy datetime64 or None, speed is in m/s
+    """
+    from PIL import Image
+    from PIL.ExifTags import GPS, IFD
+
+    exif = Image.Exif()
+    gps = {
+        GPS.GPSVersionID: b'\x02\x03\x00\x00',
+        GPS.GPSLatitudeRef: 'N' if latitude >= 0 else 'S',
+        GPS.GPSLatitude: _rational(latitude),
+        GPS.GPSLongitudeRef: 'E' if longitude >= 0 else 'W',
+        GPS.GPSLongitude: _rational(longitude),
+        GPS.GPSMapDatum: 'WGS-84',
+    }
+    if elevation is not None and math.isfinite(elevation):
+        gps[GPS.GPSAltitudeRef] = b'\x00' if elevation >= 0 else b'\x01'
+        gps[GPS.GPSAltitude] = round(abs(elevation), 3)
+    if speed is not None and math.isfinite(speed):
+        gps[GPS.GPSSpeedRef] = 'K'
+        gps[GPS.GPSSpeed] = round(speed * 3.6, 3)
+    if gps_time is not None and not np.isnat(gps_time):
+        when = gps_time.astype('datetime64[us]').item()
+        gps[GPS.GPSTimeStamp] = (when.hour, when.minute, when.second + when.microsecond / 1e6)
+        gps[GPS.GPSDateStamp] = when.strftime('%Y:%m:%d')
+        exif[0x0132] = when.strftime('%Y:%m:%d %H:%M:%S')  # DateTime
+        exif.get_ifd(IFD.Exif)[0x9003] = when.strftime('%Y:%m:%d %H:%M:%S')  # DateTimeOriginal
+    exif.get_ifd(IFD.GPSInfo).update(gps)
+    return exif
+
+
+def _runs(times, pieces):
+    # cut the sorted frame times into about `pieces` runs, preferably where there is a seek anyway
+    if not len(times):
+        return []
+    target = max(len(times) // max(pieces, 1), 1)
+    runs = []
+    start = 0
+    for ix in range(1, len(times)):
+        if ix - start >= target or (ix - start >= target // 2 and times[ix] - times[ix - 1] > SEEK_AHEAD):
+            runs.append((start, ix))
+            start = ix
+    runs.append((start, len(times)))
+    return runs
+
+
+def _extract_run(source, times, save):
+    """
+    decode the frames at `times` (sorted seconds), calling save(position in times, frame) for each one
+    """
+    import av
+
+    with av.open(str(source)) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = 'AUTO'
+        half_frame = 0.5 / float(stream.average_rate or 30)
+        ix = 0
+        saved = 0
+        while ix < len(times):
+            # seek to the keyframe at or before the next wanted frame
+            container.seek(int(max(times[ix] - half_frame, 0) / stream.time_base), stream=stream, backward=True)
+            for frame in container.decode(stream):
+                if frame.time is None or frame.time < times[ix] - half_frame:
+                    continue
+                while ix < len(times) and frame.time >= times[ix] - half_frame:
+                    if frame.time <= times[ix] + half_frame:
+                        save(ix, frame)
+                        saved += 1
+                    ix += 1
+                if ix >= len(times) or times[ix] - frame.time > SEEK_AHEAD:
+                    break
+            else:
+                # end of the video
+                break
+        return saved
+
+
+def extract_images(source, frame_info, indices, output_dir, jobs=None, quality=JPEG_QUALITY):
+    """
+    save the frames at the rows `indices` of frame_info as geotagged JPEGs in output_dir. returns the paths written,
+    in time order: not the ones of frames that could not be decoded, even if a file of that name is already there
+    """
+    logger = logging.getLogger(__name__)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    jobs = jobs or os.cpu_count() or 1
+
+    indices = np.asarray(indices, dtype=np.int64)
+    indices = indices[np.argsort(frame_info['presentation_time'][indices], kind='stable')]
+    times = np.asarray(frame_info['presentation_time'], dtype=float)[indices]
+    names = image_names(frame_info)
+    paths = [output_dir / names[row] for row in indices]
+    written = [False] * len(paths)
+
+    def save(position, frame):
+        row = indices[position]
+        exif = gps_exif(float(frame_info['latitude'][row]), float(frame_info['longitude'][row]),
+                        float(frame_info['elevation'][row]),
+                        frame_info['gps_time'][row] if 'gps_time' in frame_info else None,
+                        float(frame_info['speed'][row]) if 'speed' in frame_info else None)
+        frame.to_image().save(paths[position], quality=quality, exif=exif)
+        written[position] = True
+
+    runs = _runs(times, jobs * TASKS_PER_JOB)
+    logger.info(f'Extracting {len(indices)} frames of {str(source)} in {len(runs)} runs with {jobs} threads')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(_extract_run, source, times[start:end],
+                               lambda position, frame, start=start: save(start + position, frame))
+                   for start, end in runs]
+        for future in futures:
+            future.result()
+    saved = sum(written)
+    if saved < len(indices):
+        logger.warning(f'{len(indices) - saved} of the selected frames could not be decoded')
+    return [path for path, done in zip(paths, written) if done]
+
+
+def frame_positions(source, skip=False):
+    """
+    a frame_info with the columns select_frames() and extract_images() need (index, presentation_time, gps_time,
+    latitude, longitude, elevation, speed), from the frame rate and the GPMF track only: nothing is decoded
+    """
+    from .api import iter_devc
+    from .geodesy import interp_geodetic
+    from .gopro2gpx import GPSPointBuilder
+    from .klv_extraction import parseStream
+    from .np_datetime_conv import interp_time_array
+    from .orientation import frame_times
+
+    builder = GPSPointBuilder(skip=skip)
+    gps_times, points = [], []
+    for raw, time, duration in iter_devc(source):
+        klvlist, _ = parseStream(raw)
+        new = builder.add(klvlist)
+        if new and time is not None:
+            # spread the points of a packet evenly over its duration, like the frames of FrameInfoBuilder
+            gps_times.append(time + np.arange(len(new)) * ((duration or 1.0) / len(new)))
+            points.extend(new)
+
+    times = frame_times(source)
+    frame_info = {'index': np.arange(len(times), dtype=float), 'presentation_time': times}
+    nan = np.full(len(times), np.nan)
+    if not points:
+        frame_info.update(gps_time=np.full(len(times), np.datetime64('NaT'), dtype='datetime64[us]'),
+                          latitude=nan, longitude=nan, elevation=nan, speed=nan)
+        return frame_info
+
+    xp = np.concatenate(gps_times)
+    covered = (times >= xp[0]) & (times <= xp[-1] + 1.0)
+    lat, lon, elevation = interp_geodetic(times, xp, [p.latitude for p in points], [p.longitude for p in points],
+                                          [p.elevation for p in points])
+    frame_info.update(
+        gps_time=interp_time_array(times, xp,
+                                   np.array([np.datetime64(p.time) for p in points], dtype='datetime64[us]')),
+        latitude=np.where(covered, lat, np.nan),
+        longitude=np.where(covered, lon, np.nan),
+        elevation=np.where(covered, elevation, np.nan),
+        speed=np.where(covered, np.interp(times, xp, [p.speed for p in points]), np.nan))
+    return frame_info
+
+
+def write_images(output_dir, source, frame_info, every=None, metres=None, seconds=None, jobs=None):
+    """
+    select, extract and geotag the frames, and write the PIX4D CSV of the images to output_dir/images_pix4d.csv
+    """
+    from .klv_extraction import write_pix4d_csv
+
+    indices = select_frames(frame_info, every, metres, seconds)
+    paths = extract_images(source, frame_info, indices, output_dir, jobs)
+    # the rows of the images that were written
+    rows = dict(zip(image_names(frame_info), range(len(frame_info['index']))))
+    write_pix4d_csv(Path(output_dir) / 'images_pix4d.csv', frame_info, sorted(rows[path.name] for path in paths))
+    return paths
+
+
+class FramesTest(unittest.TestCase):
+    SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+
+    def _straight(self, n=900, fps=30.0, speed=10.0):
+        # due north at constant speed, the first and last frames without a position
+        times = np.arange(n) / fps
+        lat = 40.0 + times * speed / 111195.0
+        lat[[0, -1]] = [0.0, np.nan]
+        return {'index': np.arange(n, dtype=float), 'presentation_time': times, 'latitude': lat,
+                'longitude': np.where(np.isfinite(lat) & (lat != 0), -3.0, 0.0)}
+
+    def test_select_frames(self):
+        from .metrics import step_distances
+
+        frame_info = self._straight()
+        np.testing.assert_array_equal(select_frames(frame_info, every=7), np.arange(1, 899, 7))
+        np.testing.assert_array_equal(select_frames(frame_info), np.arange(1, 899))
+
+        # the last step is shorter: the last frame with a position ends the selection if it is over half a step away
+        rows = select_frames(frame_info, seconds=0.5)
+        self.assertEqual((rows[0], rows[-1]), (1, 898))
+        steps = np.diff(frame_info['presentation_time'][rows])
+        np.testing.assert_allclose(steps[:-1], 0.5, atol=1 / 30.0)
+        self.assertTrue(0.25 <= steps[-1] <= 0.5)
+
+        rows = select_frames(frame_info, metres=7.0)
+        self.assertEqual((rows[0], rows[-1]), (1, 898))
+        steps = step_distances(frame_info['latitude'][rows], frame_info['longitude'][rows])
+        # 10 m/s at 30 fps: within a frame (0.33 m) of every 7 m
+        np.testing.assert_allclose(steps[:-1], 7.0, atol=10 / 30.0)
+        self.assertTrue(3.5 <= steps[-1] <= 7.0)
+
+    def test_exif_round_trip(self):
+        import io
+        from PIL import Image
+        from PIL.ExifTags import GPS, IFD
+
+        def degrees(dms):
+            return float(dms[0]) + float(dms[1]) / 60 + float(dms[2]) / 3600
+
+        when = np.datetime64('2019-02-24T11:19:55.699556')
+        buffer = io.BytesIO()
+        Image.new('RGB', (8, 8)).save(buffer, 'JPEG', exif=gps_exif(-33.8567844, -70.2193301, -12.5, when, 10.0))
+        exif = Image.open(io.BytesIO(buffer.getvalue())).getexif()
+        gps = exif.get_ifd(IFD.GPSInfo)
+
+        self.assertEqual((gps[GPS.GPSLatitudeRef], gps[GPS.GPSLongitudeRef]), ('S', 'W'))
+        self.assertAlmostEqual(degrees(gps[GPS.GPSLatitude]), 33.8567844, places=7)
+        self.assertAlmostEqual(degrees(gps[GPS.GPSLongitude]), 70.2193301, places=7)
+        self.assertEqual((gps[GPS.GPSAltitudeRef], float(gps[GPS.GPSAltitude])), (b'\x01', 12.5))
+        self.assertAlmostEqual(float(gps[GPS.GPSSpeed]), 36.0)
+        self.assertEqual(gps[GPS.GPSDateStamp], '2019:02:24')
+        self.assertAlmostEqual(float(gps[GPS.GPSTimeStamp][2]), 55.699556, places=5)
+        self.assertEqual(exif.get_ifd(IFD.Exif)[0x9003], '2019:02:24 11:19:55')
+
+    def test_extract_images(self):
+        import tempfile
+        from PIL import Image
+        from .testing import can_write_test_video, write_test_video
+
+        if not can_write_test_video():
+            self.skipTest('needs PyAV 13 or later to write the test video')
+        with tempfile.TemporaryDirectory() as tmp:
+            video = Path(tmp) / 'hero6.mp4'
+            frame_count = write_test_video(video, (self.SAMPLES / 'hero6.bin').read_bytes()[:30000], fps=5)
+            frame_info = frame_positions(video)
+            self.assertEqual(len(frame_info['index']), frame_count)
+            # a last row past the end of the video, whose image is already there from an earlier run
+            frame_info = {k: np.append(v, v[-1] + (1 if k == 'index' else 10 if k == 'presentation_time' else 0))
+                          for k, v in frame_info.items()}
+            names = image_names(frame_info)
+            (Path(tmp) / 'images').mkdir()
+            (Path(tmp) / 'images' / names[-1]).write_bytes(b'stale')
+
+            indices = [2, 7, 11, len(names) - 1]
+            paths = extract_images(video, frame_info, indices, Path(tmp) / 'images', jobs=2)
+            self.assertEqual([path.name for path in paths], [names[i] for i in indices[:-1]])
+            for path in paths:
+                with Image.open(path) as image:
+                    self.assertEqual(image.size, (64, 48))
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="extract geotagged still images from a GoPro video")
+    parser.add_argument("video_file", help="GoPro video file (.mp4)", type=Path)
+    parser.add_argument("output_dir", help="directory for the IMG_xxxx.JPG images", type=Path)
+    spacing = parser.add_mutually_exclusive_group()
+    spacing.add_argument("--every", type=int, metavar="N", help="extract every Nth frame")
+    spacing.add_argument("--every_metres", type=float, metavar="METRES", help="extract a frame every METRES of track")
+    spacing.add_argument("--every_seconds", type=float, metavar="SECONDS", help="extract a frame every SECONDS")
+    parser.add_argument("-s", "--skip", help="Skip bad points (GPSFIX=0)", action="store_true", default=False)
+    parser.add_argument("-j", "--jobs", type=int, help="decoding threads (default: one per core)")
+    parser.add_argument('-l', '--loglevel', default='info',
+                        help='Provide logging level. Example --loglevel debug')
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    logging.basicConfig(level=args.loglevel.upper())
+    logger = logging.getLogger(__name__)
+
+    frame_info = frame_positions(args.video_file, skip=args.skip)
+    paths = write_images(args.output_dir, args.video_file, frame_info, args.every, args.every_metres,
+                         args.every_seconds, args.jobs)
+    logger.info(f'Wrote {len(paths)} images to {str(args.output_dir)}')
+
+
+if __name__ == "__main__":
+    main()
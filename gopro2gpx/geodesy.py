@@ -0,0 +1,301 @@
+"""
+bulk WGS84 coordinate conversions and track resampling.
+
+interpolating latitude and longitude independently is only approximately right (it ignores the curvature of the
+earth and gets worse near the poles and the antimeridian), so these helpers convert whole arrays to earth-centered,
+earth-fixed (ECEF) coordinates, interpolate there, and convert back. everything works on numpy arrays so resampling a
+long track costs a handful of vectorized passes instead of a python loop per point.
+
+quaternions are interpolated with a batched SLERP. they use the same (qw, qx, qy, qz) ordering as fourCC.QUATData.
+"""
+
+import unittest
+from datetime import timedelta
+from pathlib import Path
+
+import numpy as np
+
+from . import gpshelper
+from .np_datetime_conv import interp_time_array
+
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1.0 / 298.257223563
+WGS84_B = WGS84_A * (1.0 - WGS84_F)
+WGS84_E2 = WGS84_F * (2.0 - WGS84_F)
+WGS84_EP2 = (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+# mean radius, for the spherical approximations
+EARTH_RADIUS = 6371008.8
+
+
+def geodetic_to_ecef(lat, lon, alt):
+    """
+    latitude and longitude in degrees, altitude in metres above the ellipsoid. returns x, y, z in metres
+    """
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    alt = np.asarray(alt, dtype=float)
+
+    sin_lat = np.sin(lat)
+    cos_lat = np.cos(lat)
+    n = WGS84_A / np.sqrt(1.0 - WGS84_E2 * sin_lat ** 2)
+
+    x = (n + alt) * cos_lat * np.cos(lon)
+    y = (n + alt) * cos_lat * np.sin(lon)
+    z = (n * (1.0 - WGS84_E2) + alt) * sin_lat
+    return x, y, z
+
+
+def ecef_to_geodetic(x, y, z):
+    """
+    inverse of geodetic_to_ecef, using Bowring's closed form (sub-millimetre for anything near the surface)
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    z = np.asarray(z, dtype=float)
+
+    p = np.hypot(x, y)
+    theta = np.arctan2(z * WGS84_A, p * WGS84_B)
+    lat = np.arctan2(z + WGS84_EP2 * WGS84_B * np.sin(theta) ** 3,
+                     p - WGS84_E2 * WGS84_A * np.cos(theta) ** 3)
+    lon = np.arctan2(y, x)
+
+    sin_lat = np.sin(lat)
+    n = WGS84_A / np.sqrt(1.0 - WGS84_E2 * sin_lat ** 2)
+    # this form of the altitude is stable at every latitude, including the poles where cos(lat) -> 0
+    alt = p * np.cos(lat) + z * sin_lat - WGS84_A ** 2 / n
+
+    return np.degrees(lat), np.degrees(lon), alt
+
+
+def _enu_basis(lat0, lon0):
+    lat0 = np.radians(lat0)
+    lon0 = np.radians(lon0)
+    sin_lat, cos_lat = np.sin(lat0), np.cos(lat0)
+    sin_lon, cos_lon = np.sin(lon0), np.cos(lon0)
+    # rows are the east, north and up unit vectors expressed in ECEF
+    return np.array([
+        [-sin_lon, cos_lon, 0.0],
+        [-sin_lat * cos_lon, -sin_lat * sin_lon, cos_lat],
+        [cos_lat * cos_lon, cos_lat * sin_lon, sin_lat],
+    ])
+
+
+def ecef_to_enu(x, y, z, lat0, lon0, alt0):
+    """
+    east, north, up in metres relative to the origin (lat0, lon0, alt0)
+    """
+    x0, y0, z0 = geodetic_to_ecef(lat0, lon0, alt0)
+    d = np.stack([np.asarray(x) - x0, np.asarray(y) - y0, np.asarray(z) - z0])
+    e, n, u = np.tensordot(_enu_basis(lat0, lon0), d, axes=1)
+    return e, n, u
+
+
+def enu_to_ecef(e, n, u, lat0, lon0, alt0):
+    x0, y0, z0 = geodetic_to_ecef(lat0, lon0, alt0)
+    d = np.stack([np.asarray(e, dtype=float), np.asarray(n, dtype=float), np.asarray(u, dtype=float)])
+    x, y, z = np.tensordot(_enu_basis(lat0, lon0).T, d, axes=1)
+    return x + x0, y + y0, z + z0
+
+
+def geodetic_to_enu(lat, lon, alt, lat0=None, lon0=None, alt0=None):
+    """
+    local tangent plane coordinates. the origin defaults to the first point
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    alt = np.asarray(alt, dtype=float)
+    if lat0 is None:
+        lat0, lon0, alt0 = lat.flat[0], lon.flat[0], alt.flat[0]
+    return ecef_to_enu(*geodetic_to_ecef(lat, lon, alt), lat0, lon0, alt0)
+
+
+def enu_to_geodetic(e, n, u, lat0, lon0, alt0):
+    return ecef_to_geodetic(*enu_to_ecef(e, n, u, lat0, lon0, alt0))
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    great circle distance in metres on the mean earth sphere. broadcasts like any other numpy ufunc
+    """
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    dlat = lat2 - lat1
+    dlon = np.radians(np.asarray(lon2) - np.asarray(lon1))
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def interp_geodetic(x, xp, lat, lon, alt):
+    """
+    same argument conventions as np.interp(), but interpolates positions along straight lines in ECEF
+    instead of treating latitude, longitude and altitude as independent
+    """
+    ecef = geodetic_to_ecef(lat, lon, alt)
+    return ecef_to_geodetic(*[np.interp(x, xp, c) for c in ecef])
+
+
+def slerp_quaternions(x, xp, q):
+    """
+    batched spherical linear interpolation. q is an (n, 4) array of (qw, qx, qy, qz) sampled at xp (increasing).
+    like np.interp(), values of x outside of xp are clamped to the first or last quaternion.
+
+    the results are unit quaternions, and q and -q being the same rotation, each one is on the side of the sample
+    before it: they are the raw samples only up to the norm and the sign. in particular at the last sample, reached
+    from the one before, the result is -q[-1] when the two are more than 180 degrees apart as 4-vectors
+    """
+    q = np.asarray(q, dtype=float).reshape(-1, 4)
+    xp = np.asarray(xp, dtype=float)
+    x = np.asarray(x, dtype=float)
+    if len(q) == 1:
+        return np.repeat(q, len(x), axis=0)
+
+    q = q / np.linalg.norm(q, axis=1, keepdims=True)
+
+    i0 = np.clip(np.searchsorted(xp, x, side='right') - 1, 0, len(xp) - 2)
+    i1 = i0 + 1
+    span = xp[i1] - xp[i0]
+    t = np.clip(np.divide(x - xp[i0], span, out=np.zeros_like(x), where=span != 0), 0.0, 1.0)
+
+    q0 = q[i0]
+    q1 = q[i1]
+    dot = np.sum(q0 * q1, axis=1)
+    # q and -q are the same rotation: take the short way around
+    q1 = np.where(dot[:, None] < 0, -q1, q1)
+    dot = np.abs(dot)
+
+    omega = np.arccos(np.clip(dot, -1.0, 1.0))
+    sin_omega = np.sin(omega)
+    close = sin_omega < 1e-6
+    safe_sin = np.where(close, 1.0, sin_omega)
+    w0 = np.where(close, 1.0 - t, np.sin((1.0 - t) * omega) / safe_sin)
+    w1 = np.where(close, t, np.sin(t * omega) / safe_sin)
+
+    out = w0[:, None] * q0 + w1[:, None] * q1
+    return out / np.linalg.norm(out, axis=1, keepdims=True)
+
+
+def resample_track(times, lat, lon, alt, rate_hz=None, new_times=None, **columns):
+    """
+    resample a track given as arrays, either onto a fixed rate (e.g. 1, 10 or 30 Hz) starting at the first sample,
+    or onto arbitrary new_times (datetime64, e.g. the presentation times of video frames).
+    any extra keyword arrays (speed, ...) are linearly interpolated as well.
+    returns a dict with 'gps_time', 'latitude', 'longitude', 'elevation' and the extra columns.
+    the samples are sorted by time first, keeping the first one of every time (GPS time can repeat or step back, and
+    np.interp() needs increasing sample times)
+    """
+    times = np.asarray(times, dtype='datetime64[us]')
+    times, first = np.unique(times, return_index=True)
+    if len(first) < len(lat) or np.any(np.diff(first) < 0):
+        lat, lon, alt = [np.asarray(c, dtype=float)[first] for c in (lat, lon, alt)]
+        columns = {k: np.asarray(v, dtype=float)[first] for k, v in columns.items()}
+    if new_times is None:
+        if rate_hz is None:
+            raise ValueError("either rate_hz or new_times is required")
+        if rate_hz <= 0:
+            raise ValueError(f"rate_hz must be positive, not {rate_hz}")
+        step = np.timedelta64(int(round(1e6 / rate_hz)), 'us')
+        new_times = np.arange(times[0], times[-1] + np.timedelta64(1, 'us'), step)
+    new_times = np.asarray(new_times, dtype='datetime64[us]')
+
+    epoch = times[0]
+    xp = (times - epoch).astype(float)
+    x = (new_times - epoch).astype(float)
+
+    r_lat, r_lon, r_alt = interp_geodetic(x, xp, lat, lon, alt)
+    out = {
+        'gps_time': interp_time_array(x, xp, times),
+        'latitude': r_lat,
+        'longitude': r_lon,
+        'elevation': r_alt,
+    }
+    for k, v in columns.items():
+        out[k] = np.interp(x, xp, np.asarray(v, dtype=float))
+    return out
+
+
+def resample_points(points, rate_hz):
+    """
+    resample a list of gpshelper.GPSPoint to a fixed rate, e.g. before writing a 1 Hz GPX
+    """
+    if len(points) < 2:
+        return list(points)
+
+    t0 = min(p.time for p in points)
+    times = np.array([np.datetime64(p.time) for p in points], dtype='datetime64[us]')
+    track = resample_track(times,
+                           [p.latitude for p in points],
+                           [p.longitude for p in points],
+                           [p.elevation for p in points],
+                           rate_hz=rate_hz,
+                           speed=[p.speed for p in points])
+
+    offsets = (track['gps_time'] - np.datetime64(t0, 'us')).astype('timedelta64[us]').astype(np.int64)
+    return [gpshelper.GPSPoint(float(lat), float(lon), float(alt), t0 + timedelta(microseconds=int(dt)), float(speed))
+            for lat, lon, alt, dt, speed in
+            zip(track['latitude'], track['longitude'], track['elevation'], offsets, track['speed'])]
+
+
+class GeodesyTest(unittest.TestCase):
+    SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+
+    def test_ecef_round_trip(self):
+        rng = np.random.default_rng(0)
+        lat = np.concatenate([rng.uniform(-90, 90, 1000), [90.0, -90.0, 0.0, 89.9999]])
+        lon = np.concatenate([rng.uniform(-180, 180, 1000), [0.0, 45.0, 180.0, -179.9999]])
+        alt = np.concatenate([rng.uniform(-500, 9000, 1000), [0.0, 100.0, -10.0, 3000.0]])
+
+        r_lat, r_lon, r_alt = ecef_to_geodetic(*geodetic_to_ecef(lat, lon, alt))
+        np.testing.assert_allclose(r_lat, lat, atol=1e-9)
+        # the longitude is undefined at the poles, and +-180 are the same
+        not_pole = np.abs(lat) < 90
+        np.testing.assert_allclose(np.cos(np.radians(r_lon - lon))[not_pole], 1.0, atol=1e-12)
+        np.testing.assert_allclose(r_alt, alt, atol=1e-3)
+
+        x, y, z = geodetic_to_ecef(0.0, 0.0, 0.0)
+        self.assertEqual((float(x), float(y), float(z)), (WGS84_A, 0.0, 0.0))
+        r_lat, r_lon, r_alt = enu_to_geodetic(*geodetic_to_enu(lat[:10], lon[:10], alt[:10], 40.0, -3.0, 600.0),
+                                              40.0, -3.0, 600.0)
+        np.testing.assert_allclose(r_alt, alt[:10], atol=1e-3)
+
+    def test_slerp(self):
+        half = np.sqrt(0.5)
+        # identity, then 90 degrees about z, given unnormalized
+        q = np.array([[2.0, 0.0, 0.0, 0.0], [half, 0.0, 0.0, half]])
+        out = slerp_quaternions([-1.0, 0.0, 0.5, 1.0, 2.0], [0.0, 1.0], q)
+        np.testing.assert_allclose(out[[0, 1]], [[1, 0, 0, 0]] * 2)
+        np.testing.assert_allclose(out[[3, 4]], [q[1]] * 2)
+        # half way is 45 degrees about z
+        np.testing.assert_allclose(out[2], [np.cos(np.pi / 8), 0, 0, np.sin(np.pi / 8)])
+        np.testing.assert_allclose(np.linalg.norm(out, axis=1), 1.0)
+
+        # the same rotation as -q: interpolated the short way, and the last sample comes out with its sign flipped
+        out = slerp_quaternions([0.0, 0.5, 1.0], [0.0, 1.0], [[1.0, 0, 0, 0], [-half, 0, 0, -half]])
+        np.testing.assert_allclose(out[1], [np.cos(np.pi / 8), 0, 0, np.sin(np.pi / 8)])
+        np.testing.assert_allclose(out[2], [half, 0, 0, half])
+
+    def test_resample(self):
+        from .gopro2gpx import BuildGPSPoints
+        from .klv_extraction import parseStream
+
+        points = BuildGPSPoints(parseStream((self.SAMPLES / 'gopro7.bin').read_bytes())[0])
+        resampled = resample_points(points, 1.0)
+        steps = [(b.time - a.time).total_seconds() for a, b in zip(resampled, resampled[1:])]
+        self.assertEqual(set(steps), {1.0})
+        self.assertEqual(resampled[0].time, points[0].time)
+        self.assertEqual(len(resampled), int((points[-1].time - points[0].time).total_seconds()) + 1)
+        self.assertAlmostEqual(resampled[0].latitude, points[0].latitude, places=9)
+        self.assertAlmostEqual(resampled[0].longitude, points[0].longitude, places=9)
+        # between the samples, along the track
+        self.assertLessEqual(max(p.latitude for p in resampled), max(p.latitude for p in points))
+        self.assertGreaterEqual(min(p.longitude for p in resampled), min(p.longitude for p in points))
+
+        # the same with the samples shuffled and repeated
+        times = np.array([np.datetime64(p.time) for p in points], dtype='datetime64[us]')
+        lat = np.array([p.latitude for p in points])
+        order = np.random.default_rng(0).permutation(np.concatenate([np.arange(len(points))] * 2))
+        expected = resample_track(times, lat, lat, lat, rate_hz=10.0)
+        shuffled = resample_track(times[order], lat[order], lat[order], lat[order], rate_hz=10.0)
+        np.testing.assert_array_equal(shuffled['gps_time'], expected['gps_time'])
+        np.testing.assert_array_equal(shuffled['latitude'], expected['latitude'])
+        self.assertRaises(ValueError, resample_track, times, lat, lat, lat, rate_hz=0)
@@ -10,127 +10,156 @@
 
 import argparse
 import array
-import os
 import platform
 import re
 import struct
 import subprocess
-import sys
 import time
+import unittest
 from collections import namedtuple
 from datetime import datetime, timedelta
 import logging
 
-SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-sys.path.append(os.path.dirname(SCRIPT_DIR))
-
-from .config import setup_environment
 from . import fourCC
-from . import gpmf
 from . import gpshelper
 
 
-def BuildGPSPoints(data, skip=False):
+class GPSPointBuilder:
     """
     Data comes UNSCALED so we have to do: Data / Scale.
     Do a finite state machine to process the labels.
     GET
      - SCAL     Scale value
      - GPSF     GPS Fix
+     - GPSP     GPS Precision (DOP x100)
      - GPSU     GPS Time
      - GPS5     GPS Data
+
+    The state (scale, fix, time) is kept between calls to add(), so the labels can be fed
+    in as many pieces as they arrive.
     """
-    logger = logging.getLogger(__name__)
 
-    points = []
-    SCAL = fourCC.XYZData(1.0, 1.0, 1.0)
-    GPSU = None
-    SYST = fourCC.SYSTData(0, 0)
+    def __init__(self, skip=False):
+        self.skip = skip
+        self.SCAL = fourCC.XYZData(1.0, 1.0, 1.0)
+        self.GPSU = None
+        self.SYST = fourCC.SYSTData(0, 0)
+        self.GPSFIX = 0  # no lock.
+        self.GPSP = None
+        self.time_offset = timedelta(milliseconds=0)
+
+        self.stats = {
+            'ok': 0,
+            'badfix': 0,
+            'badfixskip': 0,
+            'empty': 0
+        }
+
+    def add(self, data):
+        """
+        process some more labels, returns the new points
+        """
+        logger = logging.getLogger(__name__)
+        stats = self.stats
+        skip = self.skip
+        points = []
+
+        for d in data:
+
+            if d.fourCC == 'SCAL':
+                self.SCAL = d.data
+            elif d.fourCC == 'GPSU':
+                self.GPSU = d.data
+                self.time_offset = timedelta(milliseconds=0)
+            elif d.fourCC == 'GPSF':
+                # an empty GPSF (or GPSP) keeps the last value
+                if d.data is not None:
+                    if d.data != self.GPSFIX:
+                        logger.debug("GPSFIX change to %s [%s]" % (d.data, fourCC.LabelGPSF.xlate.get(d.data, '?')))
+                    self.GPSFIX = d.data
+            elif d.fourCC == 'GPSP':
+                if d.data is not None:
+                    self.GPSP = d.data / 100.0
+            elif d.fourCC == 'GPS5':
+                # we have to use the REPEAT value.
+
+                for item in d.data:
+
+                    if item.lon == item.lat == item.alt == 0:
+                        logger.warning("Warning: Skipping empty point")
+                        stats['empty'] += 1
+                        continue
 
-    stats = {
-        'ok': 0,
-        'badfix': 0,
-        'badfixskip': 0,
-        'empty': 0
-    }
+                    if self.GPSFIX == 0:
+                        stats['badfix'] += 1
+                        if skip:
+                            logger.warning("Warning: Skipping point due GPSFIX==0")
+                            stats['badfixskip'] += 1
+                            continue
 
-    GPSFIX = 0  # no lock.
-    for d in data:
+                    retdata = [float(x) / float(y) for x, y in zip(item._asdict().values(), list(self.SCAL))]
 
-        if d.fourCC == 'SCAL':
-            SCAL = d.data
-        elif d.fourCC == 'GPSU':
-            GPSU = d.data
-            time_offset = timedelta(milliseconds=0)
-        elif d.fourCC == 'GPSF':
-            if d.data != GPSFIX:
-                logger.debug("GPSFIX change to %s [%s]" % (d.data, fourCC.LabelGPSF.xlate[d.data]))
-            GPSFIX = d.data
-        elif d.fourCC == 'GPS5':
-            # we have to use the REPEAT value.
+                    self.time_offset = self.time_offset + timedelta(milliseconds=1000.0 / 18)
 
-            for item in d.data:
+                    gpsdata = fourCC.GPSData._make(retdata)
+                    p = gpshelper.GPSPoint(gpsdata.lat, gpsdata.lon, gpsdata.alt, self.GPSU + self.time_offset,
+                                           gpsdata.speed)
+                    p.dop = self.GPSP
+                    p.fix = self.GPSFIX
+                    points.append(p)
+                    stats['ok'] += 1
 
-                if item.lon == item.lat == item.alt == 0:
+            elif d.fourCC == 'SYST':
+                values = [float(x) / float(y) for x, y in zip(d.data._asdict().values(), list(self.SCAL))]
+                if values[0] != 0 and values[1] != 0:
+                    self.SYST = fourCC.SYSTData._make(values)
+
+
+            elif d.fourCC == 'GPRI':
+                # KARMA GPRI info
+
+                if d.data.lon == d.data.lat == d.data.alt == 0:
                     logger.warning("Warning: Skipping empty point")
                     stats['empty'] += 1
                     continue
 
-                if GPSFIX == 0:
+                if self.GPSFIX == 0:
                     stats['badfix'] += 1
                     if skip:
                         logger.warning("Warning: Skipping point due GPSFIX==0")
                         stats['badfixskip'] += 1
                         continue
 
-                retdata = [float(x) / float(y) for x, y in zip(item._asdict().values(), list(SCAL))]
-
-                time_offset = time_offset + timedelta(milliseconds=1000.0 / 18)
+                values = [float(x) / float(y) for x, y in zip(d.data._asdict().values(), list(self.SCAL))]
+                gpsdata = fourCC.KARMAGPSData._make(values)
 
-                gpsdata = fourCC.GPSData._make(retdata)
-                p = gpshelper.GPSPoint(gpsdata.lat, gpsdata.lon, gpsdata.alt, GPSU + time_offset, gpsdata.speed)
-                points.append(p)
-                stats['ok'] += 1
+                if self.SYST.seconds != 0 and self.SYST.miliseconds != 0:
+                    p = gpshelper.GPSPoint(gpsdata.lat, gpsdata.lon, gpsdata.alt,
+                                           datetime.fromtimestamp(self.SYST.miliseconds), gpsdata.speed)
+                    p.fix = self.GPSFIX
+                    points.append(p)
+                    stats['ok'] += 1
 
-        elif d.fourCC == 'SYST':
-            data = [float(x) / float(y) for x, y in zip(d.data._asdict().values(), list(SCAL))]
-            if data[0] != 0 and data[1] != 0:
-                SYST = fourCC.SYSTData._make(data)
+        return points
 
+    def log_stats(self):
+        logger = logging.getLogger(__name__)
+        stats = self.stats
+        logger.info("-- stats -----------------")
+        total_points = 0
+        for i in stats.keys():
+            total_points += stats[i]
+        logger.info("- Ok:              %5d" % stats['ok'])
+        logger.info("- GPSFIX=0 (bad):  %5d (skipped: %d)" % (stats['badfix'], stats['badfixskip']))
+        logger.info("- Empty (No data): %5d" % stats['empty'])
+        logger.info("Total points:      %5d" % total_points)
+        logger.info("--------------------------")
 
-        elif d.fourCC == 'GPRI':
-            # KARMA GPRI info
-
-            if d.data.lon == d.data.lat == d.data.alt == 0:
-                logger.warning("Warning: Skipping empty point")
-                stats['empty'] += 1
-                continue
-
-            if GPSFIX == 0:
-                stats['badfix'] += 1
-                if skip:
-                    logger.warning("Warning: Skipping point due GPSFIX==0")
-                    stats['badfixskip'] += 1
-                    continue
 
-            data = [float(x) / float(y) for x, y in zip(d.data._asdict().values(), list(SCAL))]
-            gpsdata = fourCC.KARMAGPSData._make(data)
-
-            if SYST.seconds != 0 and SYST.miliseconds != 0:
-                p = gpshelper.GPSPoint(gpsdata.lat, gpsdata.lon, gpsdata.alt, datetime.fromtimestamp(SYST.miliseconds),
-                                       gpsdata.speed)
-                points.append(p)
-                stats['ok'] += 1
-
-    logger.info("-- stats -----------------")
-    total_points = 0
-    for i in stats.keys():
-        total_points += stats[i]
-    logger.info("- Ok:              %5d" % stats['ok'])
-    logger.info("- GPSFIX=0 (bad):  %5d (skipped: %d)" % (stats['badfix'], stats['badfixskip']))
-    logger.info("- Empty (No data): %5d" % stats['empty'])
-    logger.info("Total points:      %5d" % total_points)
-    logger.info("--------------------------")
+def BuildGPSPoints(data, skip=False):
+    builder = GPSPointBuilder(skip=skip)
+    points = builder.add(data)
+    builder.log_stats()
     return (points)
 
 
@@ -165,11 +194,44 @@ def BuildOrientations(data):
 
     return points_CORI, points_IORI
 
+class GPSPointBuilderTest(unittest.TestCase):
+    def _klv(self, label, ktype, size, repeat, payload=b''):
+        from .klvdata import KLVData
+
+        data = struct.pack('>4sBBH', label, ord(ktype), size, repeat) + payload + b'\0' * (-len(payload) % 4)
+        return KLVData(data, 0)
+
+    def _gps5(self, lat):
+        return self._klv(b'GPS5', 'l', 20, 1, struct.pack('>5l', lat, -37000000, 600000, 5000, 5000))
+
+    def test_empty_precision(self):
+        scal = self._klv(b'SCAL', 'l', 4, 5, struct.pack('>5l', 10000000, 10000000, 1000, 1000, 100))
+        gpsu = self._klv(b'GPSU', 'U', 16, 1, b'190224112030.000')
+        klvs = [scal, gpsu, self._klv(b'GPSF', 'L', 4, 1, struct.pack('>L', 3)),
+                self._klv(b'GPSP', 'S', 2, 1, struct.pack('>H', 154)), self._gps5(404000000),
+                # the next DEVC has empty GPSF and GPSP: the last values are kept
+                gpsu, self._klv(b'GPSF', 'L', 4, 0), self._klv(b'GPSP', 'S', 2, 0), self._gps5(404000100)]
+        self.assertIsNone(klvs[-2].data)
+
+        points = BuildGPSPoints(klvs)
+        self.assertEqual([(p.latitude, p.fix, p.dop) for p in points], [(40.4, 3, 1.54), (40.40001, 3, 1.54)])
+
+
 def parseArgs():
     parser = argparse.ArgumentParser()
     parser.add_argument("-v", "--verbose", help="increase output verbosity", action="count")
     parser.add_argument("-b", "--binary", help="read data from bin file", action="store_true")
     parser.add_argument("-s", "--skip", help="Skip bad points (GPSFIX=0)", action="store_true", default=False)
+    parser.add_argument("-r", "--rate", help="resample the track to a fixed rate in Hz (e.g. 1, 10, 30)", type=float)
+    parser.add_argument("--simplify", help="simplify the track to this tolerance in metres", type=float, metavar="METRES")
+    parser.add_argument("--max_points", help="limit the track to N points", type=int)
+    parser.add_argument("--smooth", help="reject GPS outliers and smooth the track (Kalman filter, using the DOP)", action="store_true")
+    parser.add_argument("-m", "--metrics", help="add distance, grade, vertical speed, heading and acceleration to the GPX and CSV", action="store_true")
+    parser.add_argument("-a", "--all_streams", help="also write every GPMF stream to outputfile.streams.npz", action="store_true")
+    parser.add_argument("--sidecar", help="also write every GPMF stream to the sidecar outputfile.telemetry", action="store_true")
+    parser.add_argument("--recover", help="skip damaged GPMF blocks (bad sectors, truncated files) instead of failing", action="store_true")
+    parser.add_argument("--backend", help="how to read the GPMF track of a video (default: the first installed of native, pyav, ffmpeg)", choices=("auto", "native", "pyav", "ffmpeg"), default="auto")
+    parser.add_argument("-j", "--jobs", help="parse the GPMF track with N processes (long clips)", type=int, default=1)
     parser.add_argument("file", help="Video file or binary metadata dump")
     parser.add_argument("outputfile", help="output file. builds KML and GPX")
     args = parser.parse_args()
@@ -178,35 +240,13 @@ def parseArgs():
 
 def main():
     args = parseArgs()
-    config = setup_environment(args)
-    parser = gpmf.Parser(config)
-
-    if not args.binary:
-        data = parser.readFromMP4()
-    else:
-        data = parser.readFromBinary()
-
-    # build some funky tracks from camera GPS
-
-    points = BuildGPSPoints(data, skip=args.skip)
-
-    if len(points) == 0:
-        print("Can't create file. No GPS info in %s. Exitting" % args.file)
-        sys.exit(0)
-
-    my_csv = gpshelper.generate_CSV(points)
-    with open("%s.csv" % args.outputfile , "w+") as fd:
-        fd.write(my_csv)
-
-    return
-
-    kml = gpshelper.generate_KML(points)
-    with open("%s.kml" % args.outputfile , "w+") as fd:
-        fd.write(kml)
-
-    gpx = gpshelper.generate_GPX(points, trk_name="gopro7-track")
-    with open("%s.gpx" % args.outputfile , "w+") as fd:
-        fd.write(gpx)
+    # the engine of the gopro2gpx command (cli.py), with the outputs this script always wrote
+    from .cli import options, run
+    formats = ['csv', 'kml', 'gpx'] + ['npz'] * args.all_streams + ['telemetry'] * args.sidecar
+    run(options(file=args.file, output=args.outputfile, formats=formats, verbose=args.verbose, binary=args.binary,
+                skip=args.skip, rate=args.rate, simplify=args.simplify, max_points=args.max_points,
+                smooth=args.smooth, metrics=args.metrics, recover=args.recover, backend=args.backend,
+                jobs=args.jobs))
 
 if __name__ == "__main__":
     main()
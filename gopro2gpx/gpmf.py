@@ -12,41 +12,43 @@
 #   https://github.com/stilldavid/gopro-utils/blob/master/telemetry/reader.go
 
 
-import array
 import os
-import struct
-import sys
 
-from .ffmpegtools import FFMpegTools
-from .klvdata import KLVData
+from .backends import open_packets
+from .recovery import DamageReport, parse_recovering
 
 
 class Parser:
     def __init__(self, config):
         self.config = config
-        self.ffmtools = FFMpegTools(self.config)
+        self.backend = getattr(config, 'backend', 'auto')
 
         # map some handy shortcuts
         self.verbose = config.verbose
         self.file = config.file
         self.outputfile = config.outputfile
+        self.recover = config.recover
+        self.report = None
 
 
     def readFromMP4(self):
-        """read data the metadata track from video. Requires FFMPEG wrapper.
+        """read data the metadata track from video, with the container backend of the config (see backends.py).
            -vv creates a dump file with the  binary data called dump_track.bin
         """
+        return self.parseStream(self.readRawFromMP4())
+
+    def readRawFromMP4(self):
+        """the unparsed metadata track of the video"""
 
         if not os.path.exists(self.file):
             raise FileNotFoundError("Can't open %s" % self.file)
 
-        track_number, lineinfo = self.ffmtools.getMetadataTrack(self.file)
-        if not track_number:
-            raise Exception("File %s doesn't have any metadata" % self.file)
-
+        backend, packets = open_packets(self.file, self.backend, self.config)
         if self.verbose:
-            print("Working on file %s track %s (%s)" % (self.file, track_number, lineinfo))
-        metadata_raw = self.ffmtools.getMetadata(track_number, self.file)
+            print("Working on file %s (%s backend)" % (self.file, backend.name))
+        metadata_raw = b''.join(packet for packet, _, _ in packets)
+        if not metadata_raw:
+            raise Exception("File %s doesn't have any metadata" % self.file)
 
         if self.verbose == 2:
             print("Creating output file for binary data (fromMP4): %s" % self.outputfile)
@@ -54,14 +56,16 @@ class Parser:
             f.write(metadata_raw)
             f.close()
 
-        # process the data here
-        metadata = self.parseStream(metadata_raw)
-        return(metadata)
+        return metadata_raw
 
     def readFromBinary(self):
         """read data from binary file, instead extract the metadata track from video. Useful for quick development
            -vv creates a dump file with the  binary data called dump_binary.raw
         """
+        return self.parseStream(self.readRawFromBinary())
+
+    def readRawFromBinary(self):
+        """the content of the binary file"""
         if not os.path.exists(self.file):
             raise FileNotFoundError("Can't open %s" % self.file)
 
@@ -78,37 +82,25 @@ class Parser:
             f.write(data)
             f.close()
 
-        # process the data here
-        metadata = self.parseStream(data)
-        return metadata
+        return data
 
     def parseStream(self, data_raw):
         """
-        main code that reads the points
+        main code that reads the points: klv_extraction.parseStream() over the whole track
         """
-        data = array.array('b')
-        data.frombytes(data_raw)
-
-        offset = 0
-        klvlist = []
-
-        while offset < len(data):
-
-            klv = KLVData(data,offset)
-            if not klv.skip():
-                klvlist.append(klv)
-                if self.verbose == 3:
-                    print(klv)
-            else:
-                if klv: 
-                    print("Warning, skipping klv", klv)
-                else:
-                    # unknown label
-                    pass
-                    
-            offset += 8
-            if klv.type != 0:
-                offset += klv.padded_length
-                #print(">offset:%d length:%d padded:%d" % (offset, length, padded_length))
-
-        return(klvlist)
+        from .klv_extraction import parseStream
+
+        if self.recover:
+            # validate every header and skip the damaged blocks, see recovery.py
+            self.report = DamageReport()
+            klvlist, _ = parse_recovering(data_raw, self.report, final=True)
+            self.report.log()
+            return klvlist
+
+        klvlist, unread = parseStream(data_raw)
+        if unread:
+            print("Warning, the metadata ends with a truncated KLV (%d bytes ignored)" % len(unread))
+        if self.verbose == 3:
+            for klv in klvlist:
+                print(klv)
+        return klvlist
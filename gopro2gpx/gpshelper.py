@@ -8,6 +8,7 @@
 
 
 from datetime import datetime, timedelta
+import json
 import time
 import os
 
@@ -29,6 +30,15 @@ class GPSPoint:
         self.distance = 0
         self.left_pedal_smoothness = 0
         self.left_torque_effectiveness = 0
+        # precision: GPSP / 100 and GPSF of the DEVC the point comes from (None: unknown)
+        self.dop = None
+        self.fix = None
+        # derived metrics, filled by metrics.apply_metrics()
+        self.smoothed_speed = None
+        self.vertical_speed = None
+        self.grade = None
+        self.heading = None
+        self.acceleration = None
 
 
 def UTCTime(timedata):
@@ -107,6 +117,8 @@ def generate_GPX(points, trk_name="exercise"):
         pts += '		    <gpxtpx:hr>%s</gpxtpx:hr>\r\n' % hr
         pts += '		    <gpxtpx:cad>%s</gpxtpx:cad>\r\n' % cadence
         pts += '		    <gpxtpx:speed>%s</gpxtpx:speed>\r\n' % speed
+        if p.heading is not None:
+            pts += '		    <gpxtpx:course>%.1f</gpxtpx:course>\r\n' % p.heading
         pts += '		    <gpxtpx:distance>%s</gpxtpx:distance>\r\n' % distance
         pts += '		   </gpxtpx:TrackPointExtension>\r\n'
         pts += '		<gpxx:TrackPointExtension/>\r\n' ## new
@@ -179,11 +191,58 @@ def generate_CSV(gps_points):
     simple CSV output
     """
 
-    lines = ["Time,elapsed,longitude,latitude,elevation,speed"]
+    # the metrics.apply_metrics() columns, when they were computed
+    metrics = gps_points[0].heading is not None
+
+    header = "Time,elapsed,longitude,latitude,elevation,speed"
+    if metrics:
+        header += ",distance,smoothed_speed,vertical_speed,grade,heading,acceleration"
+    lines = [header]
     t0 = gps_points[0].time
     for p in gps_points:
         dt = p.time - t0
         s = "%s,%.3f,%s,%s,%s,%s" % (UTCTime(p.time), dt / timedelta(milliseconds=1) / 1000.0 , p.longitude, p.latitude, p.elevation, p.speed)
+        if metrics:
+            s += ",%.3f,%.3f,%.3f,%.2f,%.1f,%.3f" % (p.distance, p.smoothed_speed, p.vertical_speed, p.grade, p.heading, p.acceleration)
         lines.append(s)
 
     return "\n".join(lines)
+
+
+def iter_GeoJSONSeq(gps_points, name="exercise", geometry="line"):
+    """
+    newline-delimited GeoJSON (one Feature per line), yielded line by line.
+    geometry="line": one LineString for the track, with its name and time range.
+    geometry="points": one Point per GPS point, with its time, speed and the metrics when they were computed
+    """
+    if geometry == "line":
+        if not gps_points:
+            return
+        feature = {
+            "type": "Feature",
+            "geometry": {"type": "LineString",
+                         "coordinates": [[p.longitude, p.latitude, p.elevation] for p in gps_points]},
+            "properties": {"name": name, "start": UTCTime(gps_points[0].time), "end": UTCTime(gps_points[-1].time),
+                           "points": len(gps_points)},
+        }
+        yield json.dumps(feature, separators=(',', ':')) + "\n"
+        return
+
+    if geometry != "points":
+        raise ValueError("unknown GeoJSON geometry %r, use line or points" % geometry)
+    for p in gps_points:
+        properties = {"name": name, "time": UTCTime(p.time), "speed": p.speed}
+        if p.heading is not None:
+            properties.update(distance=p.distance, heading=p.heading, grade=p.grade,
+                              vertical_speed=p.vertical_speed)
+        feature = {"type": "Feature",
+                   "geometry": {"type": "Point", "coordinates": [p.longitude, p.latitude, p.elevation]},
+                   "properties": properties}
+        yield json.dumps(feature, separators=(',', ':')) + "\n"
+
+
+def generate_GeoJSONSeq(gps_points, name="exercise", geometry="line"):
+    """
+    the whole iter_GeoJSONSeq() output as a string
+    """
+    return "".join(iter_GeoJSONSeq(gps_points, name, geometry))
@@ -0,0 +1,404 @@
+"""
+batch extraction over several machines, through a shared job queue.
+
+the queue is a SQLite database that every worker opens (on a shared filesystem with working locks, or a local disk
+when all the workers run on one machine). each job is a clip and the outputs to write for it. a worker claims the
+oldest pending job with a lease, renews the lease while it runs gopro2gpx on the clip (cli.run: the GPMF track only,
+or a read of the video frames for the per-frame outputs), moves the outputs into place and marks the job done.
+
+  * a worker that dies loses its lease: once it expires the job is claimed again by another worker
+  * a job that fails goes back to the queue, up to max_attempts times, then stays failed with its error
+  * the outputs of a job are written to a temporary directory next to their destination and moved with os.replace(),
+    so a job that runs twice (a lease that expired under a slow worker) writes the same complete files, never half
+    of them
+  * every job records its worker, times and input size, so status() gives the throughput of the whole batch and of
+    each worker
+
+the lease times are wall clock times of the workers, so the machines need roughly synchronised clocks (NTP).
+
+usage:
+    python -m gopro2gpx.jobqueue queue.db add -o out/ -f gpx -f pix4d /archive/2020/*.MP4
+    python -m gopro2gpx.jobqueue queue.db work --exit_when_empty     # on every machine
+    python -m gopro2gpx.jobqueue queue.db status
+    python -m gopro2gpx.jobqueue queue.db retry                      # requeue the failed jobs
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import traceback
+import unittest
+import uuid
+from pathlib import Path
+
+# seconds. the lease is renewed every third of it while a job runs
+DEFAULT_LEASE = 300.0
+DEFAULT_MAX_ATTEMPTS = 3
+# seconds before a failed job can be claimed again, doubled on every attempt
+RETRY_DELAY = 10.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    output TEXT UNIQUE NOT NULL,
+    options TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease TEXT,
+    lease_until REAL,
+    error TEXT,
+    size INTEGER,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, not_before);
+"""
+
+Job = collections.namedtuple("Job", "id path output options attempts lease")
+WorkerStats = collections.namedtuple("WorkerStats", "worker jobs bytes busy")
+QueueStats = collections.namedtuple("QueueStats", "pending running done failed bytes busy wall workers")
+
+
+def default_worker_name():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class JobQueue:
+    def __init__(self, db_path, lease=DEFAULT_LEASE, max_attempts=DEFAULT_MAX_ATTEMPTS, retry_delay=RETRY_DELAY):
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        # autocommit, the transactions that need it are opened explicitly (BEGIN IMMEDIATE takes the write lock
+        # before reading, so two workers can't claim the same job)
+        self.db = sqlite3.connect(str(db_path), timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self.db.execute(sql, params)
+
+    def _transaction(self, statements):
+        # statements(db) runs inside one write transaction, its result is returned
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(self.db)
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            return result
+
+    def add(self, path, output=None, **options):
+        """
+        queue a clip. output is the output base (default: the clip without its extension), options are the ones of
+        cli.options(). a clip already queued for the same output is left as it is. returns True if it was added
+        """
+        path = Path(path).resolve()
+        output = Path(output).resolve() if output else path.with_suffix('')
+        cursor = self._execute("INSERT OR IGNORE INTO jobs (path, output, options) VALUES (?, ?, ?)",
+                               (str(path), str(output), json.dumps(options, sort_keys=True)))
+        if cursor.rowcount == 1:
+            return True
+        queued = self._execute("SELECT path FROM jobs WHERE output = ?", (str(output),)).fetchone()[0]
+        if queued != str(path):
+            logging.getLogger(__name__).warning(f'Not queueing {path}: {queued} already writes to {output}')
+        return False
+
+    def claim(self, worker):
+        """
+        lease the next job that is pending, or running with an expired lease. None if there is nothing to do
+        """
+        def claim_next(db):
+            now = time.time()
+            row = db.execute(
+                "SELECT id, path, output, options, attempts FROM jobs "
+                "WHERE (state = 'pending' AND not_before <= ?) OR (state = 'running' AND lease_until < ?) "
+                "ORDER BY id LIMIT 1", (now, now)).fetchone()
+            if row is None:
+                return None
+            job_id, path, output, options, attempts = row
+            lease = uuid.uuid4().hex
+            db.execute("UPDATE jobs SET state = 'running', attempts = ?, worker = ?, lease = ?, lease_until = ?, "
+                       "started = ?, finished = NULL WHERE id = ?",
+                       (attempts + 1, worker, lease, now + self.lease, now, job_id))
+            return Job(job_id, path, output, json.loads(options), attempts + 1, lease)
+
+        return self._transaction(claim_next)
+
+    def renew(self, job):
+        """
+        extend the lease of a running job. False if the job isn't ours anymore (the lease expired and another worker
+        claimed it)
+        """
+        cursor = self._execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND lease = ? AND state = 'running'",
+                               (time.time() + self.lease, job.id, job.lease))
+        return cursor.rowcount == 1
+
+    def complete(self, job, size=None):
+        """
+        acknowledge a job. False if the lease was lost in the meantime, and the job belongs to another worker
+        """
+        cursor = self._execute("UPDATE jobs SET state = 'done', error = NULL, size = ?, finished = ?, "
+                               "lease_until = NULL WHERE id = ? AND lease = ? AND state = 'running'",
+                               (size, time.time(), job.id, job.lease))
+        return cursor.rowcount == 1
+
+    def fail(self, job, error):
+        """
+        give a job back after an error: it is retried later, or marked failed after max_attempts
+        """
+        now = time.time()
+        final = job.attempts >= self.max_attempts
+        cursor = self._execute(
+            "UPDATE jobs SET state = ?, error = ?, finished = ?, lease_until = NULL, not_before = ? "
+            "WHERE id = ? AND lease = ? AND state = 'running'",
+            ('failed' if final else 'pending', error, now, now + self.retry_delay * 2 ** (job.attempts - 1),
+             job.id, job.lease))
+        return cursor.rowcount == 1
+
+    def retry_failed(self):
+        """
+        requeue the failed jobs with a fresh count of attempts. returns how many
+        """
+        return self._execute("UPDATE jobs SET state = 'pending', attempts = 0, not_before = 0 "
+                             "WHERE state = 'failed'").rowcount
+
+    def failed(self):
+        """
+        (path, error) of the failed jobs
+        """
+        return self._execute("SELECT path, error FROM jobs WHERE state = 'failed' ORDER BY id").fetchall()
+
+    def status(self):
+        """
+        QueueStats of the whole queue: the jobs in every state, the input bytes of the done jobs and the seconds the
+        workers spent on them, the wall time from the first start to the last finish, and a WorkerStats per worker
+        """
+        counts = dict(self._execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        done = "FROM jobs WHERE state = 'done'"
+        size, busy, first, last = self._execute(
+            f"SELECT TOTAL(size), TOTAL(finished - started), MIN(started), MAX(finished) {done}").fetchone()
+        workers = [WorkerStats(*row) for row in self._execute(
+            f"SELECT worker, COUNT(*), TOTAL(size), TOTAL(finished - started) {done} GROUP BY worker ORDER BY worker")]
+        return QueueStats(counts.get('pending', 0), counts.get('running', 0), counts.get('done', 0),
+                          counts.get('failed', 0), int(size), busy, (last - first) if first is not None else 0.0,
+                          workers)
+
+    def __len__(self):
+        return self._execute("SELECT COUNT(*) FROM jobs WHERE state IN ('pending', 'running')").fetchone()[0]
+
+
+def process_job(job):
+    """
+    run gopro2gpx on the clip of a job. every output is written into a temporary directory next to the output base,
+    then moved over the final name. returns the size of the clip
+    """
+    from .cli import options, run
+
+    output = Path(job.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    staging = Path(tempfile.mkdtemp(prefix=f'.{output.name}.', dir=output.parent))
+    try:
+        run(options(file=job.path, output=str(staging / output.name), **job.options))
+        for written in sorted(staging.iterdir()):
+            os.replace(written, output.parent / written.name)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return os.path.getsize(job.path)
+
+
+class _Heartbeat(threading.Thread):
+    # renews the lease of a job every lease/3 seconds until stopped
+    def __init__(self, queue, job):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.job = job
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        while not self.stopped.wait(self.queue.lease / 3.0):
+            if not self.queue.renew(self.job):
+                self.lost = True
+                logging.getLogger(__name__).warning(f'Lost the lease of {self.job.path}')
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def work(queue, worker=None, exit_when_empty=False, poll=5.0, max_jobs=None, process=process_job):
+    """
+    claim and process jobs until the queue is empty (exit_when_empty, or nothing left to retry), max_jobs were done, or
+    forever, polling every poll seconds. returns the number of jobs completed by this worker
+    """
+    logger = logging.getLogger(__name__)
+    worker = worker or default_worker_name()
+    completed = 0
+    while max_jobs is None or completed < max_jobs:
+        job = queue.claim(worker)
+        if job is None:
+            if exit_when_empty and len(queue) == 0:
+                break
+            time.sleep(poll)
+            continue
+
+        logger.info(f'{worker}: processing {job.path} (attempt {job.attempts})')
+        heartbeat = _Heartbeat(queue, job)
+        heartbeat.start()
+        try:
+            size = process(job)
+        except Exception as e:
+            heartbeat.stop()
+            logger.warning(f'{worker}: {job.path} failed: {e}')
+            queue.fail(job, f'{type(e).__name__}: {e}\n{traceback.format_exc()}')
+            continue
+        heartbeat.stop()
+
+        if queue.complete(job, size):
+            completed += 1
+        else:
+            # the outputs are whole files either way, the other worker writes the same ones
+            logger.warning(f'{worker}: {job.path} was claimed by another worker, not acknowledged')
+    return completed
+
+
+def format_status(stats):
+    lines = ["%d pending, %d running, %d done, %d failed" % (stats.pending, stats.running, stats.done, stats.failed)]
+    if stats.done and stats.wall > 0:
+        lines.append("throughput: %.2f clips/s, %.1f MB/s over %.1f s (%.1f s of work on %d workers)" % (
+            stats.done / stats.wall, stats.bytes / 1e6 / stats.wall, stats.wall, stats.busy, len(stats.workers)))
+    for w in stats.workers:
+        rate = w.bytes / 1e6 / w.busy if w.busy > 0 else 0.0
+        lines.append("  %s: %d clips, %.1f MB in %.1f s (%.1f MB/s)" % (w.worker, w.jobs, w.bytes / 1e6, w.busy, rate))
+    return "\n".join(lines)
+
+
+class JobQueueTest(unittest.TestCase):
+    SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.queue = JobQueue(self.tmp / 'queue.db', lease=0.5, retry_delay=0.0)
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmp)
+
+    def test_batch(self):
+        for name in ('gopro7', 'hero5'):
+            self.assertTrue(self.queue.add(self.SAMPLES / f'{name}.bin', self.tmp / 'out' / name, formats=['gpx']))
+        self.assertFalse(self.queue.add(self.SAMPLES / 'gopro7.bin', self.tmp / 'out' / 'gopro7', formats=['gpx']))
+
+        self.assertEqual(work(self.queue, 'a', exit_when_empty=True, max_jobs=1), 1)
+        self.assertEqual(work(self.queue, 'b', exit_when_empty=True), 1)
+        self.assertEqual(sorted(p.name for p in (self.tmp / 'out').iterdir()), ['gopro7.gpx', 'hero5.gpx'])
+
+        stats = self.queue.status()
+        self.assertEqual((stats.pending, stats.running, stats.done, stats.failed), (0, 0, 2, 0))
+        self.assertEqual([w.worker for w in stats.workers], ['a', 'b'])
+        self.assertEqual(stats.bytes, sum(os.path.getsize(self.SAMPLES / f'{n}.bin') for n in ('gopro7', 'hero5')))
+
+    def test_expired_lease(self):
+        self.queue.add(self.SAMPLES / 'gopro7.bin', self.tmp / 'gopro7', formats=['gpx'])
+        job = self.queue.claim('dead')
+        self.assertIsNone(self.queue.claim('other'))
+        time.sleep(0.6)
+        again = self.queue.claim('other')
+        self.assertEqual((again.id, again.attempts), (job.id, 2))
+        self.assertFalse(self.queue.complete(job))
+        self.assertTrue(self.queue.complete(again))
+
+    def test_retries(self):
+        self.queue.add(self.tmp / 'missing.MP4', formats=['gpx'])
+        self.assertEqual(work(self.queue, 'a', exit_when_empty=True), 0)
+        stats = self.queue.status()
+        self.assertEqual((stats.pending, stats.failed), (0, 1))
+        self.assertIn('missing.MP4', self.queue.failed()[0][1])
+        self.assertEqual(self.queue.retry_failed(), 1)
+        self.assertEqual(len(self.queue), 1)
+
+
+def parseArgs():
+    from .cli import DEFAULT_FORMATS, FORMATS
+
+    parser = argparse.ArgumentParser(description="batch extraction of GoPro clips through a shared job queue")
+    parser.add_argument("database", help="queue database file (SQLite), shared by every worker", type=Path)
+    parser.add_argument('-l', '--loglevel', default='info', help='Provide logging level. Example --loglevel debug')
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("add", help="queue video files (.mp4) or binary metadata dumps (.bin)")
+    add.add_argument("files", nargs='+', type=Path)
+    add.add_argument("-o", "--output_dir", type=Path, help="write the outputs here (default: next to every clip)")
+    add.add_argument("-f", "--format", dest="formats", action="append", choices=list(FORMATS),
+                     help="output format, repeat for several (default: %s)" % ", ".join(DEFAULT_FORMATS))
+    add.add_argument("-s", "--skip", help="Skip bad points (GPSFIX=0)", action="store_true", default=False)
+    add.add_argument("--smooth", help="reject GPS outliers and smooth the track", action="store_true")
+    add.add_argument("-m", "--metrics", help="add the derived metrics to the GPX and CSV", action="store_true")
+    add.add_argument("--recover", help="skip damaged GPMF blocks instead of failing", action="store_true")
+
+    work_parser = commands.add_parser("work", help="process jobs until stopped")
+    work_parser.add_argument("--worker", help="name of this worker (default: host-pid)")
+    work_parser.add_argument("--lease", type=float, default=DEFAULT_LEASE,
+                             help="seconds before the job of a dead worker is claimed again (default: %(default)s)")
+    work_parser.add_argument("--max_attempts", type=int, default=DEFAULT_MAX_ATTEMPTS,
+                             help="attempts before a job is marked failed (default: %(default)s)")
+    work_parser.add_argument("--exit_when_empty", action="store_true", help="stop when no job is left")
+
+    commands.add_parser("status", help="jobs in every state and the throughput of the workers")
+    commands.add_parser("retry", help="requeue the failed jobs")
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    logging.basicConfig(level=args.loglevel.upper())
+    logger = logging.getLogger(__name__)
+
+    if args.command == "work":
+        with JobQueue(args.database, lease=args.lease, max_attempts=args.max_attempts) as queue:
+            work(queue, args.worker, exit_when_empty=args.exit_when_empty)
+            print(format_status(queue.status()))
+        return
+
+    with JobQueue(args.database) as queue:
+        if args.command == "add":
+            options = dict(skip=args.skip, smooth=args.smooth, metrics=args.metrics, recover=args.recover)
+            if args.formats:
+                options['formats'] = args.formats
+            added = sum(queue.add(f, args.output_dir / f.stem if args.output_dir else None, **options)
+                        for f in args.files)
+            logger.info(f'Queued {added} of {len(args.files)} clips')
+        elif args.command == "retry":
+            logger.info(f'Requeued {queue.retry_failed()} failed jobs')
+        else:
+            print(format_status(queue.status()))
+            for path, error in queue.failed():
+                print("failed: %s: %s" % (path, error.splitlines()[0] if error else ''))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,45 @@
+"""
+the heavy dependencies (PyAV, numpy, scipy) are imported by the functions that need them, so that --help, or tools
+that only need parseStream(), start quickly
+"""
 import argparse
 import array
+import csv
 import logging
-import sys
+import math
 from pathlib import Path
-import av
+
+from .config import DEFAULT_MEMORY_LIMIT
 from .klvdata import KLVData
-import numpy as np
-from scipy.io import savemat
-from datetime import datetime, timedelta
 from gopro2gpx.gopro2gpx import BuildGPSPoints, BuildOrientations
-from .np_datetime_conv import interp_time_array
-import csv
-import math
-from av.data.stream import DataStream
-from av.video.stream import VideoStream
-from scipy.spatial.transform import Rotation as R
 from . import gpshelper
 
 
-
-def parseStream(data_raw):
+def parseStream(data_raw, report=None):
     """
-    main code that reads the points
+    main code that reads the points.
+    with a recovery.DamageReport, damaged blocks are skipped and recorded in it instead of derailing the parser
     """
+    if report is not None:
+        from .recovery import parse_recovering
+        return parse_recovering(data_raw, report)
+
     data = array.array('b')
     data.frombytes(data_raw)
 
     offset = 0
     klvlist = []
+    complex_type = None
     logger = logging.getLogger(__name__)
 
     while offset < len(data):
 
-        klv = KLVData(data, offset)
+        klv = KLVData(data, offset, complex_type)
+        if klv.fourCC in ('DEVC', 'STRM'):
+            # TYPE is sticky within a stream
+            complex_type = None
+        elif klv.fourCC == 'TYPE':
+            complex_type = klv.data
         if klv.type == -1:
             # partial buffer read! save these bytes for later
             return klvlist, data_raw[offset:]
@@ -56,48 +63,174 @@ def parseStream(data_raw):
     return klvlist, bytes()
 
 
-def read_video(args):
+FRAME_INFO_FIELDS = ['index', 'gps_time', 'presentation_time', 'latitude', 'longitude', 'elevation', 'speed',
+                     'c_qw', 'c_qx', 'c_qy', 'c_qz', 'i_qw', 'i_qx', 'i_qy', 'i_qz']
+
+
+class FrameInfoBuilder:
+    """
+    accumulates the per-frame metadata while the container is demuxed: video frames are counted with add_frame()
+    and every parsed chunk of GPMF data is interpolated onto the frames seen since the previous chunk by add_klv().
+    everything is kept in growable typed buffers that spill to disk past memory_limit bytes, so memory stays bounded
+    however long the clip is. n_frames is only a hint: the buffers grow with what is actually produced
+    """
+
+    def __init__(self, n_frames=0, skip=False, memory_limit=DEFAULT_MEMORY_LIMIT):
+        from .buffers import ColumnBuffers, PointBuffer
+
+        self.skip = skip
+        self.frame_count = 0
+        self.last_frame = 0
+        self.all_points = PointBuffer(memory_limit // 4)
+        self.frame_info = ColumnBuffers({k: ('datetime64[us]' if k == 'gps_time' else float, ())
+                                         for k in FRAME_INFO_FIELDS}, memory_limit - memory_limit // 4)
+
+    def add_frame(self, index, time):
+        self.frame_info.append(index=index, presentation_time=time)
+        self.frame_count += 1
+
+    def add_klv(self, klv):
+        import numpy as np
+        from .geodesy import interp_geodetic, slerp_quaternions
+        from .np_datetime_conv import interp_time_array
+
+        frame_count = self.frame_count
+        last_frame = self.last_frame
+
+        points = BuildGPSPoints(klv, skip=self.skip)
+        self.all_points.extend(points)
+        points_CORI, points_IORI = BuildOrientations(klv)
+
+        if not len(points):
+            return
+
+        gps_count = len(points)
+        times = np.array([np.datetime64(p.time) for p in points], dtype='datetime64[us]')
+        lat = np.array([p.latitude for p in points])
+        lon = np.array([p.longitude for p in points])
+        speeds = np.array([p.speed for p in points])
+        elevation = np.array([p.elevation for p in points])
+
+        # assume that the video runs at 29.97 Hz and the GPS runs at 18 Hz.
+        # the easiest way to line these up is with simple interpolation.
+        x = np.linspace(0, 1, frame_count - last_frame)
+        xp = np.linspace(0, 1, gps_count)
+
+        # interpolate the positions in ECEF rather than latitude and longitude independently
+        lat, lon, elevation = interp_geodetic(x, xp, lat, lon, elevation)
+        self.frame_info.append(gps_time=interp_time_array(x, xp, times),
+                               latitude=lat,
+                               longitude=lon,
+                               speed=np.interp(x, xp, speeds),
+                               elevation=elevation)
+
+        # the orientation streams usually run at the frame rate, but SLERP onto the frames in case not. the c_q*/i_q*
+        # columns are unit quaternions with the sign SLERP gives them, not the raw samples (see slerp_quaternions)
+        for prefix, quats in (('c_', points_CORI), ('i_', points_IORI)):
+            if len(quats) > 0:
+                q = slerp_quaternions(x, np.linspace(0, 1, len(quats)), quats)
+            else:
+                q = np.zeros((len(x), 4))
+            self.frame_info.append(**{prefix + 'qw': q[:, 0], prefix + 'qx': q[:, 1],
+                                      prefix + 'qy': q[:, 2], prefix + 'qz': q[:, 3]})
+
+        self.last_frame = frame_count
+
+    def finish(self):
+        # the frames after the last GPMF chunk have no metadata
+        self.frame_info.pad(self.frame_count)
+        frame_info = self.frame_info.arrays()
+        frame_info.update(orientation_angles(frame_info))
+        return frame_info
+
+
+def relative_euler_angles(q):
+    """
+    q is an (n, 4) array of (qw, qx, qy, qz). returns the (n, 3) 'yxz' Euler angles in degrees of every
+    rotation relative to the first one, computed in one batch. rows without a valid quaternion are NaN
+    """
+    import numpy as np
+    from scipy.spatial.transform import Rotation as R
+
+    q = np.asarray(q, dtype=float).reshape(-1, 4)
+    angles = np.full((len(q), 3), np.nan)
+    valid = np.flatnonzero(np.linalg.norm(q, axis=1) > 0)
+    if len(valid):
+        # the quaternions have always been handed to from_quat() in (qw, qx, qy, qz) order: keep it that way so that
+        # the saved angles stay comparable with older outputs
+        rot = R.from_quat(q[valid])
+        angles[valid] = (rot * rot[0].inv()).as_euler('yxz', degrees=True)
+    return angles
+
+
+def orientation_angles(frame_info):
+    """
+    Euler angles of the camera (CORI), image (IORI) and net image pose for every frame
+    """
+    import numpy as np
+    from scipy.spatial.transform import Rotation as R
+
+    q_cori = np.column_stack([frame_info[k] for k in ('c_qw', 'c_qx', 'c_qy', 'c_qz')])
+    q_iori = np.column_stack([frame_info[k] for k in ('i_qw', 'i_qx', 'i_qy', 'i_qz')])
+    valid = (np.linalg.norm(q_cori, axis=1) > 0) & (np.linalg.norm(q_iori, axis=1) > 0)
+
+    # IORI is relative to CORI, and I want the net quaternion describing the image pose
+    q_net = np.zeros_like(q_cori)
+    if valid.any():
+        q_net[valid] = (R.from_quat(q_iori[valid]).inv() * R.from_quat(q_cori[valid])).as_quat()
+
+    # the initial GoPro pose is set when the device is powered on, and all quaternions are relative to that.
+    # but since I cannot know that initial pose (most GoPros do not have a magnetometer), I'm going to
+    # save the Euler angles relative to that initial pose
+    angles = {}
+    for prefix, q in (('rel_net', q_net), ('cam_rel', q_cori), ('img_rel', q_iori)):
+        rel = relative_euler_angles(q)
+        angles[prefix + '_az'] = rel[:, 0]
+        angles[prefix + '_tilt'] = rel[:, 1]
+        angles[prefix + '_roll'] = rel[:, 2]
+    return angles
+
+
+def find_gpmf_stream(container):
+    for ds in container.streams.data:
+        if 'GoPro MET' in ds.metadata.get('handler_name', ''):
+            return ds
+    raise Exception(f'GoPro Metadata stream not found in {container.name}')
+
+
+def extract_frame_info(args):
+    """
+    demux args.video_file and interpolate the GPMF metadata to every video frame.
+    returns (frame_info, all_points) without writing anything but the optional streams container and sidecar
+    """
+    import av
+    from .sidecar import SidecarWriter
+    from .streams import StreamExtractor, TimeseriesStore
+
     source = args.video_file
     max_frames = args.max_frames
-    frame_count = 0
-    last_frame = 0
     unread_bytes = bytes()
-    all_points = []
 
     logger = logging.getLogger(__name__)
 
+    report = None
+    if args.recover:
+        from .recovery import DamageReport
+        report = DamageReport()
+
     logger.info(f'Opening video file {str(source)}')
     with av.open(str(source)) as container:
         n_frames = container.streams.video[0].frames
         logger.debug(f'Frame count: {n_frames}')
-        frame_info = {
-            'index': np.zeros(n_frames),
-            'gps_time': np.zeros(n_frames, dtype='datetime64[us]'),
-            'presentation_time': np.zeros(n_frames),
-            'latitude': np.zeros(n_frames),
-            'longitude': np.zeros(n_frames),
-            'elevation': np.zeros(n_frames),
-            'speed': np.zeros(n_frames),
-            'c_qw': np.zeros(n_frames),
-            'c_qx': np.zeros(n_frames),
-            'c_qy': np.zeros(n_frames),
-            'c_qz': np.zeros(n_frames),
-            'i_qw': np.zeros(n_frames),
-            'i_qx': np.zeros(n_frames),
-            'i_qy': np.zeros(n_frames),
-            'i_qz': np.zeros(n_frames)
-        }
-        cori = []
-        iori = []
+        builder = FrameInfoBuilder(n_frames, skip=args.skip, memory_limit=args.memory_limit * 1024 * 1024)
 
         # find the GPMF data stream
-        gpmf_ix = -1
-        for ix, ds in enumerate(container.streams.data):
-            if 'GoPro MET' in ds.metadata['handler_name']:
-                gpmf_ix = ix
-                break
-        if gpmf_ix == -1:
-            raise Exception(f'GoPro Metadata stream not found in {str(source)}')
+        gpmf_stream = find_gpmf_stream(container)
+        streams = []
+        if args.output_streams:
+            streams.append(StreamExtractor(TimeseriesStore(args.output_streams)))
+        if args.output_sidecar:
+            streams.append(StreamExtractor(SidecarWriter(args.output_sidecar)))
 
         for packet_index, packet in enumerate(container.demux()):
 
@@ -105,7 +238,7 @@ def read_video(args):
                 # We need to skip the "flushing" packets that `demux` generates
                 continue
 
-            if max_frames is not None and frame_count >= max_frames:
+            if max_frames is not None and builder.frame_count >= max_frames:
                 break
 
             """
@@ -116,13 +249,12 @@ def read_video(args):
             we should avoid decoding the packets if we don't really need to process them
             """
 
-            if isinstance(packet.stream, VideoStream):
+            if packet.stream.type == 'video':
                 frames = packet.decode()
                 if frames is not None and len(frames) > 0:
                     for frame in frames:
-                        last_frame_pts = frame.pts
-                        frame_info['index'][frame_count] = frame.index
-                        frame_info['presentation_time'][frame_count] = frame.time
+                        # newer PyAV releases dropped frame.index, but frames are decoded in order anyway
+                        builder.add_frame(getattr(frame, 'index', builder.frame_count), frame.time)
 
                         """
                         image_data = frame.to_image()
@@ -141,117 +273,125 @@ def read_video(args):
                             frame_meta["frame_image_width"] = image_size[0]
                             frame_meta["frame_image_height"] = image_size[1]
                         """
-                        frame_count += 1
-
-            elif isinstance(packet.stream, DataStream):
-                # logger.debug(f"No frames found in packet {packet_index}, processing as metadata")
 
+            elif packet.stream.index == gpmf_stream.index:
                 # there are multiple data streams, but we only care about the metadata stream with the GPMF data
-                if 'GoPro MET' not in packet.stream.metadata['handler_name']:
-                    continue
-
-                packet_data = packet.to_bytes()
-                klv, unread_bytes = parseStream(unread_bytes + packet_data)
-                points = BuildGPSPoints(klv, skip=args.skip)
-                all_points.extend(points)
-                points_CORI, points_IORI = BuildOrientations(klv)
-                cori.extend(points_CORI)
-                iori.extend(points_IORI)
-
-                if not len(points):
-                    continue
-
-                gps_count = len(points)
-                if gps_count > 0:
-                    times = np.array([np.datetime64(p.time) for p in points], dtype='datetime64[us]')
-                    lat = np.array([p.latitude for p in points])
-                    lon = np.array([p.longitude for p in points])
-                    speeds = np.array([p.speed for p in points])
-                    elevation = np.array([p.elevation for p in points])
-
-                    # assume that the video runs at 29.97 Hz and the GPS runs at 18 Hz.
-                    # the easiest way to line these up is with simple interpolation.
-                    x = np.linspace(0, 1, frame_count - last_frame)
-                    xp = np.linspace(0, 1, gps_count)
-
-                    frame_info['gps_time'][last_frame:frame_count] = interp_time_array(x, xp, times)
-
-                    # interpolating latitude and longitude independently isn't really the right thing to do,
-                    # but let's see if it's adequate here
-                    frame_info['latitude'][last_frame:frame_count] = np.interp(x, xp, lat)
-                    frame_info['longitude'][last_frame:frame_count] = np.interp(x, xp, lon)
-                    frame_info['speed'][last_frame:frame_count] = np.interp(x, xp, speeds)
-                    frame_info['elevation'][last_frame:frame_count] = np.interp(x, xp, elevation)
-
-                    if len(points_CORI) > 0:
-                        frame_info['c_qw'][last_frame:frame_count] = [p.qw for p in points_CORI]
-                        frame_info['c_qx'][last_frame:frame_count] = [p.qx for p in points_CORI]
-                        frame_info['c_qy'][last_frame:frame_count] = [p.qy for p in points_CORI]
-                        frame_info['c_qz'][last_frame:frame_count] = [p.qz for p in points_CORI]
-
-                    if len(points_IORI) > 0:
-                        frame_info['i_qw'][last_frame:frame_count] = [p.qw for p in points_IORI]
-                        frame_info['i_qx'][last_frame:frame_count] = [p.qx for p in points_IORI]
-                        frame_info['i_qy'][last_frame:frame_count] = [p.qy for p in points_IORI]
-                        frame_info['i_qz'][last_frame:frame_count] = [p.qz for p in points_IORI]
-
-                last_frame = frame_count
-
-    # truncate unnecessary extra samples: corrupted video frames could reduce the total number of frames we could save
-    if frame_count < n_frames:
-        for k in frame_info:
-            frame_info[k] = frame_info[k][:frame_count]
-
-    logger.info(f'Finished reading {frame_count} frames from {str(source)}')
-
-    # interpret the quaternions
-    qn_iori = [R.from_quat([p.qw, p.qx, p.qy, p.qz]) for p in iori]
-    qn_cori = [R.from_quat([p.qw, p.qx, p.qy, p.qz]) for p in cori]
+                klv, unread_bytes = parseStream(unread_bytes + bytes(packet), report)
+                builder.add_klv(klv)
+                for extractor in streams:
+                    extractor.add_klv(klv, float(packet.pts * packet.time_base),
+                                      float(packet.duration * packet.time_base) if packet.duration else 1.0)
 
-    # IORI is relative to CORI, and I want the net quaternion describing the image pose
-    qn_net = [q_i.inv() * q_c for q_c, q_i in zip(qn_cori, qn_iori)]
+        for extractor in streams:
+            logger.info(f'Writing all GPMF streams: {str(extractor.store.path)}')
+            extractor.store.close()
 
-    # the initial GoPro pose is set when the device is powered on, and all quaternions are relative to that.
-    # but since I cannot know that initial pose (most GoPros do not have a magnetometer), I'm going to
-    # save the Euler angles relative to that initial pose
-    rel_net_angles = np.array(
-        [(qn_net[ii] * qn_net[0].inv()).as_euler('yxz', degrees=True) for ii in range(frame_count)])
-    frame_info['rel_net_az'] = rel_net_angles[:, 0]
-    frame_info['rel_net_tilt'] = rel_net_angles[:, 1]
-    frame_info['rel_net_roll'] = rel_net_angles[:, 2]
-
-    rel_cori = np.array([(qn_cori[ii] * qn_cori[0].inv()).as_euler('yxz', degrees=True) for ii in range(frame_count)])
-    frame_info['cam_rel_az'] = rel_cori[:, 0]
-    frame_info['cam_rel_tilt'] = rel_cori[:, 1]
-    frame_info['cam_rel_roll'] = rel_cori[:, 2]
-
-    rel_iori = np.array([(qn_iori[ii] * qn_iori[0].inv()).as_euler('yxz', degrees=True) for ii in range(frame_count)])
-    frame_info['img_rel_az'] = rel_iori[:, 0]
-    frame_info['img_rel_tilt'] = rel_iori[:, 1]
-    frame_info['img_rel_roll'] = rel_iori[:, 2]
+    if report is not None:
+        from .recovery import parse_recovering
+        klv, _ = parse_recovering(unread_bytes, report, final=True)
+        builder.add_klv(klv)
+        report.log(logger)
 
-    # save in Matlab format
-    if args.output_mat_file is None:
-        args.output_mat_file = args.video_file.with_suffix(".mat")
+    frame_info = builder.finish()
+    logger.info(f'Finished reading {builder.frame_count} frames from {str(source)}')
+    return frame_info, builder.all_points
+
+
+def read_video(args):
+    frame_info, all_points = extract_frame_info(args)
+    resolve_outputs(args)
+    write_outputs(args, frame_info, all_points)
+
+
+def read_orientation_only(args):
+    """
+    the orientation columns of read_video(), without decoding the frames or building GPS points
+    """
+    from .orientation import read_orientation
+
+    logger = logging.getLogger(__name__)
+    frame_info = read_orientation(args.video_file, per_frame=True)
+    resolve_outputs(args)
     logger.info(f'Writing .MAT file: {str(args.output_mat_file)}')
-    savemat(str(args.output_mat_file), frame_info)
+    write_mat(args.output_mat_file, frame_info)
+    if args.output_full_csv:
+        logger.info(f'Writing full .CSV file: {str(args.output_full_csv)}')
+        write_full_csv(args.output_full_csv, frame_info)
 
+
+def resolve_outputs(args):
+    """
+    fill in the default output filenames next to the video file
+    """
+    if args.output_mat_file is None:
+        args.output_mat_file = args.video_file.with_suffix(".mat")
     if args.output_full_csv is None:
         args.output_full_csv = args.video_file.with_suffix(".csv")
+    if args.output_pix4d_csv is None:
+        args.output_pix4d_csv = args.video_file.with_name(args.video_file.stem + "_pix4d.csv")
+    if args.output_kml is None:
+        args.output_kml = args.video_file.with_suffix(".kml")
+    return args
+
 
+def output_writers(args, frame_info, all_points):
+    """
+    the (description, function, arguments) of every output requested in args. they are independent of each other,
+    so they can run in any order or concurrently
+    """
+    writers = [('.MAT file', write_mat, (args.output_mat_file, frame_info))]
     if args.output_full_csv:
-        # save the full metadata as a CSV just in case somebody wants that for another (non-Matlab program)
-        logger.info(f'Writing full .CSV file: {str(args.output_full_csv)}')
-        with args.output_full_csv.open('w', newline='') as csvfile:
-            fieldnames = frame_info.keys()
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames, dialect="excel")
-            writer.writeheader()
+        writers.append(('full .CSV file', write_full_csv, (args.output_full_csv, frame_info)))
+    if args.output_pix4d_csv:
+        writers.append(('PIX4D .CSV file', write_pix4d_csv, (args.output_pix4d_csv, frame_info)))
+    if args.output_kml:
+        writers.append(('.KML file', write_kml, (args.output_kml, all_points, args.simplify, args.max_points)))
+    if args.output_images:
+        from .frames import write_images
+        writers.append(('geotagged images', write_images,
+                        (args.output_images, args.video_file, frame_info, args.every, args.every_metres,
+                         args.every_seconds, args.jobs)))
+    return writers
+
+
+def write_outputs(args, frame_info, all_points):
+    logger = logging.getLogger(__name__)
+    for description, writer, writer_args in output_writers(args, frame_info, all_points):
+        logger.info(f'Writing {description}: {str(writer_args[0])}')
+        writer(*writer_args)
+
 
-            # from dict of lists to list of dicts
-            rows = [{k: v[ii] for k, v in frame_info.items()} for ii in range(frame_count)]
-            for ii in range(frame_count):
-                writer.writerow(rows[ii])
+def write_mat(path, frame_info):
+    from scipy.io import savemat
 
+    # save in Matlab format
+    savemat(str(path), frame_info)
+
+
+def write_full_csv(path, frame_info):
+    # save the full metadata as a CSV just in case somebody wants that for another (non-Matlab program)
+    frame_count = len(frame_info['index'])
+    with path.open('w', newline='') as csvfile:
+        fieldnames = frame_info.keys()
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, dialect="excel")
+        writer.writeheader()
+
+        # from dict of lists to one dict per row, without building all of the rows in memory
+        for ii in range(frame_count):
+            writer.writerow({k: v[ii] for k, v in frame_info.items()})
+
+
+def pix4d_image_name(index, frame_count):
+    """
+    the IMG_xxxx.JPG name of frame `index` (counted from 0) of a clip of frame_count frames
+    """
+    # determine how many prefix zeros will be required to keep these files in order
+    n_digits_required = math.ceil(math.log10(frame_count))
+    index_str = str(int(index + 1)).zfill(n_digits_required)  # does PIX4D count frames from 0 or 1? I guess 1
+    return f'IMG_{index_str}.JPG'
+
+
+def write_pix4d_csv(path, frame_info, rows=None):
     """
 write the CSV for PIX4D to use (Image geolocation file)
 
@@ -266,42 +406,37 @@ extension file. It contains four columns per line, and uses a comma to separate
 Example:
 IMG_3165.JPG,46.2345612,6.5611445,539.931234
 IMG_3166.JPG,46.2323423,6.5623423,529.823423
-    """
-    if args.output_pix4d_csv is None:
-        args.output_pix4d_csv = args.video_file.with_name(args.video_file.stem + "_pix4d.csv")
 
-    if args.output_pix4d_csv:
-        logger.info(f'Writing PIX4D .CSV file: {str(args.output_pix4d_csv)}')
-        with args.output_pix4d_csv.open('w', newline='') as csvfile:
-            fieldnames = ['imagename', 'latitude', 'longitude', 'altitude']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter=',', quoting=csv.QUOTE_NONE)
-            writer.writeheader()
-
-            # determine how many prefix zeros will be required to keep these files in order
-            n_digits_required = math.ceil(math.log10(frame_count))
-
-            for ii in range(frame_count):
-                index = int(frame_info["index"][ii] + 1)  # does PIX4D count frames from 0 or 1? I guess 1
-                index_str = str(index).zfill(n_digits_required)
-                writer.writerow(
-                    {'imagename': f'IMG_{index_str}.JPG',
-                     'latitude': frame_info['latitude'][ii],
-                     'longitude': frame_info['longitude'][ii],
-                     'altitude': frame_info['elevation'][ii]
-                     }
-                )
-
-    if args.output_kml is None:
-        args.output_kml = args.video_file.with_suffix(".kml")
-
-    if args.output_kml:
-        logger.info(f'Writing .KML file: {str(args.output_kml)}')
-        # oops, these altitudes don't seem to work right in Google Earth, so I'm going to set them all to 0
-        for ii in range(len(all_points)):
-            all_points[ii].elevation = 0
-        kml = gpshelper.generate_KML(all_points)
-        with args.output_kml.open("w+") as fd:
-            fd.write(kml)
+rows limits the file to these rows of frame_info (e.g. the frames saved as images)
+    """
+    frame_count = len(frame_info['index'])
+    with path.open('w', newline='') as csvfile:
+        fieldnames = ['imagename', 'latitude', 'longitude', 'altitude']
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter=',', quoting=csv.QUOTE_NONE)
+        writer.writeheader()
+
+        for ii in (range(frame_count) if rows is None else rows):
+            writer.writerow(
+                {'imagename': pix4d_image_name(frame_info["index"][ii], frame_count),
+                 'latitude': frame_info['latitude'][ii],
+                 'longitude': frame_info['longitude'][ii],
+                 'altitude': frame_info['elevation'][ii]
+                 }
+            )
+
+
+def write_kml(path, all_points, tolerance=None, max_points=None):
+    from .simplify import simplify_points
+
+    points = simplify_points(all_points, tolerance, max_points)
+    # oops, these altitudes don't seem to work right in Google Earth, so I'm going to set them all to 0
+    # (all_points may rebuild the GPSPoint objects on every access, so zero them on a materialized list)
+    points = list(points)
+    for ii in range(len(points)):
+        points[ii].elevation = 0
+    kml = gpshelper.generate_KML(points)
+    with path.open("w+") as fd:
+        fd.write(kml)
 
 
 def parseArgs():
@@ -313,9 +448,31 @@ def parseArgs():
                         help="output filename for metadata CSV in PIX4D format (optional)")
     parser.add_argument("-n", "--max_frames", nargs='?', type=int, help="stop after processing N frames (optional)")
     parser.add_argument("-s", "--skip", help="Skip bad points (GPSFIX=0)", action="store_true", default=False)
+    parser.add_argument("--simplify", type=float, metavar="METRES",
+                        help="simplify the KML track to this tolerance in metres (optional)")
+    parser.add_argument("--max_points", type=int, help="limit the KML track to N points (optional)")
     parser.add_argument('-l', '--loglevel', default='info',
                         help='Provide logging level. Example --loglevel debug')
     parser.add_argument("-m", "--output_mat_file", help="output metadata .MAT file (optional)", type=Path)
+    parser.add_argument("--memory_limit", type=int, default=DEFAULT_MEMORY_LIMIT // (1024 * 1024), metavar="MB",
+                        help="spill the accumulated metadata to temporary files past this many MB (default: %(default)s)")
+    parser.add_argument("-a", "--output_streams", type=Path,
+                        help="output every GPMF stream (ACCL, GYRO, GRAV, ...) to this .npz container (optional)")
+    parser.add_argument("--output_sidecar", type=Path,
+                        help="output every GPMF stream to this memory-mappable .telemetry sidecar (optional)")
+    parser.add_argument("--recover", action="store_true", default=False,
+                        help="skip damaged GPMF blocks (bad sectors, truncated files) instead of failing")
+    parser.add_argument("--orientation_only", action="store_true", default=False,
+                        help="only write the CORI/IORI orientation of every frame to the .MAT and full .CSV files")
+    parser.add_argument("--output_images", type=Path, metavar="DIR",
+                        help="save geotagged IMG_xxxx.JPG frames (and their PIX4D CSV) to this directory (optional)")
+    spacing = parser.add_mutually_exclusive_group()
+    spacing.add_argument("--every", type=int, metavar="N", help="with --output_images, save every Nth frame")
+    spacing.add_argument("--every_metres", type=float, metavar="METRES",
+                         help="with --output_images, save a frame every METRES of track")
+    spacing.add_argument("--every_seconds", type=float, metavar="SECONDS",
+                         help="with --output_images, save a frame every SECONDS")
+    parser.add_argument("-j", "--jobs", type=int, help="threads decoding the --output_images frames (default: one per core)")
     parser.add_argument("video_file", help="GoPro Video file (.mp4)", type=Path)
 
     # parser.print_help()
@@ -324,11 +481,36 @@ def parseArgs():
     return args
 
 
+def gopro2gpx_command(args):
+    """
+    the gopro2gpx command (cli.py) writing the same outputs as these args, apart from their names
+    """
+    command = ['gopro2gpx', '-f', 'mat', '-f', 'frames', '-f', 'pix4d', '-f', 'kml']
+    command += ['-f', 'npz'] * bool(args.output_streams) + ['-f', 'telemetry'] * bool(args.output_sidecar)
+    for flag, value in (('-n', args.max_frames), ('--simplify', args.simplify), ('--max_points', args.max_points),
+                        ('--images', args.output_images), ('--every', args.every),
+                        ('--every_metres', args.every_metres), ('--every_seconds', args.every_seconds)):
+        if value is not None:
+            command += [flag, str(value)]
+    command += ['-s'] * args.skip + ['--recover'] * args.recover + [str(args.video_file)]
+    return ' '.join(command)
+
+
 def main():
+    """
+    deprecated: the gopro2gpx command (cli.py) writes the same per-frame outputs in the same single pass, and is where
+    new options go. this one stays for the scripts and Matlab setups that call it, for its per-output file names, the
+    full CSV named <video>.csv, --orientation_only, and its KML without altitudes
+    """
     args = parseArgs()
     logging.basicConfig(level=args.loglevel.upper())
     logger = logging.getLogger(__name__)
-    read_video(args)
+    if not args.orientation_only:
+        logger.warning(f'klv_extraction is deprecated, the same outputs come from: {gopro2gpx_command(args)}')
+    if args.orientation_only:
+        read_orientation_only(args)
+    else:
+        read_video(args)
     logger.info(f'Finished working on {str(args.video_file)}. Exiting')
 
 
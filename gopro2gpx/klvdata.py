@@ -7,6 +7,7 @@
 #
 
 import struct
+import unittest
 
 from . import fourCC
 
@@ -15,18 +16,30 @@ class KLVData:
     """
     format: Header: 32-bit, 8-bit, 8-bit, 16-bit
             Data: 32-bit aligned, padded with 0
+
+    a whole clip keeps hundreds of thousands of these alive in its klvlist, so they have __slots__ instead of a
+    __dict__, and length and padded_length are computed from the header instead of stored
     """
     binary_format = '>4sBBH'
+    header = struct.Struct(binary_format) # unsigned bytes!
+
+    __slots__ = ('fourCC', 'type', 'size', 'repeat', 'complex_type', 'rawdata', 'data')
+
+    # one str per label instead of one per KLV
+    _labels = {}
 
-    def __init__(self, data, offset):
+    def __init__(self, data, offset, complex_type=None):
 
-        s  = struct.Struct(KLVData.binary_format) # unsigned bytes!
-        self.fourCC, self.type, self.size, self.repeat = s.unpack_from(data, offset=offset)
-        self.fourCC = self.fourCC.decode()
+        self.fourCC, self.type, self.size, self.repeat = KLVData.header.unpack_from(data, offset=offset)
+        label = KLVData._labels.get(self.fourCC)
+        if label is None:
+            label = KLVData._labels.setdefault(self.fourCC, self.fourCC.decode())
+        self.fourCC = label
 
         self.type = int(self.type)
-        self.length = self.size * self.repeat
-        self.padded_length = self.pad(self.length)
+
+        # the sticky TYPE of the enclosing stream, needed to decode complex ('?') samples
+        self.complex_type = complex_type
 
         # read now the data, in raw format
         self.rawdata = self.readRawData(data, offset)
@@ -51,12 +64,20 @@ class KLVData:
         s = "fourCC=%s type=%s size=%d repeat=%s data={%s} raws=|%s| raw=[%s]" % (self.fourCC, stype, self.size, self.repeat, self.data, rawdatas, rawdata)
         return(s)
 
+    @property
+    def length(self):
+        return self.size * self.repeat
+
+    @property
+    def padded_length(self):
+        if self.type == -1:
+            # partial buffer read: don't advance the offset
+            return 0
+        return self.pad(self.length)
+
     def pad(self,n, base=4):
         "padd the number so is % base == 0"
-        i = n
-        while i%base != 0:
-            i+=1
-        return i
+        return -(-n // base) * base
 
     def skip(self):
         return self.fourCC in fourCC.skip_labels
@@ -73,11 +94,55 @@ class KLVData:
             rawdata = None
         elif num_bytes+offset+8 > len(data):
             rawdata = None
-            self.type = -1  # partial buffer read. try again later
-            self.padded_length = 0  # don't advance the offset
+            self.type = -1  # partial buffer read. try again later (padded_length is 0)
         else:
-            fmt = '>' + str(num_bytes) + 's'
-            s  = struct.Struct(fmt)
-            rawdata, = s.unpack_from(data, offset=offset+8)
+            rawdata = bytes(data[offset+8:offset+8+num_bytes])
 
         return(rawdata)
+
+
+class KLVMemory(unittest.TestCase):
+    # bytes per KLV with a 4-byte payload: the slotted record, its rawdata and the decoded value.
+    # with a __dict__ per instance this was about 280
+    BUDGET = 192
+    COUNT = 20000
+
+    def buffer(self):
+        import array
+
+        raw = b''.join(struct.pack('>4sBBHL', b'TSMP', ord('L'), 4, 1, 100000 + i) for i in range(self.COUNT))
+        data = array.array('b')
+        data.frombytes(raw)
+        return data
+
+    def test_memory_per_klv(self):
+        import gc
+        import tracemalloc
+
+        data = self.buffer()
+        KLVData(data, 0)
+        gc.collect()
+        tracemalloc.start()
+        try:
+            klvlist = [KLVData(data, 12 * i) for i in range(self.COUNT)]
+            used, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(klvlist[-1].data, 100000 + self.COUNT - 1)
+        self.assertLessEqual(used / self.COUNT, self.BUDGET)
+
+    def test_no_instance_dict(self):
+        klv = KLVData(self.buffer(), 0)
+        self.assertFalse(hasattr(klv, '__dict__'))
+        self.assertEqual((klv.length, klv.padded_length), (4, 4))
+
+    def test_pickle(self):
+        # parallel.py sends klvlists between processes
+        import pickle
+
+        klv = pickle.loads(pickle.dumps(KLVData(self.buffer(), 12)))
+        self.assertEqual((klv.fourCC, klv.type, klv.size, klv.repeat, klv.data), ('TSMP', ord('L'), 4, 1, 100001))
+
+
+if __name__ == '__main__':
+    unittest.main()
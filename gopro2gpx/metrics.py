@@ -0,0 +1,237 @@
+"""
+derived metrics of a GPS track: distance, smoothed speed, grade, vertical speed, heading and acceleration.
+
+everything is computed for the whole track at once with numpy: step distances (great circle, or straight 3D lines in
+ECEF, which is the same as in any local ENU frame), their cumulative sum, and then the smoothed quantities over a
+sliding time window. the window is found with two searchsorted() calls, so irregular sampling (dropped GPS samples,
+resampled or merged tracks) gives rates over the right time span, and a rate is just
+
+    (cumulative[end] - cumulative[start]) / (time[end] - time[start])
+
+for all the points in one pass.
+
+use apply_metrics() between BuildGPSPoints() and the gpshelper writers: it fills GPSPoint.distance (written to the
+GPX <gpxtpx:distance>) and the heading, grade, vertical speed and acceleration columns of the CSV.
+"""
+
+import unittest
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from . import gpshelper
+from .geodesy import EARTH_RADIUS, geodetic_to_ecef, haversine
+
+# seconds. GoPro GPS is 10-18 Hz and noisy, a couple of seconds removes the jitter and keeps the turns
+DEFAULT_WINDOW = 2.0
+
+# metres. below this the grade and heading over a window are noise (standing still)
+MIN_MOVEMENT = 1.0
+
+METHODS = ('haversine', 'enu')
+
+
+def step_distances(lat, lon, ele=None, method='haversine'):
+    """
+    distance in metres from every point to the next one (n - 1 values). 'haversine' is the great circle distance on
+    the ground, 'enu' the straight line between the points including the change of elevation
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    if method == 'haversine':
+        return haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    if method == 'enu':
+        ele = np.zeros(len(lat)) if ele is None else np.asarray(ele, dtype=float)
+        xyz = np.column_stack(geodetic_to_ecef(lat, lon, ele))
+        return np.linalg.norm(np.diff(xyz, axis=0), axis=1)
+    raise ValueError(f'unknown distance method {method!r}, use one of {METHODS}')
+
+
+def bearing(lat1, lon1, lat2, lon2):
+    """
+    initial great circle bearing in degrees [0, 360) from point 1 to point 2. broadcasts
+    """
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    dlon = np.radians(np.asarray(lon2) - np.asarray(lon1))
+    y = np.sin(dlon) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
+    return np.degrees(np.arctan2(y, x)) % 360.0
+
+
+def _seconds(times):
+    times = np.asarray(times)
+    if np.issubdtype(times.dtype, np.number):
+        return times.astype(float)
+    times = times.astype('datetime64[us]')
+    return (times - times[0]).astype(np.int64) / 1e6
+
+
+def _window(t, window):
+    # for every point, the first and last point within window/2 seconds of it
+    start = np.searchsorted(t, t - window / 2.0, side='left')
+    end = np.searchsorted(t, t + window / 2.0, side='right') - 1
+    # a window that holds a single point (a gap in the track) falls back to the neighbours
+    single = start == end
+    start[single] = np.maximum(start[single] - 1, 0)
+    end[single] = np.minimum(end[single] + 1, len(t) - 1)
+    return start, end
+
+
+def _rate(values, t, start, end):
+    dt = t[end] - t[start]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = (values[end] - values[start]) / dt
+    return np.where(dt > 0, rate, 0.0)
+
+
+def _fill_forward(values, valid):
+    # replace the invalid values by the last valid one (the first valid one at the start)
+    if not valid.any():
+        return np.zeros_like(values)
+    ix = np.where(valid, np.arange(len(values)), 0)
+    np.maximum.accumulate(ix, out=ix)
+    ix[:np.argmax(valid)] = np.argmax(valid)
+    return values[ix]
+
+
+def compute_metrics(times, lat, lon, ele, window=DEFAULT_WINDOW, method='haversine'):
+    """
+    derived metrics of a track as a dict of arrays, one value per point:
+
+      step_distance   metres from the previous point (0 for the first)
+      distance        cumulative metres from the start
+      speed           m/s, distance over the time window
+      vertical_speed  m/s, climb over the time window
+      grade           percent, climb over horizontal distance in the time window
+      heading         degrees clockwise from north, over the time window
+      acceleration    m/s^2, derivative of the smoothed speed
+
+    times are datetime64 (or datetime) values or seconds, sorted. window is in seconds
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    ele = np.asarray(ele, dtype=float)
+    t = _seconds(times)
+    n = len(t)
+
+    metrics = {name: np.zeros(n) for name in
+               ('step_distance', 'distance', 'speed', 'vertical_speed', 'grade', 'heading', 'acceleration')}
+    if n < 2:
+        return metrics
+
+    steps = step_distances(lat, lon, ele, method)
+    metrics['step_distance'][1:] = steps
+    distance = np.concatenate([[0.0], np.cumsum(steps)])
+    metrics['distance'] = distance
+
+    start, end = _window(t, window)
+    metrics['speed'] = _rate(distance, t, start, end)
+    metrics['vertical_speed'] = _rate(ele, t, start, end)
+
+    # the grade is on the ground distance, whatever the method of the step distances
+    ground = distance if method == 'haversine' else np.concatenate(
+        [[0.0], np.cumsum(step_distances(lat, lon, method='haversine'))])
+    run = ground[end] - ground[start]
+    moving = run >= MIN_MOVEMENT
+    with np.errstate(divide='ignore', invalid='ignore'):
+        grade = 100.0 * (ele[end] - ele[start]) / run
+    metrics['grade'] = np.where(moving, grade, 0.0)
+
+    # standing still the direction between the window ends is noise: keep the last heading instead
+    heading = bearing(lat[start], lon[start], lat[end], lon[end])
+    metrics['heading'] = _fill_forward(heading, moving)
+
+    metrics['acceleration'] = _rate(metrics['speed'], t, start, end)
+    return metrics
+
+
+def apply_metrics(points, window=DEFAULT_WINDOW, method='haversine'):
+    """
+    compute the metrics of a list of gpshelper.GPSPoint and store them on the points: distance (cumulative),
+    smoothed_speed, vertical_speed, grade, heading and acceleration. the GPS speed (p.speed) is left as it is.
+    returns the points
+    """
+    if not points:
+        return points
+    times = np.array([np.datetime64(p.time) for p in points], dtype='datetime64[us]')
+    metrics = compute_metrics(times,
+                              [p.latitude for p in points],
+                              [p.longitude for p in points],
+                              [p.elevation for p in points],
+                              window=window, method=method)
+    columns = [metrics[name].tolist() for name in
+               ('distance', 'speed', 'vertical_speed', 'grade', 'heading', 'acceleration')]
+    for p, distance, speed, vertical_speed, grade, heading, acceleration in zip(points, *columns):
+        p.distance = distance
+        p.smoothed_speed = speed
+        p.vertical_speed = vertical_speed
+        p.grade = grade
+        p.heading = heading
+        p.acceleration = acceleration
+    return points
+
+
+class MetricsTest(unittest.TestCase):
+    def _track(self, t):
+        # due north at 5 m/s, climbing 0.5 m/s: a 10 % grade
+        t = np.asarray(t, dtype=float)
+        lat = 40.0 + np.degrees(5.0 * t / EARTH_RADIUS)
+        return t, lat, np.full(len(t), -3.7), 600.0 + 0.5 * t
+
+    def test_straight(self):
+        t, lat, lon, ele = self._track(np.arange(0, 60, 0.1))
+        metrics = compute_metrics(t, lat, lon, ele)
+
+        np.testing.assert_allclose(metrics['step_distance'][1:], 0.5, rtol=1e-6)
+        np.testing.assert_allclose(metrics['distance'], 5.0 * t, rtol=1e-6, atol=1e-6)
+        np.testing.assert_allclose(metrics['speed'], 5.0, rtol=1e-6)
+        np.testing.assert_allclose(metrics['vertical_speed'], 0.5, rtol=1e-9)
+        np.testing.assert_allclose(metrics['grade'], 10.0, rtol=1e-6)
+        np.testing.assert_allclose(metrics['heading'], 0.0, atol=1e-6)
+        np.testing.assert_allclose(metrics['acceleration'], 0.0, atol=1e-6)
+
+        # in a straight line, the climb is part of the distance (on the ellipsoid, not the sphere of haversine)
+        flat = compute_metrics(t, lat, lon, np.full(len(t), 600.0), method='enu')
+        np.testing.assert_allclose(flat['speed'], 5.0, rtol=0.01)
+        metrics = compute_metrics(t, lat, lon, ele, method='enu')
+        np.testing.assert_allclose(metrics['speed'], np.hypot(flat['speed'], 0.5), rtol=1e-5)
+        np.testing.assert_allclose(metrics['grade'], 10.0, rtol=1e-6)
+
+    def test_irregular(self):
+        # dropped samples and a 3 s gap: the rates are over the time actually elapsed
+        t = np.arange(0, 60, 0.1)
+        rng = np.random.default_rng(0)
+        t = np.sort(rng.choice(t[(t < 20) | (t > 23)], 300, replace=False))
+        t, lat, lon, ele = self._track(t)
+        metrics = compute_metrics(t, lat, lon, ele)
+        np.testing.assert_allclose(metrics['speed'], 5.0, rtol=1e-6)
+        np.testing.assert_allclose(metrics['vertical_speed'], 0.5, rtol=1e-9)
+
+        # the same with datetimes
+        times = np.datetime64('2020-01-01T12:00:00') + (t * 1e6).astype('timedelta64[us]')
+        np.testing.assert_allclose(compute_metrics(times, lat, lon, ele)['speed'], 5.0, rtol=1e-6)
+
+    def test_standing(self):
+        # east for 10 s, then stopped for 10 s: the heading is kept, the grade is 0
+        t = np.arange(0, 20, 0.1)
+        moved = np.minimum(t, 10.0) * 5.0
+        lon = -3.7 + np.degrees(moved / (EARTH_RADIUS * np.cos(np.radians(40.0))))
+        metrics = compute_metrics(t, np.full(len(t), 40.0), lon, np.full(len(t), 600.0))
+        stopped = t > 12
+        np.testing.assert_allclose(metrics['speed'][stopped], 0.0, atol=1e-9)
+        np.testing.assert_allclose(metrics['heading'][stopped], 90.0, atol=0.01)
+        np.testing.assert_array_equal(metrics['grade'][stopped], 0.0)
+        self.assertAlmostEqual(metrics['distance'][-1], 50.0, places=3)
+
+    def test_apply(self):
+        t, lat, lon, ele = self._track(np.arange(0, 10, 0.5))
+        t0 = datetime(2020, 1, 1)
+        points = [gpshelper.GPSPoint(a, o, e, t0 + timedelta(seconds=float(s)), 5.0)
+                  for s, a, o, e in zip(t, lat, lon, ele)]
+        self.assertIs(apply_metrics(points), points)
+        self.assertAlmostEqual(points[-1].distance, 5.0 * t[-1], places=3)
+        self.assertAlmostEqual(points[5].smoothed_speed, 5.0, places=4)
+        self.assertAlmostEqual(points[5].grade, 10.0, places=3)
+        self.assertEqual(apply_metrics([]), [])
+        self.assertRaises(ValueError, step_distances, lat, lon, method='vincenty')
@@ -8,7 +8,6 @@ more: https://stackoverflow.com/questions/13703720/converting-between-datetime-t
 """
 
 import numpy as np
-from scipy.io import savemat
 from datetime import datetime, timedelta
 from time import sleep
 import unittest
@@ -0,0 +1,243 @@
+"""
+orientation-only fast path: the CORI/IORI Euler angles of read_video() without the GPS work.
+
+only the KLV headers are walked (scan.scan_headers): every label other than CORI, IORI and the SCAL of their stream
+is skipped by its length without being decoded, the quaternions are converted straight from the raw payloads with numpy, and the angles
+are computed in one batch by orientation_angles(). no video frame is decoded, no GPS point is built and no KML/CSV
+is written, so a full clip costs about as much as reading its GPMF track.
+
+the samples are timestamped by spreading them evenly over their GPMF packet, like streams.StreamExtractor. with
+per_frame=True they are SLERPed onto the video frames instead (frame times from the frame rate, nothing decoded).
+
+usage:
+    python -m gopro2gpx.orientation GH010198.MP4                   # -> GH010198_orientation.mat/.csv
+    python -m gopro2gpx.orientation --per_frame GH010198.MP4 -o angles.csv
+"""
+
+import argparse
+import logging
+import struct
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from . import fourCC
+from .api import iter_devc
+from .geodesy import slerp_quaternions
+from .klv_extraction import orientation_angles
+from .scan import scan_headers
+
+ORIENTATION_LABELS = ('CORI', 'IORI')
+
+_WANTED = [b'STRM', b'SCAL'] + [label.encode() for label in ORIENTATION_LABELS]
+
+
+def scan_orientation(raw):
+    """
+    the (label, quaternions) blocks of one DEVC, quaternions as scaled (n, 4) (qw, qx, qy, qz) arrays.
+    everything else is skipped by header
+    """
+    headers, end = scan_headers(raw)
+    if end < len(raw):
+        logging.getLogger(__name__).warning(f'Truncated DEVC in orientation scan, {len(raw) - end} bytes ignored')
+
+    blocks = []
+    scale = 1.0
+    for header in headers[np.isin(headers['fourCC'], _WANTED)]:
+        name = header['fourCC'].decode('latin-1')
+        if name == 'STRM':
+            scale = 1.0
+            continue
+
+        offset = int(header['offset']) + 8
+        length = int(header['size']) * int(header['repeat'])
+        if not length:
+            continue
+        dtype = np.dtype(fourCC.complex_types[chr(header['type'])])
+        values = np.frombuffer(raw, dtype=dtype, count=length // dtype.itemsize, offset=offset).astype(float)
+        if name == 'SCAL':
+            scale = values[0] if len(values) == 1 else values
+        else:
+            blocks.append((name, values.reshape(int(header['repeat']), -1) / scale))
+    return blocks
+
+
+def read_quaternions(source):
+    """
+    {'CORI': (times, quaternions), 'IORI': (times, quaternions)} of source (a video, a .bin dump, or anything
+    api.iter_devc() accepts). times are seconds from the start of the clip, or DEVC counts for raw dumps
+    """
+    found = {label: ([], []) for label in ORIENTATION_LABELS}
+    slot = 0.0
+    for raw, time, duration in iter_devc(source):
+        start = slot if time is None else time
+        duration = duration or 1.0
+        for label, q in scan_orientation(raw):
+            times, quats = found[label]
+            times.append(start + np.arange(len(q)) * (duration / len(q)))
+            quats.append(q)
+        slot = start + duration
+
+    return {label: (np.concatenate(t) if t else np.zeros(0), np.concatenate(q) if q else np.zeros((0, 4)))
+            for label, (t, q) in found.items()}
+
+
+def frame_times(source):
+    """
+    presentation time of every video frame, from the frame count and rate of the container (nothing is decoded)
+    """
+    import av
+
+    with av.open(str(source)) as container:
+        stream = container.streams.video[0]
+        start = float(stream.start_time * stream.time_base) if stream.start_time is not None else 0.0
+        return start + np.arange(stream.frames) / float(stream.average_rate)
+
+
+def _resample(times, q, new_times):
+    if len(q) == 0:
+        return np.zeros((len(new_times), 4))
+    return slerp_quaternions(new_times, times, q)
+
+
+def read_orientation(source, per_frame=False):
+    """
+    the orientation of source as a dict of arrays: 'time', the camera and image quaternions (c_qw..c_qz,
+    i_qw..i_qz) and the rel_net_*, cam_rel_* and img_rel_* angles of read_video(). samples are on the CORI
+    timeline, or on the video frames with per_frame=True
+    """
+    quats = read_quaternions(source)
+    t_cori, q_cori = quats['CORI']
+    t_iori, q_iori = quats['IORI']
+
+    if per_frame:
+        times = frame_times(source)
+    else:
+        times = t_cori if len(t_cori) else t_iori
+
+    # usually both streams run at the frame rate, sample for sample, and there is nothing to resample
+    if per_frame or not np.array_equal(t_cori, t_iori):
+        q_cori = _resample(t_cori, q_cori, times)
+        q_iori = _resample(t_iori, q_iori, times)
+
+    result = {'index': np.arange(len(times), dtype=float), 'time': times}
+    for prefix, q in (('c_', q_cori), ('i_', q_iori)):
+        for column, name in enumerate(('qw', 'qx', 'qy', 'qz')):
+            result[prefix + name] = q[:, column]
+    result.update(orientation_angles(result))
+    return result
+
+
+def _klv(label, ktype, size, repeat, payload):
+    header = struct.pack('>4sBBH', label, ord(ktype) if ktype else 0, size, repeat)
+    return header + payload + b'\0' * (-len(payload) % 4)
+
+
+class OrientationTest(unittest.TestCase):
+    def _quaternions(self, rng, n):
+        q = rng.normal(size=(n, 4))
+        return q / np.linalg.norm(q, axis=1, keepdims=True)
+
+    def _stream(self, label, q, scale):
+        # SCAL, then the quaternions as int16, like the cameras write them
+        payload = _klv(b'SCAL', 's', 2, 1, struct.pack('>h', scale)) + _klv(label, 's', 8, len(q), (
+            np.round(q * scale).astype('>i2').tobytes()))
+        return _klv(b'STRM', None, 1, len(payload), payload)
+
+    def _clip(self, n_cori, n_iori, devcs=3):
+        rng = np.random.default_rng(0)
+        raw = b''
+        for _ in range(devcs):
+            # an ACCL stream with its own SCAL first: skipped, and its SCAL doesn't leak into the next stream
+            accl = _klv(b'SCAL', 's', 2, 1, struct.pack('>h', 418)) + _klv(b'ACCL', 's', 6, 5, bytes(30))
+            payload = (_klv(b'STRM', None, 1, len(accl), accl) +
+                       self._stream(b'CORI', self._quaternions(rng, n_cori), 32767) +
+                       self._stream(b'IORI', self._quaternions(rng, n_iori), 16384))
+            raw += _klv(b'DEVC', None, 1, len(payload), payload)
+        return raw
+
+    def _reference(self, raw):
+        from .gopro2gpx import BuildOrientations
+        from .klv_extraction import parseStream
+
+        cori, iori = BuildOrientations(parseStream(raw)[0])
+        return np.array(cori), np.array(iori)
+
+    def test_quaternions(self):
+        raw = self._clip(4, 4)
+        cori, iori = self._reference(raw)
+        quats = read_quaternions([raw[i:i + 7] for i in range(0, len(raw), 7)])
+
+        np.testing.assert_allclose(quats['CORI'][1], cori)
+        np.testing.assert_allclose(quats['IORI'][1], iori)
+        # spread evenly over their DEVC, one second each
+        np.testing.assert_allclose(quats['CORI'][0], np.arange(12) / 4)
+        np.testing.assert_array_equal(quats['CORI'][0], quats['IORI'][0])
+
+    def test_angles(self):
+        raw = self._clip(4, 4)
+        cori, iori = self._reference(raw)
+        reference = {'c_' + name: cori[:, i] for i, name in enumerate(('qw', 'qx', 'qy', 'qz'))}
+        reference.update({'i_' + name: iori[:, i] for i, name in enumerate(('qw', 'qx', 'qy', 'qz'))})
+        reference.update(orientation_angles(reference))
+
+        result = read_orientation(raw)
+        self.assertEqual(set(reference) - set(result), set())
+        for key, values in reference.items():
+            np.testing.assert_allclose(result[key], values, err_msg=key)
+
+    def test_resampled(self):
+        # IORI at half the rate of CORI: it is SLERPed onto the CORI timeline
+        raw = self._clip(4, 2)
+        cori, iori = self._reference(raw)
+        result = read_orientation(raw)
+
+        np.testing.assert_allclose(result['time'], np.arange(12) / 4)
+        q_cori = np.column_stack([result['c_' + name] for name in ('qw', 'qx', 'qy', 'qz')])
+        q_iori = np.column_stack([result['i_' + name] for name in ('qw', 'qx', 'qy', 'qz')])
+        # the same rotations, up to the norm and the sign
+        cori /= np.linalg.norm(cori, axis=1, keepdims=True)
+        iori /= np.linalg.norm(iori, axis=1, keepdims=True)
+        np.testing.assert_allclose(np.abs(np.sum(q_cori * cori, axis=1)), 1.0)
+        np.testing.assert_allclose(np.abs(np.sum(q_iori[::2] * iori, axis=1)), 1.0)
+        self.assertEqual(len(result['rel_net_az']), 12)
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="extract only the camera and image orientation of a GoPro video")
+    parser.add_argument("source", help="GoPro video file (.mp4) or binary metadata dump (.bin)", type=Path)
+    parser.add_argument("-o", "--output", type=Path,
+                        help="output .mat or .csv file (default: both, next to the source)")
+    parser.add_argument("--per_frame", action="store_true", default=False,
+                        help="one row per video frame instead of one per CORI sample")
+    parser.add_argument('-l', '--loglevel', default='info',
+                        help='Provide logging level. Example --loglevel debug')
+    return parser.parse_args()
+
+
+def main():
+    from .klv_extraction import write_full_csv, write_mat
+
+    args = parseArgs()
+    logging.basicConfig(level=args.loglevel.upper())
+    logger = logging.getLogger(__name__)
+
+    angles = read_orientation(args.source, per_frame=args.per_frame)
+    logger.info(f'{len(angles["time"])} orientation samples in {str(args.source)}')
+
+    if args.output is not None:
+        outputs = [args.output]
+    else:
+        base = args.source.with_name(args.source.stem + "_orientation")
+        outputs = [base.with_suffix(".mat"), base.with_suffix(".csv")]
+    for output in outputs:
+        logger.info(f'Writing {str(output)}')
+        if output.suffix.lower() == '.mat':
+            write_mat(output, angles)
+        else:
+            write_full_csv(output, angles)
+
+
+if __name__ == "__main__":
+    main()
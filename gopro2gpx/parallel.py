@@ -0,0 +1,173 @@
+"""
+parallel parsing of one long GPMF track.
+
+every top level DEVC holds about a second of telemetry and carries its own stream metadata (SCAL, TYPE, GPSU, GPSF...),
+so the track can be cut at DEVC boundaries, the pieces parsed (parseStream + GPSPointBuilder) in a process pool, and
+the results put back together in order. a two hour clip then uses every core instead of one.
+
+    klvlist, points = parse_parallel(raw, jobs=8, skip=True)
+    _, points = parse_parallel(raw, jobs=8, keep_klv=False)    # only the points come back from the workers
+"""
+
+import concurrent.futures
+import logging
+import os
+import struct
+import unittest
+from pathlib import Path
+
+from .gopro2gpx import GPSPointBuilder
+from .gpshelper import GPSPoint
+from .klv_extraction import parseStream
+
+_HEADER = struct.Struct('>4sBBH')
+
+# tasks per worker: enough to even out DEVC of different sizes, few enough to keep the pickling overhead low
+TASKS_PER_JOB = 4
+
+
+def devc_boundaries(data):
+    """
+    (start, end) of every top level KLV of data. a truncated last block ends at len(data)
+    """
+    blocks = []
+    offset = 0
+    end = len(data)
+    while offset + _HEADER.size <= end:
+        _, _, size, repeat = _HEADER.unpack_from(data, offset)
+        block_end = min(offset + _HEADER.size + (-(-size * repeat // 4) * 4), end)
+        blocks.append((offset, block_end))
+        offset = block_end
+    if offset < end:
+        blocks.append((offset, end))
+    return blocks
+
+
+def split(data, pieces):
+    """
+    cut data at DEVC boundaries into at most `pieces` pieces of similar size
+    """
+    blocks = devc_boundaries(data)
+    if not blocks:
+        return []
+    target = max(len(data) // max(pieces, 1), 1)
+    chunks = []
+    start = blocks[0][0]
+    for _, block_end in blocks:
+        if block_end - start >= target:
+            chunks.append(data[start:block_end])
+            start = block_end
+    if start < len(data):
+        chunks.append(data[start:])
+    return chunks
+
+
+# the labels GPSPointBuilder keeps between DEVC, and the ones each kind of point needs to have seen first
+STATE_LABELS = ('SCAL', 'GPSU', 'GPSF', 'GPSP', 'SYST')
+_NEEDS = {'GPS5': {'SCAL', 'GPSU', 'GPSF'}, 'GPRI': {'SCAL', 'GPSF', 'SYST'}}
+
+
+def self_contained(klvlist):
+    """
+    True if the points of klvlist don't depend on the state left by the data before it
+    """
+    seen = set()
+    for klv in klvlist:
+        if klv.fourCC in _NEEDS and not _NEEDS[klv.fourCC] <= seen:
+            return False
+        seen.add(klv.fourCC)
+    return True
+
+
+def _point_rows(points):
+    # GPSPoint -> plain tuples: a fraction of the pickling cost of the objects
+    return [(p.latitude, p.longitude, p.elevation, p.time, p.speed, p.dop, p.fix) for p in points]
+
+
+def _points(rows):
+    points = []
+    for latitude, longitude, elevation, timestamp, speed, dop, fix in rows:
+        p = GPSPoint(latitude, longitude, elevation, timestamp, speed)
+        p.dop = dop
+        p.fix = fix
+        points.append(p)
+    return points
+
+
+def _parse_piece(piece, skip, keep_klv):
+    """
+    runs in a worker. only what the parent needs comes back: the points as tuples, the builder stats, the state
+    labels, and the KLVs themselves only when keep_klv (pickling them back costs about as much as parsing them)
+    """
+    klvlist, _ = parseStream(piece)
+    contained = self_contained(klvlist)
+    if not contained:
+        # the parent redoes this piece in sequence
+        return (klvlist if keep_klv else None), None, None, None, [], False
+    builder = GPSPointBuilder(skip=skip)
+    rows = _point_rows(builder.add(klvlist))
+    state = [klv for klv in klvlist if klv.fourCC in STATE_LABELS]
+    return (klvlist if keep_klv else None), rows, builder.stats, builder.time_offset, state, True
+
+
+def parse_parallel(data, jobs=None, skip=False, keep_klv=True):
+    """
+    parse a whole GPMF track with `jobs` processes. returns (klvlist, points), the same as
+    parseStream(data) and BuildGPSPoints(klvlist, skip). with keep_klv=False only the points are sent back from the
+    workers and klvlist is None: much faster when the KLVs aren't needed (no stream outputs)
+    """
+    jobs = jobs or os.cpu_count() or 1
+    pieces = split(data, jobs * TASKS_PER_JOB)
+    logging.getLogger(__name__).debug(f'Parsing {len(data)} bytes in {len(pieces)} pieces with {jobs} processes')
+
+    klvlist = [] if keep_klv else None
+    points = []
+    # the state of a serial GPSPointBuilder at the start of every piece
+    carried = GPSPointBuilder(skip=skip)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        # map() hands the results back in the order of the pieces
+        results = pool.map(_parse_piece, pieces, [skip] * len(pieces), [keep_klv] * len(pieces))
+        for piece, (piece_klv, rows, stats, time_offset, state, contained) in zip(pieces, results):
+            if keep_klv:
+                klvlist.extend(piece_klv)
+            if contained:
+                points.extend(_points(rows))
+                for key, count in stats.items():
+                    carried.stats[key] += count
+                carried.add(state)
+                carried.time_offset = time_offset
+            else:
+                # e.g. Karma GPRI using the SYST of an earlier DEVC: redo this piece in sequence
+                if piece_klv is None:
+                    piece_klv, _ = parseStream(piece)
+                points.extend(carried.add(piece_klv))
+    carried.log_stats()
+    return klvlist, points
+
+
+def _serial(data, skip):
+    klvlist, _ = parseStream(data)
+    return klvlist, GPSPointBuilder(skip=skip).add(klvlist)
+
+
+class ParallelTest(unittest.TestCase):
+    SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+
+    def assertSamePoints(self, points, expected):
+        self.assertEqual(_point_rows(points), _point_rows(expected))
+
+    def test_same_as_serial(self):
+        for name in ('hero6', 'gopro7', 'karma'):
+            data = (self.SAMPLES / f'{name}.bin').read_bytes() * 5
+            klvlist, expected = _serial(data, skip=False)
+            parallel_klv, points = parse_parallel(data, jobs=2)
+            self.assertSamePoints(points, expected)
+            self.assertEqual([(k.fourCC, k.rawdata) for k in parallel_klv], [(k.fourCC, k.rawdata) for k in klvlist])
+
+            none, points = parse_parallel(data, jobs=2, skip=True, keep_klv=False)
+            self.assertIsNone(none)
+            self.assertSamePoints(points, _serial(data, skip=True)[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
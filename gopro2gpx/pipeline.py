@@ -0,0 +1,246 @@
+"""
+asyncio pipeline for batches of videos.
+
+read_video() handles one clip strictly in sequence: demux, parse, interpolate and then write every output one after
+the other. on network storage most of that wall time is spent waiting for I/O, so here every clip is split into
+stages connected by bounded queues:
+
+    demux + count frames (thread) -> parse GPMF (thread) -> FrameInfoBuilder -> writers (thread pool, concurrently)
+
+and several clips run at the same time, so a batch keeps both the disks and the CPU busy. the outputs are exactly
+the ones read_video() writes.
+
+usage:
+    python -m gopro2gpx.pipeline -j 4 GH010198.MP4 GH010199.MP4 GH010200.MP4
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import unittest
+from pathlib import Path
+
+from .config import DEFAULT_MEMORY_LIMIT
+from .klv_extraction import FrameInfoBuilder, find_gpmf_stream, output_writers, parseStream, resolve_outputs
+
+# end of stream marker for the queues
+_DONE = object()
+
+
+def _demux(source, max_frames, loop, queue, stop, batch_size=256):
+    """
+    runs in a worker thread: demux the container and push ('frames', [(index, time), ...]) batches and
+    ('gpmf', bytes) packets onto the asyncio queue, in container order
+    """
+    import av
+
+    def put(item):
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                return future.result(timeout=0.5)
+            except concurrent.futures.TimeoutError:
+                if stop.is_set():
+                    future.cancel()
+                    raise asyncio.CancelledError()
+
+    frame_count = 0
+    frames = []
+    try:
+        with av.open(str(source)) as container:
+            put(('n_frames', container.streams.video[0].frames))
+            gpmf_stream = find_gpmf_stream(container)
+
+            for packet in container.demux():
+                if packet.dts is None:
+                    continue
+                if max_frames is not None and frame_count >= max_frames:
+                    break
+
+                if packet.stream.type == 'video':
+                    for frame in packet.decode():
+                        frames.append((getattr(frame, 'index', frame_count), frame.time))
+                        frame_count += 1
+                    if len(frames) >= batch_size:
+                        put(('frames', frames))
+                        frames = []
+                elif packet.stream.index == gpmf_stream.index:
+                    # the frames seen so far must reach the builder before the GPMF data that follows them
+                    if frames:
+                        put(('frames', frames))
+                        frames = []
+                    put(('gpmf', bytes(packet)))
+
+        if frames:
+            put(('frames', frames))
+    finally:
+        if not stop.is_set():
+            put(_DONE)
+
+
+async def _parse(loop, pool, raw_queue, klv_queue):
+    unread_bytes = bytes()
+    while True:
+        item = await raw_queue.get()
+        if item is not _DONE and item[0] == 'gpmf':
+            klv, unread_bytes = await loop.run_in_executor(pool, parseStream, unread_bytes + item[1])
+            item = ('klv', klv)
+        await klv_queue.put(item)
+        if item is _DONE:
+            return
+
+
+async def _build(klv_queue, skip, memory_limit):
+    builder = None
+    while True:
+        item = await klv_queue.get()
+        if item is _DONE:
+            return builder
+
+        kind, payload = item
+        if kind == 'n_frames':
+            builder = FrameInfoBuilder(payload, skip=skip, memory_limit=memory_limit)
+        elif kind == 'frames':
+            for index, time in payload:
+                builder.add_frame(index, time)
+        else:
+            builder.add_klv(payload)
+
+
+async def process_video(args, pool, queue_size=64, demux_pool=None):
+    """
+    the asynchronous equivalent of read_video(args). the demuxer blocks its thread until the parser has room in the
+    queue, so it runs in demux_pool, never in pool where the parser waits for a thread: with a shared pool, clips
+    demuxing on every thread would deadlock. without demux_pool the clip gets a thread of its own
+    """
+    if demux_pool is None:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as demux_pool:
+            return await process_video(args, pool, queue_size, demux_pool)
+
+    logger = logging.getLogger(__name__)
+    loop = asyncio.get_running_loop()
+    raw_queue = asyncio.Queue(queue_size)
+    klv_queue = asyncio.Queue(queue_size)
+    stop = threading.Event()
+
+    logger.info(f'Opening video file {str(args.video_file)}')
+    reader = loop.run_in_executor(demux_pool, _demux, args.video_file, args.max_frames, loop, raw_queue, stop)
+    try:
+        _, _, builder = await asyncio.gather(reader,
+                                             _parse(loop, pool, raw_queue, klv_queue),
+                                             _build(klv_queue, args.skip, args.memory_limit * 1024 * 1024))
+    except BaseException:
+        # unblock the reader thread if one of the consumers died
+        stop.set()
+        raise
+
+    frame_info = await loop.run_in_executor(pool, builder.finish)
+    logger.info(f'Finished reading {builder.frame_count} frames from {str(args.video_file)}')
+
+    resolve_outputs(args)
+    writers = output_writers(args, frame_info, builder.all_points)
+    for description, _, writer_args in writers:
+        logger.info(f'Writing {description}: {str(writer_args[0])}')
+    await asyncio.gather(*[loop.run_in_executor(pool, writer, *writer_args) for _, writer, writer_args in writers])
+    return args
+
+
+async def process_videos(args_list, jobs=2, threads=None, queue_size=64):
+    """
+    run process_video() on every item of args_list, at most `jobs` clips at a time, with `threads` threads besides
+    the demuxers. returns one entry per clip: its args, or the exception that stopped it
+    """
+    logger = logging.getLogger(__name__)
+    semaphore = asyncio.Semaphore(jobs)
+    # one demuxing thread per running clip, apart from the threads parsing, finishing and writing (up to five per
+    # clip), so that any number of threads makes progress
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as demux_pool, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=threads or jobs * 5) as pool:
+
+        async def run(args):
+            async with semaphore:
+                try:
+                    return await process_video(args, pool, queue_size, demux_pool)
+                except Exception as e:
+                    logger.error(f'Failed to process {str(args.video_file)}: {e}')
+                    return e
+
+        return await asyncio.gather(*[run(args) for args in args_list])
+
+
+class PipelineTest(unittest.TestCase):
+    SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+
+    def setUp(self):
+        # not a decorator: it would import PyAV with the module
+        from .testing import can_write_test_video
+        if not can_write_test_video():
+            self.skipTest('needs PyAV 13 or later to write the test videos')
+
+    def _args(self, video_file, output):
+        return argparse.Namespace(video_file=video_file, max_frames=None, skip=False, simplify=None, max_points=None,
+                                  memory_limit=DEFAULT_MEMORY_LIMIT // (1024 * 1024),
+                                  output_mat_file=output.with_suffix('.mat'), output_full_csv=output.with_suffix('.csv'),
+                                  output_pix4d_csv=None, output_kml=output.with_suffix('.kml'), output_streams=None,
+                                  output_sidecar=None, recover=False, output_images=None)
+
+    def test_few_threads(self):
+        import tempfile
+        from .testing import write_test_video
+        from .klv_extraction import read_video
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            videos = []
+            for name in ('hero6', 'hero5'):
+                videos.append(tmp / f'{name}.mp4')
+                write_test_video(videos[-1], (self.SAMPLES / f'{name}.bin').read_bytes(), fps=5)
+            # two clips demuxing at once, two threads for everything else, and queues that fill up: the demuxers
+            # used to take both threads and wait forever for the parsers
+            results = asyncio.run(process_videos([self._args(v, tmp / f'{v.stem}.async') for v in videos],
+                                                 jobs=2, threads=2, queue_size=2))
+            self.assertFalse([r for r in results if isinstance(r, Exception)])
+            for video in videos:
+                read_video(self._args(video, tmp / f'{video.stem}.sync'))
+                for suffix in ('.csv', '.kml'):
+                    self.assertEqual((tmp / f'{video.stem}.async').with_suffix(suffix).read_text(),
+                                     (tmp / f'{video.stem}.sync').with_suffix(suffix).read_text())
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="extract the metadata of many GoPro videos concurrently")
+    parser.add_argument("-j", "--jobs", type=int, default=2, help="number of clips processed at the same time")
+    parser.add_argument("-n", "--max_frames", nargs='?', type=int, help="stop after processing N frames (optional)")
+    parser.add_argument("-s", "--skip", help="Skip bad points (GPSFIX=0)", action="store_true", default=False)
+    parser.add_argument("--simplify", type=float, metavar="METRES",
+                        help="simplify the KML track to this tolerance in metres (optional)")
+    parser.add_argument("--max_points", type=int, help="limit the KML track to N points (optional)")
+    parser.add_argument("--memory_limit", type=int, default=DEFAULT_MEMORY_LIMIT // (1024 * 1024), metavar="MB",
+                        help="per clip, spill the accumulated metadata to temporary files past this many MB")
+    parser.add_argument('-l', '--loglevel', default='info',
+                        help='Provide logging level. Example --loglevel debug')
+    parser.add_argument("video_files", nargs='+', help="GoPro Video files (.mp4)", type=Path)
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    logging.basicConfig(level=args.loglevel.upper())
+
+    # every clip gets the same options as klv_extraction, with the outputs written next to the video
+    args_list = [argparse.Namespace(video_file=f, max_frames=args.max_frames, skip=args.skip,
+                                    simplify=args.simplify, max_points=args.max_points,
+                                    memory_limit=args.memory_limit,
+                                    output_mat_file=None, output_full_csv=None, output_pix4d_csv=None,
+                                    output_kml=None, output_streams=None, output_sidecar=None, recover=False,
+                                    output_images=None)
+                 for f in args.video_files]
+    results = asyncio.run(process_videos(args_list, jobs=args.jobs))
+    failed = sum(isinstance(r, Exception) for r in results)
+    logging.getLogger(__name__).info(f'Finished {len(results) - failed} of {len(results)} videos')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""
+quick look at a clip: a coarse GPS track (one point per second) and its bounding box, reading as little as possible.
+
+a full parse reads every byte of the GPMF track and decodes every label. for triage one position per DEVC (~1 s) is
+enough, so this walks the KLV headers only: the payloads of the other streams (ACCL, GYRO, CORI...) are skipped by
+their offset, the SCAL, GPSU, GPSF and GPSP of the GPS stream are read, and only the first sample of its GPS5. once
+that is decoded the rest of the DEVC is skipped. in a video the GPMF samples are located with the MP4 sample table
+(backends.NativeBackend), so the video data is never touched either: a few hundred bytes are read per second of
+video, in small reads, which is what matters on network storage.
+
+the points are the first point of every DEVC of the full parse, as gpshelper.GPSPoint, so the gpshelper writers work
+on them (gopro2gpx --preview). Karma clips (GPRI instead of GPS5) have no preview.
+
+usage:
+    python -m gopro2gpx.preview GH010198.MP4                 # summary: time range, bounding box, bytes read
+    python -m gopro2gpx.preview GH010198.MP4 -o GH010198.gpx # and the coarse track
+"""
+
+import argparse
+import collections
+import logging
+import os
+import struct
+import unittest
+from datetime import timedelta
+from pathlib import Path
+
+from . import gpshelper
+from .backends import NativeBackend, UnsupportedContainer, read_track
+from .klvdata import KLVData
+
+Preview = collections.namedtuple("Preview", "points start end bbox bytes_read size")
+
+# the labels of the GPS stream the points need, besides GPS5
+GPS_STATE = ('SCAL', 'GPSU', 'GPSF', 'GPSP')
+
+_HEADER = struct.Struct('>4sBBH')
+
+
+class _FileReader:
+    # unbuffered, so skipping a payload doesn't read it anyway into a buffer
+    def __init__(self, path):
+        self.fd = open(path, 'rb', buffering=0)
+        self.bytes_read = 0
+
+    def read(self, offset, n):
+        self.fd.seek(offset)
+        data = self.fd.read(n)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self.fd.close()
+
+
+class _BufferReader:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.bytes_read = 0
+
+    def read(self, offset, n):
+        data = bytes(self.data[offset:offset + n])
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+def _pad(n):
+    return -(-n // 4) * 4
+
+
+def _headers(reader, start, end):
+    # (fourCC, type, size, repeat, header offset) of the KLVs in [start, end), not walking into the nested ones
+    offset = start
+    while offset + 8 <= end:
+        header = reader.read(offset, 8)
+        if len(header) < 8:
+            return
+        label, kind, size, repeat = _HEADER.unpack(header)
+        length = size * repeat
+        if offset + 8 + _pad(length) > end:
+            # truncated KLV, like the type == -1 of KLVData
+            return
+        yield label, kind, size, repeat, offset
+        offset += 8 + _pad(length)
+
+
+class PreviewBuilder:
+    """
+    the first GPS5 sample of every DEVC, as the points of GPSPointBuilder. the fix and precision are kept from DEVC to
+    DEVC, like GPSPointBuilder does
+    """
+
+    def __init__(self, skip=False):
+        self.skip = skip
+        self.state = {}
+        self.points = []
+
+    def _decode(self, reader, offset, size, repeat):
+        data = reader.read(offset, 8 + _pad(size * repeat))
+        return KLVData(data, 0).data
+
+    def add_stream(self, reader, start, end):
+        """
+        walk the labels of a STRM. True if it had GPS data (then the DEVC is done)
+        """
+        found = {}
+        for label, kind, size, repeat, offset in _headers(reader, start, end):
+            if label == b'GPS5':
+                if repeat == 0:
+                    continue
+                # only the first sample: the header rewritten with repeat = 1
+                header = _HEADER.pack(label, kind, size, 1)
+                sample = KLVData(header + reader.read(offset + 8, _pad(size)), 0).data[0]
+                for name, found_at in found.items():
+                    self.state[name] = self._decode(reader, *found_at)
+                self._add_point(sample)
+                return True
+            name = label.decode('latin-1')
+            if name in GPS_STATE:
+                # decoded only if this turns out to be the GPS stream
+                found[name] = (offset, size, repeat)
+        return False
+
+    def add_devc(self, reader, start, end):
+        for label, kind, size, repeat, offset in _headers(reader, start, end):
+            if label == b'STRM' and kind == 0 and self.add_stream(reader, offset + 8, offset + 8 + size * repeat):
+                return
+
+    def add(self, reader, start, end):
+        """
+        every DEVC in [start, end) of the reader
+        """
+        for label, kind, size, repeat, offset in _headers(reader, start, end):
+            if label == b'DEVC' and kind == 0:
+                self.add_devc(reader, offset + 8, offset + 8 + size * repeat)
+
+    def _add_point(self, sample):
+        logger = logging.getLogger(__name__)
+        if 'GPSU' not in self.state:
+            logger.debug('GPS5 before any GPSU, skipped')
+            return
+        if sample.lon == sample.lat == sample.alt == 0:
+            return
+        fix = self.state.get('GPSF', 0)
+        if fix == 0 and self.skip:
+            return
+        scale = self.state.get('SCAL', (1.0,) * 5)
+        if not isinstance(scale, (list, tuple)):
+            scale = (scale,) * 5
+        lat, lon, alt, speed, _ = [float(x) / float(y) for x, y in zip(sample._asdict().values(), list(scale))]
+        # the time GPSPointBuilder gives the first point of the block
+        p = gpshelper.GPSPoint(lat, lon, alt, self.state['GPSU'] + timedelta(milliseconds=1000.0 / 18), speed)
+        p.fix = fix
+        p.dop = self.state['GPSP'] / 100.0 if 'GPSP' in self.state else None
+        self.points.append(p)
+
+
+def _is_video(path):
+    with open(path, 'rb') as fd:
+        return fd.read(8)[4:8] == b'ftyp'
+
+
+def preview(source, skip=False, backend='auto', config=None):
+    """
+    the Preview of a video (.mp4) or a binary metadata dump (.bin): the coarse track, its first and last time, its
+    bounding box (min_lat, min_lon, max_lat, max_lon, or None), and how many GPMF bytes were read out of the size of
+    the file (the MP4 sample table aside)
+    """
+    source = Path(source)
+    size = os.path.getsize(source)
+    builder = PreviewBuilder(skip=skip)
+
+    if not _is_video(source):
+        regions = [(0, size)]
+        reader = _FileReader(source)
+    else:
+        reader = _FileReader(source)
+        try:
+            if backend not in ('auto', 'native'):
+                raise UnsupportedContainer(f'{backend} requested')
+            regions = [(offset, offset + length) for offset, length, _, _ in NativeBackend().sample_table(reader.fd)]
+        except UnsupportedContainer as e:
+            # no sample table to seek with: read the whole track with another backend, still decoding one sample
+            # per DEVC
+            logging.getLogger(__name__).debug(f'{source}: {e}, reading the whole GPMF track')
+            reader.close()
+            reader = _BufferReader(read_track(source, 'auto' if backend == 'native' else backend, config))
+            regions = [(0, len(reader.data))]
+
+    try:
+        for start, end in regions:
+            builder.add(reader, start, end)
+    finally:
+        reader.close()
+
+    points = builder.points
+    bbox = None
+    if points:
+        lats = [p.latitude for p in points]
+        lons = [p.longitude for p in points]
+        bbox = (min(lats), min(lons), max(lats), max(lons))
+    return Preview(points, points[0].time if points else None, points[-1].time if points else None, bbox,
+                   reader.bytes_read, size)
+
+
+def format_preview(source, result):
+    lines = ["%s: %d points" % (source, len(result.points))]
+    if result.points:
+        lines.append("time: %s - %s (%s)" % (result.start.isoformat(), result.end.isoformat(), result.end - result.start))
+        lines.append("bbox: %.6f,%.6f,%.6f,%.6f (min lat, min lon, max lat, max lon)" % result.bbox)
+    lines.append("read %d of %d bytes (%.3f%%)" % (result.bytes_read, result.size,
+                                                   100.0 * result.bytes_read / max(result.size, 1)))
+    return "\n".join(lines)
+
+
+class PreviewTest(unittest.TestCase):
+    SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+
+    def _first_points(self, path):
+        # the first point of every DEVC of the full parse
+        from .api import iter_devc
+        from .gopro2gpx import GPSPointBuilder
+        from .klv_extraction import parseStream
+
+        builder = GPSPointBuilder()
+        first = []
+        for raw, _, _ in iter_devc(path):
+            points = builder.add(parseStream(raw)[0])
+            first.extend(points[:1])
+        return first
+
+    def _key(self, points):
+        return [(p.latitude, p.longitude, p.elevation, p.time, p.speed, p.fix, p.dop) for p in points]
+
+    def test_samples(self):
+        for name in ('hero5.bin', 'hero6.bin', 'gopro7.bin'):
+            with self.subTest(name=name):
+                path = self.SAMPLES / name
+                result = preview(path)
+                expected = self._first_points(path)
+                self.assertGreater(len(expected), 10)
+                self.assertEqual(self._key(result.points), self._key(expected))
+                self.assertEqual((result.start, result.end), (expected[0].time, expected[-1].time))
+                lats = [p.latitude for p in expected]
+                self.assertEqual((result.bbox[0], result.bbox[2]), (min(lats), max(lats)))
+                # the headers, the GPS state and one GPS5 sample per DEVC
+                self.assertEqual(result.size, path.stat().st_size)
+                self.assertLess(result.bytes_read, result.size / 10)
+
+    def test_video(self):
+        import tempfile
+        from .testing import write_gpmf_mp4
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'hero6.mp4'
+            write_gpmf_mp4(path, (self.SAMPLES / 'hero6.bin').read_bytes())
+            result = preview(path)
+            self.assertEqual(self._key(result.points), self._key(preview(self.SAMPLES / 'hero6.bin').points))
+            self.assertLess(result.bytes_read, result.size / 10)
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="coarse GPS track and bounding box of GoPro clips, reading the minimum")
+    parser.add_argument("files", nargs='+', type=Path, help="GoPro video files (.mp4) or binary metadata dumps (.bin)")
+    parser.add_argument("-o", "--output", type=Path, help="write the coarse track of the (single) file as .gpx, .kml or .csv")
+    parser.add_argument("-s", "--skip", help="Skip bad points (GPSFIX=0)", action="store_true", default=False)
+    parser.add_argument('-l', '--loglevel', default='warning', help='Provide logging level. Example --loglevel debug')
+    args = parser.parse_args()
+    if args.output and len(args.files) > 1:
+        parser.error("--output needs a single file")
+    return args
+
+
+def main():
+    args = parseArgs()
+    logging.basicConfig(level=args.loglevel.upper())
+
+    for f in args.files:
+        result = preview(f, skip=args.skip)
+        print(format_preview(f, result))
+
+    if args.output and result.points:
+        writers = {'.gpx': lambda points: gpshelper.generate_GPX(points, trk_name=args.files[0].stem),
+                   '.kml': gpshelper.generate_KML, '.csv': gpshelper.generate_CSV}
+        writer = writers.get(args.output.suffix.lower(), writers['.gpx'])
+        with open(args.output, "w+") as fd:
+            fd.write(writer(result.points))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""
+recovery mode for damaged GPMF data (bad sectors, truncated recordings, half-written files).
+
+the normal parser trusts every header: a garbage length sends the offset anywhere, and a decoder exception (e.g.
+"Invalid length for ACCL packet") aborts the whole file. here every header is validated against the bounds of the
+DEVC and STRM that contain it, and damage costs as little as possible:
+
+  * a KLV whose decoder fails is dropped, the rest of its stream is kept
+  * an invalid header inside a STRM drops the rest of that STRM, and inside a DEVC the rest of that DEVC
+  * garbage between top level blocks is skipped by searching for the next valid DEVC header (bytes.find)
+
+every dropped byte range is recorded in a DamageReport, with its offset in the GPMF stream and the reason. the bytes a
+DEVC cut short by the end of the data should still have had were never on disk: they are recorded apart, as missing.
+"""
+
+import array
+import collections
+import logging
+import struct
+import unittest
+from pathlib import Path
+
+from . import fourCC
+from .klvdata import KLVData
+
+_HEADER = struct.Struct('>4sBBH')
+
+# fourCCs are printable: upper/lower case letters, digits and spaces
+_LABEL_BYTES = frozenset(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789 ')
+_TYPES = frozenset([0, ord('?')] + [ord(c) for c in fourCC.complex_types])
+
+# a top level DEVC covers about a second: anything much larger is a corrupted length
+MAX_DEVC_LENGTH = 4 * 1024 * 1024
+
+Loss = collections.namedtuple("Loss", "offset length label reason")
+
+
+class DamageReport:
+    """
+    what recovery had to drop. offsets are absolute in the GPMF stream, across every chunk parsed with this report
+    """
+
+    def __init__(self):
+        self.position = 0
+        self.losses = []
+        # what a truncated DEVC lacks: never written, so not skipped either
+        self.missing = []
+        self.devc_ok = 0
+        self.devc_damaged = 0
+
+    def lost(self, offset, length, label, reason):
+        self.losses.append(Loss(self.position + offset, length, label, reason))
+
+    def truncated(self, offset, length, label):
+        self.missing.append(Loss(self.position + offset, length, label, 'truncated at the end of the data'))
+
+    @property
+    def bytes_lost(self):
+        return sum(loss.length for loss in self.losses)
+
+    @property
+    def bytes_missing(self):
+        return sum(loss.length for loss in self.missing)
+
+    def __bool__(self):
+        return bool(self.losses or self.missing)
+
+    def summary(self):
+        summary = "%d DEVC recovered intact, %d damaged, %d bytes lost in %d places" % (
+            self.devc_ok, self.devc_damaged, self.bytes_lost, len(self.losses))
+        if self.missing:
+            summary += ", %d bytes missing at the end" % self.bytes_missing
+        return summary
+
+    def log(self, logger=None):
+        logger = logger or logging.getLogger(__name__)
+        for loss in self.losses:
+            logger.warning(f'Lost {loss.length} bytes at offset {loss.offset} ({loss.label}): {loss.reason}')
+        for loss in self.missing:
+            logger.warning(f'Missing {loss.length} bytes at offset {loss.offset} ({loss.label}): {loss.reason}')
+        (logger.warning if self.losses else logger.info)(f'Recovery: {self.summary()}')
+
+
+def _pad(n):
+    return -(-n // 4) * 4
+
+
+def valid_header(data, offset, end):
+    """
+    (label, type, size, repeat) if the 8 bytes at offset look like a KLV header that fits before end, else None
+    """
+    if end - offset < _HEADER.size:
+        return None
+    label, ktype, size, repeat = _HEADER.unpack_from(data, offset)
+    if ktype not in _TYPES or not all(c in _LABEL_BYTES for c in label):
+        return None
+    if offset + _HEADER.size + size * repeat > end:
+        return None
+    return label.decode('latin-1'), ktype, size, repeat
+
+
+def resync(data, start):
+    """
+    offset of the next plausible top level DEVC at or after start, or -1
+    """
+    offset = data.find(b'DEVC', start)
+    while 0 <= offset <= len(data) - 2 * _HEADER.size:
+        _, ktype, size, repeat = _HEADER.unpack_from(data, offset)
+        if ktype == 0 and 0 < size * repeat <= MAX_DEVC_LENGTH and valid_header(data, offset + 8, len(data)):
+            return offset
+        offset = data.find(b'DEVC', offset + 1)
+    return -1
+
+
+def parse_devc(data, start, end, report):
+    """
+    the KLVData of the DEVC at data[start:end], dropping only what is damaged.
+    returns (klvlist, end): the end is earlier than the one given if another DEVC starts inside this one
+    """
+    # the DEVC header itself was checked by the caller
+    klvlist = [KLVData(data, start)]
+    complex_type = None
+    strm_end = None
+    damaged = False
+    offset = start + _HEADER.size
+
+    while offset < end:
+        if strm_end is not None and offset >= strm_end:
+            strm_end = None
+        bound = strm_end or end
+        where = 'STRM' if strm_end else 'DEVC'
+
+        header = valid_header(data, offset, bound)
+        if header is None:
+            report.lost(offset, bound - offset, where, 'invalid KLV header, dropped the rest of the %s' % where)
+            damaged = True
+            offset = bound
+            continue
+
+        label, ktype, size, repeat = header
+        if ktype == 0:
+            if label == 'DEVC':
+                # the length of the enclosing DEVC was wrong, the next one starts here
+                report.devc_damaged += 1
+                return klvlist, offset
+            if label == 'STRM':
+                strm_end = offset + 8 + size * repeat
+            complex_type = None
+            klvlist.append(KLVData(data, offset, complex_type))
+            offset += 8
+            continue
+
+        klv_end = offset + 8 + _pad(size * repeat)
+        try:
+            klv = KLVData(data, offset, complex_type)
+        except Exception as e:
+            report.lost(offset, min(klv_end, bound) - offset, label, 'undecodable: %s' % e)
+            damaged = True
+            offset = min(klv_end, bound)
+            continue
+
+        if label == 'TYPE':
+            complex_type = klv.data
+        if not klv.skip():
+            klvlist.append(klv)
+        offset = min(klv_end, bound)
+
+    if damaged:
+        report.devc_damaged += 1
+    else:
+        report.devc_ok += 1
+    return klvlist, end
+
+
+def parse_recovering(data_raw, report, final=False):
+    """
+    like klv_extraction.parseStream(): returns (klvlist, unread bytes), with the unread bytes being an incomplete
+    DEVC at the end of data_raw. with final=True there is no more data coming, and that tail is reported as lost
+    """
+    data = array.array('b')
+    data.frombytes(data_raw)
+    klvlist = []
+    offset = 0
+    end = len(data_raw)
+
+    while offset < end:
+        if end - offset < _HEADER.size:
+            break
+        label, ktype, size, repeat = _HEADER.unpack_from(data_raw, offset)
+        length = 8 + _pad(size * repeat)
+        if label != b'DEVC' or ktype != 0 or length > MAX_DEVC_LENGTH + 8:
+            found = resync(data_raw, offset + 1)
+            if found < 0:
+                # keep a few bytes: a DEVC header may be split across chunks
+                found = end if final else max(end - 7, offset)
+                if found == offset:
+                    break
+            report.lost(offset, found - offset, 'DEVC', 'garbage instead of a DEVC header')
+            offset = found
+            continue
+        if offset + length > end:
+            if not final:
+                break
+            # the recording stopped in the middle of this DEVC: keep what made it to disk
+            report.truncated(end, offset + length - end, 'DEVC')
+            length = end - offset
+
+        devc, devc_end = parse_devc(data, offset, offset + length, report)
+        klvlist.extend(devc)
+        offset = devc_end
+
+    unread = data_raw[offset:]
+    if final and unread:
+        report.lost(offset, len(unread), 'DEVC', 'truncated at the end of the data')
+        offset = end
+        unread = bytes()
+    report.position += offset
+    return klvlist, unread
+
+
+class RecoveryTest(unittest.TestCase):
+    SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+
+    def _damaged(self):
+        data = bytearray((self.SAMPLES / 'hero6.bin').read_bytes())
+        # a GYRO label overwritten with bytes that aren't text, in the 3rd DEVC
+        self.gyro = data.find(b'GYRO', 9284)
+        data[self.gyro:self.gyro + 4] = b'\xff\xd8\xff\xe0'
+        # and the recording cut 100 bytes before the end of the last DEVC
+        return bytes(data[:-100])
+
+    def _key(self, klvlist):
+        return [(klv.fourCC, klv.rawdata) for klv in klvlist]
+
+    def test_damaged(self):
+        from .klv_extraction import parseStream
+
+        data = self._damaged()
+        self.assertRaises(UnicodeDecodeError, parseStream, data)
+
+        report = DamageReport()
+        klvlist, unread = parse_recovering(data, report, final=True)
+        self.assertEqual(unread, b'')
+
+        # everything but the damaged GYRO (the last KLV of its STRM) and the last STRM, cut short, is there
+        original, _ = parseStream((self.SAMPLES / 'hero6.bin').read_bytes())
+        damaged = [i for i, klv in enumerate(original) if klv.fourCC == 'GYRO'][2]
+        self.assertEqual([klv.fourCC for klv in original[-5:]], ['STRM', 'TSMP', 'TICK', 'STNM', 'WRGB'])
+        self.assertEqual(self._key(klvlist), self._key(original[:damaged] + original[damaged + 1:-5]))
+
+        gyro_strm, last_strm = sorted(report.losses)
+        self.assertEqual((gyro_strm.offset, gyro_strm.label), (self.gyro, 'STRM'))
+        self.assertEqual(last_strm.offset + last_strm.length, len(data))
+        self.assertEqual(report.missing, [Loss(len(data), 100, 'DEVC', 'truncated at the end of the data')])
+        # only bytes that are in data are lost
+        self.assertTrue(all(loss.offset + loss.length <= len(data) for loss in report.losses))
+        self.assertEqual(report.bytes_missing, 100)
+        self.assertEqual((report.devc_ok, report.devc_damaged), (21, 2))
+
+    def test_chunked(self):
+        data = self._damaged()
+        whole = DamageReport()
+        expected, _ = parse_recovering(data, whole, final=True)
+
+        for chunk_size in (7, 1000, 4096):
+            report = DamageReport()
+            klvlist = []
+            unread = b''
+            for start in range(0, len(data), chunk_size):
+                klv, unread = parse_recovering(unread + data[start:start + chunk_size], report)
+                klvlist.extend(klv)
+            klv, _ = parse_recovering(unread, report, final=True)
+            klvlist.extend(klv)
+            self.assertEqual(self._key(klvlist), self._key(expected))
+            self.assertEqual(sorted(report.losses), sorted(whole.losses))
+            self.assertEqual(report.missing, whole.missing)
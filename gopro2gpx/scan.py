@@ -0,0 +1,164 @@
+"""
+fast walk over the KLV headers of a GPMF buffer.
+
+scan_headers() returns the (offset, fourCC, type, size, repeat) of every KLV of a buffer as one numpy structured array,
+without building a KLVData per label. the walk itself is sequential (every offset depends on the previous header), so
+only the offsets are computed in a loop: by a numba-compiled kernel when numba is installed, or by an equivalent pure
+Python loop over the bytes. the header fields are then gathered from the buffer for all the offsets at once.
+
+nested labels (type 0: DEVC, STRM) are walked into, like parseStream() does.
+"""
+
+import functools
+import logging
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+HEADER_DTYPE = np.dtype([('offset', '<i8'), ('fourCC', 'S4'), ('type', 'u1'), ('size', 'u1'), ('repeat', '<u2')])
+
+# importing numba and loading the compiled kernel costs more than walking a small buffer in python
+COMPILED_MIN_BYTES = 4 * 1024 * 1024
+
+
+def _scan_offsets_python(buf):
+    """
+    offsets of the complete KLV headers of buf (bytes), and where the walk stopped
+    """
+    offsets = []
+    offset = 0
+    end = len(buf)
+    while offset + 8 <= end:
+        length = buf[offset + 5] * ((buf[offset + 6] << 8) | buf[offset + 7])
+        if buf[offset + 4] != 0:
+            padded = (length + 3) & ~3
+            if offset + 8 + padded > end:
+                # partial KLV, like KLVData's type == -1
+                break
+            offsets.append(offset)
+            offset += 8 + padded
+        else:
+            offsets.append(offset)
+            offset += 8
+    return offsets, offset
+
+
+@functools.lru_cache(maxsize=None)
+def compiled_kernel():
+    """
+    the numba version of _scan_offsets_python, or None when numba is not installed
+    """
+    try:
+        import numba
+    except ImportError:
+        return None
+
+    @numba.njit(cache=True)
+    def scan_offsets_compiled(buf, offsets):
+        count = 0
+        offset = 0
+        end = buf.shape[0]
+        while offset + 8 <= end:
+            length = np.int64(buf[offset + 5]) * ((np.int64(buf[offset + 6]) << 8) | np.int64(buf[offset + 7]))
+            if buf[offset + 4] != 0:
+                padded = (length + 3) & ~3
+                if offset + 8 + padded > end:
+                    break
+                offsets[count] = offset
+                offset += 8 + padded
+            else:
+                offsets[count] = offset
+                offset += 8
+            count += 1
+        return count, offset
+
+    return scan_offsets_compiled
+
+
+def scan_offsets(data, compiled=None):
+    """
+    (offsets array, end of the walk) for data. compiled=None uses numba for large buffers when it is available
+    """
+    if compiled is None:
+        compiled = len(data) >= COMPILED_MIN_BYTES and compiled_kernel() is not None
+    if compiled:
+        kernel = compiled_kernel()
+        if kernel is None:
+            raise RuntimeError('numba is not installed')
+        buf = np.frombuffer(data, dtype=np.uint8)
+        # every header takes at least 8 bytes
+        offsets = np.empty(len(buf) // 8 + 1, dtype=np.int64)
+        count, end = kernel(buf, offsets)
+        return offsets[:count], int(end)
+    offsets, end = _scan_offsets_python(bytes(data))
+    return np.array(offsets, dtype=np.int64), end
+
+
+def scan_headers(data, compiled=None):
+    """
+    the headers of every complete KLV in data (bytes-like) as a HEADER_DTYPE array, and the number of bytes they
+    cover: data[end:] is a partial KLV to be completed by the next chunk, like the unread bytes of parseStream()
+    """
+    offsets, end = scan_offsets(data, compiled)
+    buf = np.frombuffer(data, dtype=np.uint8)
+    headers = np.empty(len(offsets), dtype=HEADER_DTYPE)
+    headers['offset'] = offsets
+    headers['fourCC'] = buf[offsets[:, None] + np.arange(4)].reshape(-1).view('S4')
+    headers['type'] = buf[offsets + 4]
+    headers['size'] = buf[offsets + 5]
+    headers['repeat'] = (buf[offsets + 6].astype(np.uint16) << 8) | buf[offsets + 7]
+    return headers, end
+
+
+class ScanHeadersTest(unittest.TestCase):
+    SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+
+    def samples(self):
+        files = sorted(self.SAMPLES.glob('*.bin'))
+        if not files:
+            self.skipTest(f'no samples in {self.SAMPLES}')
+        return files
+
+    def test_same_as_parseStream(self):
+        from . import fourCC
+        from .klv_extraction import parseStream
+
+        logging.disable(logging.CRITICAL)
+        try:
+            for path in self.samples():
+                data = path.read_bytes()
+                headers, end = scan_headers(data, compiled=False)
+                # parseStream drops the labels in fourCC.skip_labels, compare with what it keeps
+                klvlist, unread = parseStream(data)
+                scanned = [(h['fourCC'].decode('latin-1'), int(h['type']), int(h['size']), int(h['repeat']))
+                           for h in headers]
+                self.assertEqual([s for s in scanned if s[0] not in fourCC.skip_labels],
+                                 [(k.fourCC, k.type, k.size, k.repeat) for k in klvlist], path.name)
+                self.assertEqual(len(data) - end, len(unread), path.name)
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def test_partial_buffer(self):
+        data = self.samples()[0].read_bytes()
+        full, _ = scan_headers(data, compiled=False)
+        cut = int(full['offset'][len(full) // 2]) + 3
+        headers, end = scan_headers(data[:cut], compiled=False)
+        self.assertLessEqual(end, cut)
+        rest, _ = scan_headers(data[end:], compiled=False)
+        self.assertEqual(len(headers) + len(rest), len(full))
+
+    def test_compiled_matches_python(self):
+        if compiled_kernel() is None:
+            self.skipTest('numba is not installed')
+        for path in self.samples():
+            data = path.read_bytes()
+            for cut in (len(data), len(data) // 3):
+                python, python_end = scan_headers(data[:cut], compiled=False)
+                compiled, compiled_end = scan_headers(data[:cut], compiled=True)
+                self.assertEqual(python_end, compiled_end)
+                self.assertTrue(np.array_equal(python, compiled), path.name)
+
+
+if __name__ == '__main__':
+    unittest.main()
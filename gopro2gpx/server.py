@@ -0,0 +1,410 @@
+"""
+long-running extraction daemon with a small HTTP API, on localhost or on a Unix socket.
+
+starting python, numpy, scipy and PyAV costs more than parsing a short clip, so a batch scheduler that launches one
+process per clip spends most of its time importing. the daemon pays that once: it imports everything at startup,
+keeps the fourCC tables and their caches warm, and runs the extraction jobs in a pool of worker processes (parsing is
+pure python, threads would take turns on the GIL) that did the same imports when they started.
+
+the worker writes the result to a temporary file and the response streams it (chunked transfer encoding) while it is
+being written, so nothing is held in memory. the request is checked before it is queued: a missing path, an unknown
+format or option, or an option of the wrong type is a 400.
+
+    POST /extract   {"path": "/data/GH010198.MP4", "format": "gpx", "skip": true, "simplify": 2.0}
+    GET  /status
+
+formats: gpx, kml, csv and json (the GPS track, via gpmf.Parser; .bin dumps work too), npz and mat (the per-frame
+metadata of read_video). the other options are skip, rate, simplify, max_points, max_frames and memory_limit (MB),
+with the meaning they have on the command line.
+
+usage:
+    python -m gopro2gpx.server -j 4 --port 8642
+    python -m gopro2gpx.server --socket /run/gopro2gpx.sock
+
+    curl -d '{"path": "/data/GH010198.MP4", "format": "gpx"}' http://127.0.0.1:8642/extract > GH010198.gpx
+    curl --unix-socket /run/gopro2gpx.sock -d '{"path": "dump.bin", "format": "csv"}' http://localhost/extract
+"""
+
+import argparse
+import concurrent.futures
+import http.client
+import http.server
+import json
+import logging
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+
+from .config import DEFAULT_MEMORY_LIMIT
+
+DEFAULT_PORT = 8642
+
+CONTENT_TYPES = {
+    'gpx': 'application/gpx+xml',
+    'kml': 'application/vnd.google-earth.kml+xml',
+    'csv': 'text/csv',
+    'json': 'application/json',
+    'npz': 'application/octet-stream',
+    'mat': 'application/octet-stream',
+}
+
+
+class BadRequest(Exception):
+    pass
+
+
+def _warm_up():
+    # import everything a job may need now, instead of in the first request
+    import av  # noqa: F401
+    import numpy  # noqa: F401
+    import scipy.io  # noqa: F401
+    import scipy.spatial.transform  # noqa: F401
+    from . import geodesy, klv_extraction, simplify, track_index  # noqa: F401
+
+
+def extract_points(path, skip=False, rate=None, simplify=None, max_points=None):
+    from .geodesy import resample_points
+    from .simplify import simplify_points
+    from .track_index import load_points
+
+    points = load_points(path, skip=skip)
+    if not points:
+        raise BadRequest(f'No GPS info in {path}')
+    if rate:
+        points = resample_points(points, rate)
+    return simplify_points(points, simplify, max_points)
+
+
+def points_json(points):
+    return json.dumps([{'time': p.time.isoformat(), 'latitude': p.latitude, 'longitude': p.longitude,
+                        'elevation': p.elevation, 'speed': p.speed} for p in points])
+
+
+def extract_frames(path, skip=False, max_frames=None, memory_limit=None):
+    from .klv_extraction import extract_frame_info
+
+    args = argparse.Namespace(video_file=Path(path), max_frames=max_frames, skip=skip,
+                              output_streams=None, output_sidecar=None, recover=False,
+                              memory_limit=memory_limit or DEFAULT_MEMORY_LIMIT // (1024 * 1024))
+    frame_info, _ = extract_frame_info(args)
+    return frame_info
+
+
+# option: (accepted types, check of the value)
+OPTIONS = {
+    'skip': ((bool,), lambda v: True),
+    'rate': ((int, float), lambda v: v > 0),
+    'simplify': ((int, float), lambda v: v > 0),
+    'max_points': ((int,), lambda v: v > 0),
+    'max_frames': ((int,), lambda v: v > 0),
+    'memory_limit': ((int,), lambda v: v > 0),
+}
+
+
+def parse_job(job):
+    """
+    the checked options of one /extract request (path, format and the OPTIONS that are given), or BadRequest
+    """
+    if not isinstance(job, dict) or not isinstance(job.get('path'), str):
+        raise BadRequest('the request must be a JSON object with a "path" string')
+    fmt = job.get('format', 'gpx')
+    if fmt not in CONTENT_TYPES:
+        raise BadRequest(f'unknown format {fmt}, expected one of {", ".join(CONTENT_TYPES)}')
+    options = {'path': job['path'], 'format': fmt}
+    for name, value in job.items():
+        if name in ('path', 'format') or value is None:
+            continue
+        if name not in OPTIONS:
+            raise BadRequest(f'unknown option {name}, expected one of {", ".join(OPTIONS)}')
+        types, check = OPTIONS[name]
+        # bool is an int for isinstance(), but true isn't a frame count
+        if isinstance(value, bool) != (types == (bool,)) or not isinstance(value, types) or not check(value):
+            raise BadRequest(f'invalid value {value!r} for {name}')
+        options[name] = value
+    return options
+
+
+def run_job(job, output):
+    """
+    process one checked /extract request (see parse_job), writing the response body to the file output
+    """
+    from . import gpshelper
+
+    path = Path(job['path'])
+    fmt = job['format']
+    if not path.is_file():
+        raise FileNotFoundError(f'{path} not found')
+    skip = job.get('skip', False)
+
+    if fmt in ('npz', 'mat'):
+        frame_info = extract_frames(path, skip, job.get('max_frames'), job.get('memory_limit'))
+        with open(output, 'wb') as fd:
+            if fmt == 'npz':
+                import numpy as np
+                np.savez(fd, **frame_info)
+            else:
+                from scipy.io import savemat
+                savemat(fd, frame_info)
+        return
+
+    points = extract_points(path, skip, job.get('rate'), job.get('simplify'), job.get('max_points'))
+    if fmt == 'gpx':
+        text = gpshelper.generate_GPX(points, trk_name=path.stem)
+    elif fmt == 'kml':
+        text = gpshelper.generate_KML(points)
+    elif fmt == 'csv':
+        text = gpshelper.generate_CSV(points)
+    else:
+        text = points_json(points)
+    with open(output, 'w', encoding='utf-8', newline='') as fd:
+        fd.write(text)
+
+
+class ExtractionHandler(http.server.BaseHTTPRequestHandler):
+    server_version = 'gopro2gpx'
+    protocol_version = 'HTTP/1.1'
+    chunk_size = 64 * 1024
+    # seconds between two looks at the output of a running job
+    poll = 0.05
+
+    def log_message(self, format, *args):
+        # client_address is empty on a Unix socket, so don't use the default formatting
+        logging.getLogger(__name__).debug(format % args)
+
+    def _send(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, value):
+        self._send(status, json.dumps(value).encode('utf-8'))
+
+    def _write_chunk(self, data):
+        self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+
+    def _stream(self, future, output, content_type):
+        """
+        send the output file of a running job as it grows, in chunks. the status is only sent once the job has
+        written something (or ended), so the errors that happen before the output (all of them in practice) still
+        get their status code
+        """
+        with open(output, 'rb') as fd:
+            chunk = fd.read(self.chunk_size)
+            while not chunk and not future.done():
+                concurrent.futures.wait([future], timeout=self.poll)
+                chunk = fd.read(self.chunk_size)
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            while True:
+                if chunk:
+                    self._write_chunk(chunk)
+                elif future.done():
+                    if future.exception() is not None:
+                        # too late for an error status: end the response without its last chunk
+                        logging.getLogger(__name__).error(f'Job failed while streaming: {future.exception()}')
+                        self.close_connection = True
+                        return
+                    break
+                else:
+                    concurrent.futures.wait([future], timeout=self.poll)
+                chunk = fd.read(self.chunk_size)
+            self.wfile.write(b'0\r\n\r\n')
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/status':
+            self._send_json(200, self.server.daemon.status())
+        else:
+            self._send_json(404, {'error': f'no such endpoint {self.path}'})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/extract':
+            self._send_json(404, {'error': f'no such endpoint {self.path}'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = parse_job(json.loads(self.rfile.read(length) or b'{}'))
+        except (ValueError, BadRequest) as e:
+            self._send_json(400, {'error': f'invalid request: {e}'})
+            return
+
+        fd, output = tempfile.mkstemp(prefix='gopro2gpx-', suffix='.' + job['format'])
+        os.close(fd)
+        try:
+            future = self.server.daemon.submit(job, output)
+            self._stream(future, output, CONTENT_TYPES[job['format']])
+        except BadRequest as e:
+            self._send_json(400, {'error': str(e)})
+        except FileNotFoundError as e:
+            self._send_json(404, {'error': str(e)})
+        except Exception as e:
+            logging.getLogger(__name__).error(f'Failed to process {job["path"]}: {e}')
+            self._send_json(500, {'error': str(e)})
+        finally:
+            os.unlink(output)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ExtractionDaemon:
+    """
+    the worker pool and the HTTP server in front of it. address is a (host, port) tuple or the path of a Unix socket
+    """
+
+    def __init__(self, address=('127.0.0.1', DEFAULT_PORT), workers=None, warm_up=True):
+        self.workers = workers or os.cpu_count() or 1
+        # every worker process does the imports when it starts, not in its first job
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                           initializer=_warm_up if warm_up else None)
+        # start the workers now
+        self.pool.submit(int).result()
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.counters = {'running': 0, 'done': 0, 'failed': 0}
+
+        if isinstance(address, (str, Path)):
+            if os.path.exists(str(address)):
+                os.unlink(str(address))
+            self.httpd = ThreadingUnixHTTPServer(str(address), ExtractionHandler)
+        else:
+            self.httpd = http.server.ThreadingHTTPServer(tuple(address), ExtractionHandler)
+        self.httpd.daemon = self
+        self.address = address
+
+    def _count(self, key, delta=1):
+        with self.lock:
+            self.counters[key] += delta
+
+    def _finished(self, future):
+        with self.lock:
+            self.counters['running'] -= 1
+            self.counters['failed' if future.exception() is not None else 'done'] += 1
+
+    def submit(self, job, output):
+        """
+        run a checked job (parse_job) in the pool, writing its result to the file output. returns its future
+        """
+        self._count('running')
+        future = self.pool.submit(run_job, job, output)
+        future.add_done_callback(self._finished)
+        return future
+
+    def status(self):
+        with self.lock:
+            return dict(self.counters, workers=self.workers, uptime=time.time() - self.started)
+
+    def serve_forever(self):
+        logging.getLogger(__name__).info(f'Listening on {self.address} with {self.workers} workers')
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+
+    def close(self):
+        self.httpd.server_close()
+        self.pool.shutdown(wait=True)
+        if isinstance(self.address, (str, Path)) and os.path.exists(str(self.address)):
+            os.unlink(str(self.address))
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = str(path)
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request_extract(path, format='gpx', address=('127.0.0.1', DEFAULT_PORT), timeout=None, **options):
+    """
+    client side: ask a running daemon to process path. returns the response body (bytes), raises RuntimeError
+    with the daemon's message when the job fails
+    """
+    if isinstance(address, (str, Path)):
+        connection = UnixHTTPConnection(address, timeout=timeout)
+    else:
+        connection = http.client.HTTPConnection(*address, timeout=timeout)
+    try:
+        body = json.dumps(dict(options, path=str(Path(path).resolve()), format=format))
+        connection.request('POST', '/extract', body=body, headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        data = response.read()
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise RuntimeError(json.loads(data).get('error', response.reason))
+    return data
+
+
+class ServerTest(unittest.TestCase):
+    SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+
+    def test_unix_socket(self):
+        from . import cli
+
+        with tempfile.TemporaryDirectory() as tmp:
+            address = Path(tmp) / 'gopro2gpx.sock'
+            daemon = ExtractionDaemon(address, workers=1, warm_up=False)
+            thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+            thread.start()
+            try:
+                path = self.SAMPLES / 'hero5.bin'
+                for fmt in ('gpx', 'csv'):
+                    cli.run(cli.options(file=str(path), formats=[fmt], output=str(Path(tmp) / 'expected')))
+                    expected = cli.output_path(Path(tmp) / 'expected', fmt).read_bytes()
+                    self.assertEqual(request_extract(path, fmt, address=address), expected)
+
+                with self.assertRaisesRegex(RuntimeError, 'invalid value'):
+                    request_extract(path, 'gpx', address=address, max_points='100')
+                with self.assertRaisesRegex(RuntimeError, 'unknown option'):
+                    request_extract(path, 'gpx', address=address, maxpoints=100)
+                with self.assertRaisesRegex(RuntimeError, 'not found'):
+                    request_extract(Path(tmp) / 'missing.bin', 'gpx', address=address)
+                self.assertEqual(daemon.status()['done'], 2)
+            finally:
+                daemon.shutdown()
+                daemon.close()
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="keep the GoPro metadata extraction running as a local service")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: %(default)s)")
+    parser.add_argument("-p", "--port", type=int, default=DEFAULT_PORT, help="TCP port (default: %(default)s)")
+    parser.add_argument("--socket", type=Path, help="listen on this Unix socket instead of TCP")
+    parser.add_argument("-j", "--jobs", type=int, help="number of worker processes (default: one per CPU)")
+    parser.add_argument('-l', '--loglevel', default='info',
+                        help='Provide logging level. Example --loglevel debug')
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    logging.basicConfig(level=args.loglevel.upper())
+    daemon = ExtractionDaemon(args.socket or (args.host, args.port), workers=args.jobs)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+"""
+binary telemetry sidecar: the decoded GPMF streams of a clip in one memory-mappable file.
+
+layout (little endian):
+
+    8 bytes   magic b'GPMFSIDE'
+    uint32    format version
+    uint32    length of the header
+    header    JSON: for every stream its record dtype, number of samples, data offset and description
+    ...       padding to a 64 byte boundary
+    data      every stream as one contiguous array of records ('t': float64 seconds, 'v': the sample), sorted by t,
+              each one starting on a 64 byte boundary
+
+the records are fixed width and sorted by time, so the time column is its own index: reading the telemetry between t0
+and t1 is two binary searches on the mapped file and a slice, without parsing any GPMF. a stream whose sample layout
+changes mid-clip continues in the streams '<key>.1', '<key>.2'..., like in streams.TimeseriesStore.
+
+    with SidecarWriter('GH010198.telemetry') as sidecar:
+        StreamExtractor(sidecar).add_klv(klvlist)
+
+    sidecar = Sidecar('GH010198.telemetry')
+    sidecar.between('ACCL', 10.0, 12.5)     # -> records, rec['t'] and rec['v']
+
+usage:
+    python -m gopro2gpx.sidecar GH010198.telemetry                  # list the streams
+    python -m gopro2gpx.sidecar GH010198.telemetry ACCL 10 12.5     # print the samples in that time range
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+MAGIC = b'GPMFSIDE'
+VERSION = 1
+ALIGNMENT = 64
+SUFFIX = '.telemetry'
+_PREAMBLE = struct.Struct('<8sII')
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _descr(descr):
+    # JSON turns the tuples of dtype.descr into lists, numpy wants them back
+    if isinstance(descr, str):
+        return descr
+    return [(f[0], _descr(f[1])) + ((tuple(f[2]),) if len(f) > 2 else ()) for f in descr]
+
+
+def record_dtype(values):
+    return np.dtype([('t', '<f8'), ('v', values.dtype, values.shape[1:])])
+
+
+class SidecarWriter:
+    """
+    a store for StreamExtractor (same append() as streams.TimeseriesStore). the records of every stream go to a
+    temporary file while the clip is parsed, and close() assembles the sidecar
+    """
+
+    def __init__(self, path, spill_dir=None):
+        self.path = path
+        self.tmp = tempfile.TemporaryDirectory(prefix='gopro2gpx_', dir=spill_dir)
+        self.files = {}
+        self.meta = {}
+        # stream -> the key its samples currently go to, like streams.TimeseriesStore
+        self.parts = {}
+        self.part_of = {}
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _part(self, key, values):
+        # the key the samples go to: the current part of the stream, or a new part if their layout changed
+        current = self.parts.setdefault(key, key)
+        stream = self.meta.get(current)
+        if stream is None:
+            return current
+        dtype = np.dtype(_descr(stream['dtype']))
+        if values.dtype == dtype['v'].base and values.shape[1:] == dtype['v'].shape:
+            return current
+        part = self.part_of[current][1] + 1 if current in self.part_of else 1
+        self.parts[key] = '%s.%d' % (key, part)
+        self.part_of[self.parts[key]] = (key, part)
+        logging.getLogger(__name__).info(f'Sample layout of stream {key} changed, continuing in {self.parts[key]}')
+        return self.parts[key]
+
+    def append(self, key, times, values, meta):
+        key = self._part(key, values)
+        if key not in self.meta:
+            dtype = record_dtype(values)
+            self.meta[key] = dict(meta, dtype=dtype.descr, samples=0, sorted=True, last=-np.inf)
+            if key in self.part_of:
+                self.meta[key].update(zip(('of', 'part'), self.part_of[key]))
+            self.files[key] = open(os.path.join(self.tmp.name, '%d.bin' % len(self.files)), 'w+b')
+        stream = self.meta[key]
+
+        dtype = np.dtype(_descr(stream['dtype']))
+        records = np.empty(len(values), dtype=dtype)
+        records['t'] = times
+        records['v'] = values
+        if len(records):
+            stream['sorted'] &= bool(records['t'][0] >= stream['last']) and bool(np.all(np.diff(records['t']) >= 0))
+            stream['last'] = float(records['t'][-1])
+        stream['samples'] += len(records)
+        self.files[key].write(records.tobytes())
+
+    def _records(self, key):
+        fd = self.files[key]
+        fd.flush()
+        return np.memmap(fd.name, dtype=np.dtype(_descr(self.meta[key]['dtype'])), mode='r',
+                         shape=(self.meta[key]['samples'],))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        streams = {}
+        offset = 0
+        for key, stream in self.meta.items():
+            dtype = np.dtype(_descr(stream['dtype']))
+            streams[key] = {k: v for k, v in stream.items() if k not in ('sorted', 'last')}
+            streams[key]['offset'] = offset
+            offset = _aligned(offset + stream['samples'] * dtype.itemsize)
+        header = json.dumps({'streams': streams}, default=str).encode('utf-8')
+        data_start = _aligned(_PREAMBLE.size + len(header))
+
+        with open(str(self.path), 'wb') as out:
+            out.write(_PREAMBLE.pack(MAGIC, VERSION, len(header)))
+            out.write(header)
+            for key, stream in self.meta.items():
+                out.write(b'\0' * (data_start + streams[key]['offset'] - out.tell()))
+                if stream['sorted']:
+                    self.files[key].seek(0)
+                    shutil.copyfileobj(self.files[key], out)
+                else:
+                    # STMP can step backwards (e.g. the Karma drone and the camera in one stream)
+                    records = self._records(key)
+                    out.write(records[np.argsort(records['t'], kind='stable')].tobytes())
+                    del records
+                self.files[key].close()
+
+        self.tmp.cleanup()
+
+
+class Sidecar:
+    """
+    read-only, memory mapped view of a sidecar file. streams are numpy record arrays backed by the file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(str(path), 'rb') as fd:
+            magic, version, header_len = _PREAMBLE.unpack(fd.read(_PREAMBLE.size))
+            if magic != MAGIC:
+                raise ValueError(f'{path} is not a telemetry sidecar')
+            if version > VERSION:
+                raise ValueError(f'{path} is a version {version} sidecar, this reader understands up to {VERSION}')
+            self.header = json.loads(fd.read(header_len))['streams']
+        self.data_start = _aligned(_PREAMBLE.size + header_len)
+        self._mm = np.memmap(str(path), dtype=np.uint8, mode='r')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._mm = None
+
+    def keys(self):
+        return list(self.header)
+
+    def __contains__(self, key):
+        return key in self.header
+
+    def __getitem__(self, key):
+        stream = self.header[key]
+        return np.ndarray((stream['samples'],), dtype=np.dtype(_descr(stream['dtype'])), buffer=self._mm,
+                          offset=self.data_start + stream['offset'])
+
+    def info(self, key):
+        return self.header[key]
+
+    def between(self, key, t0=None, t1=None):
+        """
+        the records of stream key with t0 <= t <= t1 (seconds). a view into the mapped file, O(log n)
+        """
+        records = self[key]
+        times = records['t']
+        start = 0 if t0 is None else int(np.searchsorted(times, t0, side='left'))
+        end = len(records) if t1 is None else int(np.searchsorted(times, t1, side='right'))
+        return records[start:end]
+
+
+class _Blocks:
+    # a StreamExtractor store that keeps the blocks, to compare with
+    def __init__(self):
+        self.blocks = {}
+
+    def append(self, key, times, values, meta):
+        self.blocks.setdefault(key, []).append((times, values))
+
+
+class SidecarTest(unittest.TestCase):
+    SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+
+    def test_round_trip(self):
+        from .klv_extraction import parseStream
+        from .streams import StreamExtractor
+
+        klvlist, _ = parseStream((self.SAMPLES / 'hero6.bin').read_bytes())
+        blocks = _Blocks()
+        StreamExtractor(blocks).add_klv(klvlist)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / ('hero6' + SUFFIX)
+            with SidecarWriter(path, spill_dir=tmp) as writer:
+                StreamExtractor(writer).add_klv(klvlist)
+            # only the sidecar is left
+            self.assertEqual(os.listdir(tmp), [path.name])
+
+            with Sidecar(path) as sidecar:
+                self.assertEqual(sorted(sidecar.keys()), sorted(blocks.blocks))
+                for key, parts in blocks.blocks.items():
+                    times = np.concatenate([t for t, _ in parts])
+                    values = np.concatenate([v for _, v in parts])
+                    # sorted by time, like the writer does
+                    order = np.argsort(times, kind='stable')
+                    times, values = times[order], values[order]
+                    records = sidecar[key]
+                    self.assertEqual(sidecar.info(key)['samples'], len(times))
+                    self.assertEqual(self.data_start(sidecar, key) % ALIGNMENT, 0)
+                    np.testing.assert_array_equal(records['t'], times)
+                    np.testing.assert_array_equal(records['v'], values)
+
+                accl = sidecar['ACCL']
+                part = sidecar.between('ACCL', 3.0, 5.5)
+                inside = (accl['t'] >= 3.0) & (accl['t'] <= 5.5)
+                self.assertGreater(len(part), 0)
+                np.testing.assert_array_equal(part, accl[inside])
+                # the bounds are inclusive
+                t = float(accl['t'][100])
+                self.assertEqual(len(sidecar.between('ACCL', t, t)), np.count_nonzero(accl['t'] == t))
+                self.assertEqual(len(sidecar.between('ACCL')), len(accl))
+                self.assertEqual(len(sidecar.between('ACCL', 1000.0)), 0)
+                self.assertEqual(len(sidecar.between('ACCL', None, -1.0)), 0)
+
+    def test_unsorted(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / ('x' + SUFFIX)
+            with SidecarWriter(path) as writer:
+                writer.append('STMP', np.array([2.0, 3.0]), np.array([20, 30]), {})
+                writer.append('STMP', np.array([0.0, 1.0]), np.array([0, 10]), {})
+            with Sidecar(path) as sidecar:
+                np.testing.assert_array_equal(sidecar['STMP']['t'], [0.0, 1.0, 2.0, 3.0])
+                np.testing.assert_array_equal(sidecar.between('STMP', 0.5, 2.0)['v'], [10, 20])
+
+    def test_layout_change(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / ('x' + SUFFIX)
+            with SidecarWriter(path) as writer:
+                writer.append('ACCL', np.arange(3.0), np.ones((3, 3)), {'fourCC': 'ACCL'})
+                # a 4th column from here on, then back to 3
+                writer.append('ACCL', np.arange(3.0, 5.0), np.full((2, 4), 2.0), {'fourCC': 'ACCL'})
+                writer.append('ACCL', np.arange(5.0, 6.0), np.full((1, 4), 3.0), {'fourCC': 'ACCL'})
+                writer.append('ACCL', np.arange(6.0, 7.0), np.full((1, 3), 4.0), {'fourCC': 'ACCL'})
+            with Sidecar(path) as sidecar:
+                self.assertEqual(sidecar.keys(), ['ACCL', 'ACCL.1', 'ACCL.2'])
+                np.testing.assert_array_equal(sidecar['ACCL']['t'], [0.0, 1.0, 2.0])
+                np.testing.assert_array_equal(sidecar['ACCL.1']['v'], [[2.0] * 4] * 2 + [[3.0] * 4])
+                np.testing.assert_array_equal(sidecar['ACCL.2']['v'], [[4.0] * 3])
+                self.assertEqual((sidecar.info('ACCL.1')['of'], sidecar.info('ACCL.1')['part']), ('ACCL', 1))
+                self.assertNotIn('of', sidecar.info('ACCL'))
+
+    def test_not_a_sidecar(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'x.bin'
+            path.write_bytes(b'\0' * 64)
+            self.assertRaises(ValueError, Sidecar, path)
+
+    def data_start(self, sidecar, key):
+        return sidecar.data_start + sidecar.info(key)['offset']
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="read a telemetry sidecar")
+    parser.add_argument("sidecar", help="sidecar file")
+    parser.add_argument("stream", nargs='?', help="stream to print (e.g. ACCL, GPS5)")
+    parser.add_argument("t0", nargs='?', type=float, help="start time in seconds")
+    parser.add_argument("t1", nargs='?', type=float, help="end time in seconds")
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    with Sidecar(args.sidecar) as sidecar:
+        if args.stream is None:
+            for key in sidecar.keys():
+                info = sidecar.info(key)
+                print("%s,%s,%d,%s" % (key, info.get('name') or '', info['samples'], info.get('units') or ''))
+            return
+        for record in sidecar.between(args.stream, args.t0, args.t1):
+            values = np.atleast_1d(record['v'])
+            print("%.6f,%s" % (record['t'], ",".join(str(v) for v in values.tolist())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+track simplification for compact KML/GPX output.
+
+a GoPro logs GPS at 18 Hz, so an hour of footage is ~65000 points, most of which are redundant for drawing a line on a
+map. two classic algorithms are provided, both working in a local east/north plane in metres:
+
+  * Douglas-Peucker with a tolerance in metres: every dropped point lies within the tolerance of the simplified line.
+    the recursion is run level by level (douglas_peucker_many): every segment of a level is split in the same numpy
+    pass, so there is one pass per level of the recursion. every pass costs O(n), so typical tracks, where the splits
+    are somewhere in the middle, cost O(n log n) in ~log n passes. the worst case is still O(n^2): a track where every
+    split only peels off one point (a zigzag of decreasing amplitude) has n levels, ~1 s for 8000 points. the
+    O(n log n) bound of the path hull variant (Hershberger & Snoeyink) is not worth it here: it walks the points one
+    at a time, which in python is slower than the numpy passes on any real track, and GPS tracks don't zigzag like that.
+  * Visvalingam-Whyatt with a point budget: repeatedly drop the point whose triangle with its neighbours has the
+    smallest area until only max_points remain. a heap keeps this O(n log n) regardless of the input.
+
+use simplify_points() between BuildGPSPoints() and the gpshelper writers.
+"""
+
+import heapq
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from .geodesy import geodetic_to_enu
+
+
+def _plane_coords(lat, lon):
+    e, n, _ = geodetic_to_enu(lat, lon, np.zeros(len(lat)))
+    return np.column_stack([e, n])
+
+
+def douglas_peucker(xy, tolerance):
+    """
+    xy is an (n, 2) array in metres. returns the sorted indices of the points to keep
+    """
+    n = len(xy)
+    if n < 3:
+        return np.arange(n)
+    return np.flatnonzero(douglas_peucker_many(xy, [0], [n], tolerance))
+
+
+def douglas_peucker_many(xy, starts, ends, tolerance):
+    """
+    douglas_peucker() of many lines at once: the lines are xy[starts[i]:ends[i]] of one (n, 2) array. instead of one
+    segment at a time, every pending segment of every line is split in the same numpy pass, so the number of passes is
+    the depth of the recursion and not the number of kept points. returns a boolean mask of the points to keep, the
+    same points douglas_peucker() keeps line by line
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    keep = np.zeros(len(xy), dtype=bool)
+    keep[starts] = True
+    keep[ends - 1] = True
+
+    first = starts
+    last = ends - 1
+    while True:
+        pending = last - first >= 2
+        first, last = first[pending], last[pending]
+        if len(first) == 0:
+            return keep
+
+        # the inner points of every segment, one run per segment
+        inner = last - first - 1
+        offsets = np.cumsum(inner) - inner
+        ix = np.arange(offsets[-1] + inner[-1]) + np.repeat(first + 1 - offsets, inner)
+
+        a = xy[first]
+        ab = xy[last] - a
+        ap = xy[ix] - np.repeat(a, inner, axis=0)
+        seg_len = np.hypot(ab[:, 0], ab[:, 1])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dist = np.abs(ap[:, 0] * np.repeat(ab[:, 1] / seg_len, inner) -
+                          ap[:, 1] * np.repeat(ab[:, 0] / seg_len, inner))
+        if not seg_len.all():
+            # closed loop (or standing still): the distance from the anchor point
+            closed = np.repeat(seg_len == 0, inner)
+            dist[closed] = np.hypot(ap[closed, 0], ap[closed, 1])
+
+        # the first farthest point of every segment, like np.argmax()
+        farthest = np.maximum.reduceat(dist, offsets)
+        split_at = np.minimum.reduceat(np.where(dist == np.repeat(farthest, inner), ix, len(xy)), offsets)
+
+        split = farthest > tolerance
+        keep[split_at[split]] = True
+        first = np.concatenate([first[split], split_at[split]])
+        last = np.concatenate([split_at[split], last[split]])
+
+
+def _triangle_areas(xy, prev_ix, ix, next_ix):
+    a = xy[prev_ix]
+    b = xy[ix]
+    c = xy[next_ix]
+    return 0.5 * np.abs((b[..., 0] - a[..., 0]) * (c[..., 1] - a[..., 1]) -
+                        (c[..., 0] - a[..., 0]) * (b[..., 1] - a[..., 1]))
+
+
+def visvalingam(xy, max_points):
+    """
+    xy is an (n, 2) array in metres. returns the sorted indices of the max_points most significant points.
+    the first and last points are kept, unless max_points is 1 (the first point only)
+    """
+    n = len(xy)
+    max_points = int(max_points)
+    if max_points < 1:
+        raise ValueError(f'max_points must be at least 1, not {max_points}')
+    if n <= max_points:
+        return np.arange(n)
+    if max_points == 1:
+        return np.arange(1)
+
+    areas = np.full(n, np.inf)
+    areas[1:-1] = _triangle_areas(xy, np.arange(0, n - 2), np.arange(1, n - 1), np.arange(2, n))
+
+    # the heap loop is inherently sequential, so it runs on plain python floats to avoid numpy scalar overhead
+    xs = xy[:, 0].tolist()
+    ys = xy[:, 1].tolist()
+    areas = areas.tolist()
+    prev_ix = list(range(-1, n - 1))
+    next_ix = list(range(1, n + 1))
+
+    heap = list(zip(areas[1:-1], range(1, n - 1)))
+    heapq.heapify(heap)
+    removed = [False] * n
+    remaining = n
+    while remaining > max_points and heap:
+        area, ix = heapq.heappop(heap)
+        if removed[ix] or area != areas[ix]:
+            # stale heap entry
+            continue
+        removed[ix] = True
+        remaining -= 1
+
+        p, q = prev_ix[ix], next_ix[ix]
+        next_ix[p] = q
+        prev_ix[q] = p
+        for j in (p, q):
+            if 0 < j < n - 1:
+                a, c = prev_ix[j], next_ix[j]
+                new_area = 0.5 * abs((xs[j] - xs[a]) * (ys[c] - ys[a]) - (xs[c] - xs[a]) * (ys[j] - ys[a]))
+                # never let a neighbour become less significant than the point we just removed
+                areas[j] = max(area, new_area)
+                heapq.heappush(heap, (areas[j], j))
+
+    return np.flatnonzero(~np.array(removed))
+
+
+def simplify_indices(lat, lon, tolerance=None, max_points=None):
+    """
+    indices of the points to keep. tolerance is in metres, max_points bounds the output size.
+    when both are given, Douglas-Peucker runs first and Visvalingam-Whyatt trims whatever is over budget
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    keep = np.arange(len(lat))
+    if len(lat) < 3:
+        return keep[:max_points] if max_points else keep
+
+    xy = _plane_coords(lat, lon)
+    if tolerance:
+        keep = douglas_peucker(xy, tolerance)
+    if max_points and len(keep) > max_points:
+        keep = keep[visvalingam(xy[keep], max_points)]
+    return keep
+
+
+def simplify_points(points, tolerance=None, max_points=None):
+    """
+    simplify a list of gpshelper.GPSPoint, returning the kept points in their original order
+    """
+    if not tolerance and not max_points:
+        return points
+    keep = simplify_indices([p.latitude for p in points], [p.longitude for p in points], tolerance, max_points)
+    return [points[ix] for ix in keep]
+
+
+class SimplifyTest(unittest.TestCase):
+    SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+
+    def _tracks(self):
+        from .gopro2gpx import BuildGPSPoints
+        from .klv_extraction import parseStream
+
+        points = BuildGPSPoints(parseStream((self.SAMPLES / 'gopro7.bin').read_bytes())[0])
+        yield _plane_coords(np.array([p.latitude for p in points]), np.array([p.longitude for p in points]))
+        rng = np.random.default_rng(0)
+        yield np.cumsum(rng.normal(size=(5000, 2)), axis=0)
+        # a zigzag of decreasing amplitude: every split peels off one point, n levels, the O(n^2) case
+        i = np.arange(2000.0)
+        yield np.column_stack([i, (-1) ** i * (2000 - i)])
+
+    @staticmethod
+    def _distances(xy, first, last):
+        # the distance douglas_peucker() measures, of the points between first and last
+        ab = xy[last] - xy[first]
+        ap = xy[first + 1:last] - xy[first]
+        if not ab.any():
+            return np.hypot(ap[:, 0], ap[:, 1])
+        return np.abs(ap[:, 0] * ab[1] - ap[:, 1] * ab[0]) / np.hypot(*ab)
+
+    def test_douglas_peucker(self):
+        for xy in self._tracks():
+            for tolerance in (0.5, 5.0, 50.0):
+                keep = douglas_peucker(xy, tolerance)
+                self.assertEqual((keep[0], keep[-1]), (0, len(xy) - 1))
+                # every dropped point is within the tolerance of the line between the points kept around it
+                for first, last in zip(keep, keep[1:]):
+                    if last - first > 1:
+                        self.assertLessEqual(self._distances(xy, first, last).max(), tolerance)
+
+    def test_max_points(self):
+        for xy in self._tracks():
+            for max_points in (1, 2, 3, 10, 100, len(xy) - 1, len(xy), len(xy) + 5):
+                keep = visvalingam(xy, max_points)
+                self.assertEqual(len(keep), min(max_points, len(xy)))
+                self.assertEqual(keep[0], 0)
+                if max_points > 1:
+                    self.assertEqual(keep[-1], len(xy) - 1)
+        self.assertRaises(ValueError, visvalingam, xy, 0)
+
+        lat, lon = np.linspace(40, 41, 50), np.linspace(-3, -2, 50)
+        for max_points in (1, 2, 7):
+            self.assertEqual(len(simplify_indices(lat, lon, 0.1, max_points)), max_points)
+            self.assertLessEqual(len(simplify_indices(lat[:2], lon[:2], None, max_points)), max_points)
@@ -0,0 +1,360 @@
+"""
+outlier (multipath) rejection and smoothing of a GPS track.
+
+BuildGPSPoints() only drops points without a fix (GPSFIX == 0) or with all-zero coordinates, so a GoPro track still
+has the jumps of multipath reflections near buildings and under trees, and the usual few metres of jitter. here the
+track goes through a constant-velocity Kalman filter and a Rauch-Tung-Striebel backward pass, in a local east/north/up
+frame:
+
+  * the measurement noise of every point comes from its DOP (GPSP / 100, the precision of its DEVC), with a
+    larger error for points without a 3D fix and for the vertical axis
+  * a measurement whose innovation is too unlikely for its DOP (chi-square gate, east/north together) is rejected:
+    the point is placed where the smoothed track says it was instead. after MAX_REJECTED seconds of rejections in a
+    row the filter believes the measurements again, so a real jump (a tunnel exit) is followed
+  * the RTS pass uses the whole track, so the smoothed positions don't lag behind like a filter alone
+
+the east, north and up axes are filtered together as a batch of three 2-state models. the time loop can't be
+vectorized over the points: every gate decision depends on the state the previous points left. it runs in a
+numba-compiled kernel when numba is installed (about 0.5 us per point), or as the same code in plain python otherwise
+(about 50 us per point).
+
+use smooth_points() between BuildGPSPoints() and the gpshelper writers (gopro2gpx --smooth). it is not on by default:
+it moves the points away from what the camera recorded, by up to a few metres where the DOP is good and by much more
+where there was no fix (DOP 99.99 and GPSF 0: the filter trusts those points very little).
+"""
+
+import argparse
+import functools
+import logging
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from .geodesy import enu_to_geodetic, geodetic_to_enu, haversine
+
+# metres: the range error of one satellite (UERE), multiplied by the DOP for the error of a position
+UERE = 3.0
+# GPSP is not in every stream (and not before the first one): use this DOP until then
+DEFAULT_DOP = 2.0
+# the vertical error of a GPS position is about this much larger than the horizontal one
+VERTICAL_FACTOR = 1.5
+# points without a 3D fix (GPSF < 3) are this much less precise
+NO_FIX_FACTOR = 5.0
+
+# m^2/s^3: the spectral density of the (white noise) acceleration of the model, horizontal and vertical.
+# a bike or a car changes speed by a few m/s in a second, the height changes much more slowly
+ACCELERATION_NOISE = (4.0, 4.0, 0.5)
+
+# chi-square gates (99.9%): east and north together (2 degrees of freedom), and up
+GATE_HORIZONTAL = 13.8
+GATE_VERTICAL = 10.8
+
+# seconds of rejected measurements in a row before the filter is reset to them
+MAX_REJECTED = 5.0
+
+# the python version of the time loop takes about 50 us per point, numba is worth loading above this
+COMPILED_MIN_POINTS = 5000
+
+
+def _kalman_rts(t, z, r, q, gates, max_rejected, state, cov, rejected):
+    """
+    constant-velocity Kalman filter and RTS smoother for every axis of z (n, axes). r (n, axes) are the measurement
+    variances, q (axes,) the acceleration noise densities, gates (2,) the horizontal and vertical gates.
+    the horizontal axes are 0 and 1, gated together; the others are gated alone.
+    fills state (n, axes, 2) with the smoothed position and velocity, cov (n, axes, 3) with the smoothed
+    covariances (p00, p01, p11) and rejected (n,) with the measurements left out
+    """
+    n = z.shape[0]
+    axes = z.shape[1]
+    # filtered and predicted states and covariances, for the backward pass
+    xf = np.zeros((n, axes, 2))
+    pf = np.zeros((n, axes, 3))
+    xp = np.zeros((n, axes, 2))
+    pp = np.zeros((n, axes, 3))
+
+    for k in range(axes):
+        xf[0, k, 0] = z[0, k]
+        pf[0, k, 0] = r[0, k]
+        # unknown speed: anything up to ~30 m/s
+        pf[0, k, 2] = 900.0
+        xp[0, k, 0] = xf[0, k, 0]
+        pp[0, k, 0] = pf[0, k, 0]
+        pp[0, k, 2] = pf[0, k, 2]
+
+    rejected_since = t[0]
+    innovation = np.zeros(axes)
+    variance = np.zeros(axes)
+    for i in range(1, n):
+        dt = t[i] - t[i - 1]
+        if dt < 0.0:
+            dt = 0.0
+        for k in range(axes):
+            # predict: x = F x, P = F P F' + Q
+            p00 = pf[i - 1, k, 0]
+            p01 = pf[i - 1, k, 1]
+            p11 = pf[i - 1, k, 2]
+            xp[i, k, 0] = xf[i - 1, k, 0] + dt * xf[i - 1, k, 1]
+            xp[i, k, 1] = xf[i - 1, k, 1]
+            pp[i, k, 0] = p00 + 2.0 * dt * p01 + dt * dt * p11 + q[k] * dt * dt * dt / 3.0
+            pp[i, k, 1] = p01 + dt * p11 + q[k] * dt * dt / 2.0
+            pp[i, k, 2] = p11 + q[k] * dt
+            innovation[k] = z[i, k] - xp[i, k, 0]
+            variance[k] = pp[i, k, 0] + r[i, k]
+
+        # gate
+        accept = True
+        if axes >= 2:
+            d2 = innovation[0] * innovation[0] / variance[0] + innovation[1] * innovation[1] / variance[1]
+            if d2 > gates[0]:
+                accept = False
+        for k in range(2, axes):
+            if innovation[k] * innovation[k] / variance[k] > gates[1]:
+                accept = False
+
+        if accept:
+            rejected_since = t[i]
+        elif t[i] - rejected_since > max_rejected:
+            # the track really moved: start again from this measurement
+            accept = True
+            rejected_since = t[i]
+            for k in range(axes):
+                pp[i, k, 0] += innovation[k] * innovation[k]
+                variance[k] = pp[i, k, 0] + r[i, k]
+        rejected[i] = not accept
+
+        for k in range(axes):
+            if accept:
+                # update: K = P H' / S, x = x + K y, P = (I - K H) P
+                k0 = pp[i, k, 0] / variance[k]
+                k1 = pp[i, k, 1] / variance[k]
+                xf[i, k, 0] = xp[i, k, 0] + k0 * innovation[k]
+                xf[i, k, 1] = xp[i, k, 1] + k1 * innovation[k]
+                pf[i, k, 0] = (1.0 - k0) * pp[i, k, 0]
+                pf[i, k, 1] = (1.0 - k0) * pp[i, k, 1]
+                pf[i, k, 2] = pp[i, k, 2] - k1 * pp[i, k, 1]
+            else:
+                xf[i, k, 0] = xp[i, k, 0]
+                xf[i, k, 1] = xp[i, k, 1]
+                pf[i, k, 0] = pp[i, k, 0]
+                pf[i, k, 1] = pp[i, k, 1]
+                pf[i, k, 2] = pp[i, k, 2]
+
+    # RTS: xs = xf + C (xs[i+1] - xp[i+1]), Ps = Pf + C (Ps[i+1] - Pp[i+1]) C', C = Pf F' Pp[i+1]^-1
+    for k in range(axes):
+        state[n - 1, k, 0] = xf[n - 1, k, 0]
+        state[n - 1, k, 1] = xf[n - 1, k, 1]
+        cov[n - 1, k, 0] = pf[n - 1, k, 0]
+        cov[n - 1, k, 1] = pf[n - 1, k, 1]
+        cov[n - 1, k, 2] = pf[n - 1, k, 2]
+    for i in range(n - 2, -1, -1):
+        dt = t[i + 1] - t[i]
+        if dt < 0.0:
+            dt = 0.0
+        for k in range(axes):
+            p00 = pf[i, k, 0]
+            p01 = pf[i, k, 1]
+            p11 = pf[i, k, 2]
+            # Pf F'
+            a00 = p00 + dt * p01
+            a01 = p01
+            a10 = p01 + dt * p11
+            a11 = p11
+            det = pp[i + 1, k, 0] * pp[i + 1, k, 2] - pp[i + 1, k, 1] * pp[i + 1, k, 1]
+            if det <= 0.0:
+                c00 = c01 = c10 = c11 = 0.0
+            else:
+                i00 = pp[i + 1, k, 2] / det
+                i01 = -pp[i + 1, k, 1] / det
+                i11 = pp[i + 1, k, 0] / det
+                c00 = a00 * i00 + a01 * i01
+                c01 = a00 * i01 + a01 * i11
+                c10 = a10 * i00 + a11 * i01
+                c11 = a10 * i01 + a11 * i11
+            d0 = state[i + 1, k, 0] - xp[i + 1, k, 0]
+            d1 = state[i + 1, k, 1] - xp[i + 1, k, 1]
+            state[i, k, 0] = xf[i, k, 0] + c00 * d0 + c01 * d1
+            state[i, k, 1] = xf[i, k, 1] + c10 * d0 + c11 * d1
+            e00 = cov[i + 1, k, 0] - pp[i + 1, k, 0]
+            e01 = cov[i + 1, k, 1] - pp[i + 1, k, 1]
+            e11 = cov[i + 1, k, 2] - pp[i + 1, k, 2]
+            cov[i, k, 0] = p00 + c00 * (c00 * e00 + c01 * e01) + c01 * (c00 * e01 + c01 * e11)
+            cov[i, k, 1] = p01 + c00 * (c10 * e00 + c11 * e01) + c01 * (c10 * e01 + c11 * e11)
+            cov[i, k, 2] = p11 + c10 * (c10 * e00 + c11 * e01) + c11 * (c10 * e01 + c11 * e11)
+
+
+@functools.lru_cache(maxsize=None)
+def compiled_kernel():
+    """
+    the numba version of _kalman_rts, or None when numba is not installed
+    """
+    try:
+        import numba
+    except ImportError:
+        return None
+    return numba.njit(cache=True)(_kalman_rts)
+
+
+def measurement_variance(dop, fix=None):
+    """
+    (n, 3) east, north and up measurement variances in m^2 from the DOP of every point (NaN: unknown) and its
+    GPSF fix (3 = 3D)
+    """
+    dop = np.asarray(dop, dtype=float)
+    dop = np.where(np.isfinite(dop) & (dop > 0), dop, DEFAULT_DOP)
+    sigma = UERE * dop
+    if fix is not None:
+        fix = np.asarray(fix, dtype=float)
+        sigma = np.where(fix >= 3, sigma, sigma * NO_FIX_FACTOR)
+    return np.column_stack([sigma, sigma, sigma * VERTICAL_FACTOR]) ** 2
+
+
+def smooth_track(times, lat, lon, ele, dop=None, fix=None, compiled=None):
+    """
+    smoothed track as a dict of arrays: latitude, longitude, elevation, the east/north/up velocity (m/s), speed
+    (horizontal, m/s), sigma (horizontal standard deviation of the smoothed position, m) and rejected (the points
+    taken for outliers). times are datetime64 values or seconds, sorted; dop and fix are per point, or None
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    ele = np.asarray(ele, dtype=float)
+    n = len(lat)
+    times = np.asarray(times)
+    if np.issubdtype(times.dtype, np.number):
+        t = times.astype(float)
+    else:
+        times = times.astype('datetime64[us]')
+        t = (times - times[0]).astype(np.int64) / 1e6
+
+    e, nn, u = geodetic_to_enu(lat, lon, ele)
+    z = np.ascontiguousarray(np.column_stack([e, nn, u]))
+    r = measurement_variance(np.full(n, np.nan) if dop is None else dop, fix)
+
+    state = np.zeros((n, 3, 2))
+    cov = np.zeros((n, 3, 3))
+    rejected = np.zeros(n, dtype=np.bool_)
+    if n:
+        if compiled is None:
+            compiled = n >= COMPILED_MIN_POINTS and compiled_kernel() is not None
+        kernel = compiled_kernel() if compiled else _kalman_rts
+        if kernel is None:
+            raise RuntimeError('numba is not installed')
+        kernel(t, z, r, np.array(ACCELERATION_NOISE), np.array([GATE_HORIZONTAL, GATE_VERTICAL]),
+               float(MAX_REJECTED), state, cov, rejected)
+
+    s_lat, s_lon, s_ele = enu_to_geodetic(state[:, 0, 0], state[:, 1, 0], state[:, 2, 0], lat[0] if n else 0.0,
+                                          lon[0] if n else 0.0, ele[0] if n else 0.0)
+    return {
+        'latitude': s_lat,
+        'longitude': s_lon,
+        'elevation': s_ele,
+        'velocity_east': state[:, 0, 1],
+        'velocity_north': state[:, 1, 1],
+        'velocity_up': state[:, 2, 1],
+        'speed': np.hypot(state[:, 0, 1], state[:, 1, 1]),
+        'sigma': np.sqrt(cov[:, 0, 0] + cov[:, 1, 0]),
+        'rejected': rejected,
+    }
+
+
+def smooth_points(points, compiled=None):
+    """
+    smooth a list of gpshelper.GPSPoint in place (latitude, longitude, elevation) using their dop and fix.
+    the GPS speed of the points is kept. returns the points
+    """
+    if len(points) < 2:
+        return points
+    track = smooth_track(np.array([np.datetime64(p.time) for p in points], dtype='datetime64[us]'),
+                         [p.latitude for p in points],
+                         [p.longitude for p in points],
+                         [p.elevation for p in points],
+                         dop=[np.nan if p.dop is None else p.dop for p in points],
+                         fix=[3 if p.fix is None else p.fix for p in points],
+                         compiled=compiled)
+    for p, lat, lon, ele in zip(points, track['latitude'].tolist(), track['longitude'].tolist(),
+                                track['elevation'].tolist()):
+        p.latitude = lat
+        p.longitude = lon
+        p.elevation = ele
+    logging.getLogger(__name__).info(f'Smoothed {len(points)} points, {int(track["rejected"].sum())} rejected as outliers')
+    return points
+
+
+class SmoothingTest(unittest.TestCase):
+    SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+
+    def _track(self, n=600, noise=2.0, seed=0):
+        # 10 Hz, east at 5 m/s, with gaussian noise of noise metres on every axis
+        t = np.arange(n) * 0.1
+        truth = np.column_stack([5.0 * t, np.zeros(n), np.zeros(n)])
+        measured = truth + np.random.default_rng(seed).normal(scale=noise, size=(n, 3))
+        lat, lon, ele = enu_to_geodetic(measured[:, 0], measured[:, 1], measured[:, 2], 40.0, -3.7, 600.0)
+        return t, truth, lat, lon, ele
+
+    def _enu(self, track):
+        return np.column_stack(geodetic_to_enu(track['latitude'], track['longitude'], track['elevation'],
+                                               40.0, -3.7, 600.0))
+
+    def test_rts_error(self):
+        t, truth, lat, lon, ele = self._track()
+        raw = np.column_stack(geodetic_to_enu(lat, lon, ele, 40.0, -3.7, 600.0))
+        track = smooth_track(t, lat, lon, ele, dop=np.full(len(t), 1.0), compiled=False)
+        raw_error = np.sqrt(np.mean(np.sum((raw - truth) ** 2, axis=1)))
+        error = np.sqrt(np.mean(np.sum((self._enu(track) - truth) ** 2, axis=1)))
+        self.assertLess(error, raw_error / 2)
+        # the acceleration noise lets the speed wander a bit around the truth
+        self.assertAlmostEqual(track['speed'].mean(), 5.0, delta=0.1)
+        np.testing.assert_allclose(track['speed'], 5.0, atol=2.0)
+        self.assertFalse(track['rejected'].any())
+
+    def test_spike(self):
+        # a multipath jump of 200 m north for 3 points: rejected, and the track goes on where it was
+        t, truth, lat, lon, ele = self._track()
+        spike = np.arange(300, 303)
+        lat = lat.copy()
+        lat[spike] += np.degrees(200.0 / 6371008.8)
+        track = smooth_track(t, lat, lon, ele, dop=np.full(len(t), 1.0), compiled=False)
+        self.assertEqual(np.flatnonzero(track['rejected']).tolist(), spike.tolist())
+        error = np.linalg.norm(self._enu(track)[spike] - truth[spike], axis=1)
+        self.assertLess(error.max(), 3.0)
+
+    def test_real_jump(self):
+        # a jump that stays (a tunnel exit) is followed after MAX_REJECTED seconds
+        t, truth, lat, lon, ele = self._track()
+        lat = lat.copy()
+        lat[300:] += np.degrees(500.0 / 6371008.8)
+        track = smooth_track(t, lat, lon, ele, dop=np.full(len(t), 1.0), compiled=False)
+        rejected = np.flatnonzero(track['rejected'])
+        self.assertEqual(rejected[0], 300)
+        self.assertLessEqual(t[rejected[-1]] - t[300], MAX_REJECTED)
+        self.assertLess(np.abs(self._enu(track)[-100:, 1] - 500.0).max(), 3.0)
+
+    @unittest.skipIf(compiled_kernel() is None, 'numba is not installed')
+    def test_compiled(self):
+        t, truth, lat, lon, ele = self._track()
+        lat = lat.copy()
+        lat[300:303] += np.degrees(200.0 / 6371008.8)
+        dop = np.random.default_rng(1).uniform(1.0, 3.0, len(t))
+        fix = np.where(np.arange(len(t)) % 50 == 0, 2, 3)
+        python = smooth_track(t, lat, lon, ele, dop=dop, fix=fix, compiled=False)
+        compiled = smooth_track(t, lat, lon, ele, dop=dop, fix=fix, compiled=True)
+        for key, values in python.items():
+            np.testing.assert_allclose(compiled[key], values, rtol=1e-9, atol=1e-9, err_msg=key)
+
+    def test_sample(self):
+        from .config import setup_environment
+        from .gopro2gpx import BuildGPSPoints
+        from .gpmf import Parser
+
+        config = setup_environment(argparse.Namespace(verbose=0, file=str(self.SAMPLES / 'gopro7.bin'),
+                                                      outputfile=None))
+        points = BuildGPSPoints(Parser(config).readFromBinary())
+        raw = [(p.latitude, p.longitude, p.fix, p.dop) for p in points]
+        smooth_points(points)
+        lat, lon, fix, dop = (np.array(v, dtype=float) for v in zip(*raw))
+        moved = haversine(lat, lon, [p.latitude for p in points], [p.longitude for p in points])
+        # a few metres where the fix is good, more only where there is no fix (DOP 99.99)
+        good = (fix == 3) & (dop < 10)
+        self.assertLess(moved[good].max(), 10.0)
+        self.assertLess(np.percentile(moved[good], 90), 2.0)
+        self.assertLess(moved[~good].max(), 50.0)
@@ -0,0 +1,296 @@
+"""
+extract every GPMF stream (ACCL, GYRO, GRAV, MAGN, TMPC, ISOE, SHUT, WBAL, FACE, ...) to typed arrays with timestamps.
+
+the KLV list is walked once: every STRM's metadata (STNM, SIUN/UNIT, SCAL, TYPE, STMP) is remembered while its samples
+are converted straight from the raw payload with numpy, scaled by SCAL when there is one, and timestamped by spreading
+the samples evenly over the time slot of their DEVC (~1 s). samples are buffered per stream and written in chunks to a
+zip container that np.load() can open (one .npy per chunk), so memory is bounded by the chunk size and not by the
+length of the clip.
+
+    store = TimeseriesStore('GH010198.streams.npz')
+    extractor = StreamExtractor(store)
+    extractor.add_klv(klvlist)
+    store.close()
+
+    load_stream('GH010198.streams.npz', 'GRAV')  # -> times, values
+
+when the layout of the samples of a stream changes mid-clip (another number of columns or another type), what was
+buffered is written and the samples that follow go to a new stream '<stream>.1' (then '.2', ...), with 'part' and
+'of' in its metadata: nothing is dropped.
+"""
+
+import json
+import logging
+import unittest
+import zipfile
+from pathlib import Path
+
+import numpy as np
+
+from . import fourCC
+
+# labels that describe a stream rather than carry samples
+METADATA_LABELS = {'DEVC', 'DVID', 'DVNM', 'STRM', 'STNM', 'SIUN', 'UNIT', 'SCAL', 'TYPE', 'TSMP', 'STMP', 'TICK',
+                   'TOCK', 'TIMO', 'EMPT', 'ORIN', 'ORIO', 'MTRX', 'MFGI'}
+
+
+def payload_values(klv):
+    """
+    the samples of a KLV as a numpy array, straight from the raw payload: (repeat,) or (repeat, n) for plain types,
+    a structured array for complex ('?') types. None when the payload can't be represented
+    """
+    if not klv.rawdata or klv.repeat == 0:
+        return None
+
+    ctype = chr(klv.type)
+    if ctype == '?':
+        return fourCC.decode_complex(klv)
+    if ctype not in fourCC.complex_types:
+        return None
+
+    dtype = np.dtype(fourCC.complex_types[ctype])
+    if klv.size % dtype.itemsize:
+        return None
+    values = np.frombuffer(klv.rawdata, dtype=dtype, count=klv.size * klv.repeat // dtype.itemsize)
+    if dtype.kind in 'iuf':
+        values = values.astype(dtype.newbyteorder('='))
+    columns = klv.size // dtype.itemsize
+    return values.reshape(klv.repeat, columns) if columns > 1 else values
+
+
+def apply_scale(values, scale):
+    if scale is None or values.dtype.kind not in 'iuf':
+        return values
+    scale = np.asarray(scale, dtype=float)
+    if scale.size > 1 and (values.ndim != 2 or values.shape[1] != scale.size):
+        return values
+    return values / scale
+
+
+class StreamExtractor:
+    """
+    turns KLV lists into (stream, times, values) blocks for a TimeseriesStore
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.slot_start = None
+        self.slot_duration = 1.0
+        self.device = None
+        self.devices = {}
+        self._reset_stream()
+
+    def _reset_stream(self):
+        self.stream = {'name': None, 'units': None, 'scale': None, 'type': None, 'stmp': None}
+
+    def add_klv(self, klvlist, time=None, duration=1.0):
+        """
+        klvlist is the parsed content of one or more DEVC. time and duration (seconds) locate the first DEVC in the
+        clip, e.g. from the GPMF packet of the container. without them the DEVC are assumed to be one second apart
+        """
+        first = True
+        for klv in klvlist:
+            label = klv.fourCC
+            if label == 'DEVC':
+                if first and time is not None:
+                    self.slot_start = float(time)
+                elif self.slot_start is None:
+                    self.slot_start = 0.0
+                else:
+                    self.slot_start += self.slot_duration
+                self.slot_duration = duration or 1.0
+                first = False
+                self._reset_stream()
+            elif label == 'DVID':
+                self.device = klv.data
+            elif label == 'STRM':
+                self._reset_stream()
+            elif label == 'STNM':
+                self.stream['name'] = klv.data
+            elif label in ('SIUN', 'UNIT'):
+                # SIUN decodes to one string, UNIT to one string per column
+                self.stream['units'] = klv.data if isinstance(klv.data, str) or not klv.data else list(klv.data)
+            elif label == 'SCAL':
+                self.stream['scale'] = klv.data
+            elif label == 'TYPE':
+                self.stream['type'] = klv.data
+            elif label == 'STMP':
+                stmp = payload_values(klv)
+                self.stream['stmp'] = int(stmp[0]) if stmp is not None else None
+            elif label not in METADATA_LABELS:
+                self._add_samples(klv)
+
+    def _add_samples(self, klv):
+        values = payload_values(klv)
+        if values is None or len(values) == 0:
+            return
+        values = apply_scale(values, self.stream['scale'])
+
+        start = 0.0 if self.slot_start is None else self.slot_start
+        if self.stream['stmp'] is not None:
+            # STMP is the timestamp of the first sample in microseconds
+            start = self.stream['stmp'] / 1e6
+        times = start + np.arange(len(values)) * (self.slot_duration / len(values))
+
+        self.store.append(self._key(klv.fourCC), times, values, {
+            'fourCC': klv.fourCC,
+            'name': self.stream['name'],
+            'units': self.stream['units'],
+            'type': self.stream['type'] or chr(klv.type),
+            'scaled': self.stream['scale'] is not None and values.dtype.kind == 'f',
+        })
+
+    def _key(self, label):
+        # the same fourCC can come from several devices (e.g. the Karma drone and its camera)
+        owner = self.devices.setdefault(label, self.device)
+        return label if owner == self.device else '%s_%s' % (label, self.device)
+
+
+class TimeseriesStore:
+    """
+    chunked, append-only container for the extracted streams. it's a zip of .npy files: for every stream,
+    '<stream>/t_000000.npy' holds the times (seconds) and '<stream>/v_000000.npy' the values of each chunk,
+    and 'streams.json' describes the streams
+    """
+
+    def __init__(self, path, chunk_size=65536):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.zip = zipfile.ZipFile(str(path), 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+        self.buffers = {}
+        self.buffered = {}
+        self.meta = {}
+        # stream -> the key its samples currently go to
+        self.parts = {}
+        self.part_of = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, key, times, values, meta):
+        key = self._part(key, values)
+        if key not in self.meta:
+            self.meta[key] = dict(meta, chunks=0, samples=0, dtype=values.dtype.descr,
+                                  shape=list(values.shape[1:]))
+            if key in self.part_of:
+                self.meta[key].update(zip(('of', 'part'), self.part_of[key]))
+        self.buffers.setdefault(key, []).append((times, values))
+        self.buffered[key] = self.buffered.get(key, 0) + len(values)
+        if self.buffered[key] >= self.chunk_size:
+            self._flush(key)
+
+    def _part(self, key, values):
+        # the key the samples go to: the current part of the stream, or a new part if their layout changed
+        current = self.parts.setdefault(key, key)
+        meta = self.meta.get(current)
+        if meta is None or (meta['dtype'] == values.dtype.descr and meta['shape'] == list(values.shape[1:])):
+            return current
+        self._flush(current)
+        part = self.part_of[current][1] + 1 if current in self.part_of else 1
+        self.parts[key] = '%s.%d' % (key, part)
+        self.part_of[self.parts[key]] = (key, part)
+        logging.getLogger(__name__).info(f'Sample layout of stream {key} changed, continuing in {self.parts[key]}')
+        return self.parts[key]
+
+    def _write_array(self, name, array):
+        with self.zip.open(name + '.npy', 'w', force_zip64=True) as fd:
+            np.lib.format.write_array(fd, np.ascontiguousarray(array), allow_pickle=False)
+
+    def _flush(self, key):
+        buffered = self.buffers.pop(key, [])
+        self.buffered[key] = 0
+        if not buffered:
+            return
+        # one layout per key, see _part()
+        values = np.concatenate([v for _, v in buffered])
+        chunk = self.meta[key]['chunks']
+        self.meta[key]['samples'] += len(values)
+        self._write_array('%s/t_%06d' % (key, chunk), np.concatenate([t for t, _ in buffered]))
+        self._write_array('%s/v_%06d' % (key, chunk), values)
+        self.meta[key]['chunks'] += 1
+
+    def close(self):
+        if self.zip is None:
+            return
+        for key in list(self.buffers):
+            self._flush(key)
+        self.zip.writestr('streams.json', json.dumps(self.meta, indent=1, default=str))
+        self.zip.close()
+        self.zip = None
+
+
+def stream_names(path):
+    with zipfile.ZipFile(str(path)) as zf:
+        return json.loads(zf.read('streams.json'))
+
+
+def load_stream(path, key):
+    """
+    (times, values) of one stream of a TimeseriesStore, all chunks concatenated
+    """
+    meta = stream_names(path)[key]
+    with np.load(str(path)) as npz:
+        times = [npz['%s/t_%06d' % (key, c)] for c in range(meta['chunks'])]
+        values = [npz['%s/v_%06d' % (key, c)] for c in range(meta['chunks'])]
+    if not times:
+        return np.zeros(0), np.zeros(0)
+    return np.concatenate(times), np.concatenate(values)
+
+
+class StreamsTest(unittest.TestCase):
+    SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+
+    def test_layout_change(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'x.streams.npz'
+            with TimeseriesStore(path, chunk_size=4) as store:
+                store.append('ACCL', np.arange(3.0), np.ones((3, 3)), {'fourCC': 'ACCL'})
+                store.append('ACCL', np.arange(3.0, 5.0), np.ones((2, 3)), {'fourCC': 'ACCL'})
+                store.append('ACCL', np.arange(5.0, 6.0), np.ones((1, 3)), {'fourCC': 'ACCL'})
+                # a 4th column from here on
+                store.append('ACCL', np.arange(6.0, 8.0), np.zeros((2, 4)), {'fourCC': 'ACCL'})
+                store.append('ACCL', np.arange(8.0, 9.0), np.zeros((1, 3), dtype=np.int16), {'fourCC': 'ACCL'})
+
+            meta = stream_names(path)
+            self.assertEqual(sorted(meta), ['ACCL', 'ACCL.1', 'ACCL.2'])
+            self.assertEqual((meta['ACCL.2']['of'], meta['ACCL.2']['part']), ('ACCL', 2))
+            times, values = load_stream(path, 'ACCL')
+            np.testing.assert_array_equal(times, np.arange(6.0))
+            self.assertEqual(values.shape, (6, 3))
+            times, values = load_stream(path, 'ACCL.1')
+            np.testing.assert_array_equal(times, [6.0, 7.0])
+            self.assertEqual(values.shape, (2, 4))
+            self.assertEqual(load_stream(path, 'ACCL.2')[1].dtype, np.int16)
+
+    def test_round_trip(self):
+        import tempfile
+        from .klv_extraction import parseStream
+
+        klvlist, _ = parseStream((self.SAMPLES / 'hero6.bin').read_bytes())
+        expected = {}
+        scale = None
+        for klv in klvlist:
+            if klv.fourCC in ('STRM', 'DEVC'):
+                scale = None
+            elif klv.fourCC == 'SCAL':
+                scale = klv.data
+            elif klv.fourCC in ('ACCL', 'GYRO', 'GPS5'):
+                expected.setdefault(klv.fourCC, []).append(apply_scale(payload_values(klv), scale))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'hero6.streams.npz'
+            # small chunks: several per stream
+            with TimeseriesStore(path, chunk_size=500) as store:
+                StreamExtractor(store).add_klv(klvlist)
+            meta = stream_names(path)
+            for label, blocks in expected.items():
+                times, values = load_stream(path, label)
+                np.testing.assert_array_equal(values, np.concatenate(blocks))
+                self.assertEqual(meta[label]['samples'], len(values))
+                self.assertTrue(np.all(np.diff(times) >= 0))
+            self.assertGreater(meta['ACCL']['chunks'], 1)
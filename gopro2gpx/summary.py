@@ -0,0 +1,202 @@
+"""
+per-clip summary numbers for a catalog: time range, duration, bounding box, distance, maximum speed and GPS fix ratio.
+
+the clip is streamed one DEVC at a time (api.iter_devc), every DEVC is decoded and its points are folded into running
+totals as soon as they are built, so the memory doesn't grow with the length of the clip and no track is written or
+kept. one ClipSummary comes out per clip.
+
+the geometry (bounding box, distance, speed, elevation) only uses the points with a GPS fix: without one the position
+is whatever the receiver last guessed. the points without a fix, and the empty ones, are counted in the fix ratio.
+
+usage:
+    python -m gopro2gpx.summary GH010198.MP4
+    python -m gopro2gpx.summary -j 8 -o catalog.csv /archive/**/*.MP4
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import csv
+import logging
+import math
+import sys
+import unittest
+from pathlib import Path
+
+from .geodesy import EARTH_RADIUS
+
+ClipSummary = collections.namedtuple(
+    "ClipSummary",
+    "path start end duration samples fixed fix_ratio min_lat min_lon max_lat max_lon min_elevation max_elevation "
+    "distance max_speed error")
+
+
+class Summarizer:
+    """
+    running statistics of the GPS points of a clip, in constant memory. feed it the KLVs with add(), or points with
+    add_point(), then get the ClipSummary with result()
+    """
+
+    def __init__(self):
+        from .gopro2gpx import GPSPointBuilder
+
+        # the points without a fix are kept, to be counted
+        self.builder = GPSPointBuilder(skip=False)
+        self.start = self.end = None
+        self.fixed = 0
+        self.min_lat = self.min_lon = self.min_elevation = math.inf
+        self.max_lat = self.max_lon = self.max_elevation = -math.inf
+        self.distance = 0.0
+        self.max_speed = 0.0
+        self._last = None
+
+    def add(self, klvlist):
+        for p in self.builder.add(klvlist):
+            self.add_point(p)
+
+    def add_point(self, p):
+        if p.fix == 0:
+            return
+        self.fixed += 1
+        if self.start is None or p.time < self.start:
+            self.start = p.time
+        if self.end is None or p.time > self.end:
+            self.end = p.time
+        self.min_lat = min(self.min_lat, p.latitude)
+        self.max_lat = max(self.max_lat, p.latitude)
+        self.min_lon = min(self.min_lon, p.longitude)
+        self.max_lon = max(self.max_lon, p.longitude)
+        self.min_elevation = min(self.min_elevation, p.elevation)
+        self.max_elevation = max(self.max_elevation, p.elevation)
+        self.max_speed = max(self.max_speed, p.speed)
+
+        lat, lon = math.radians(p.latitude), math.radians(p.longitude)
+        if self._last is not None:
+            # haversine, like geodesy.haversine() for scalars
+            lat0, lon0 = self._last
+            a = math.sin((lat - lat0) / 2) ** 2 + math.cos(lat0) * math.cos(lat) * math.sin((lon - lon0) / 2) ** 2
+            self.distance += 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+        self._last = (lat, lon)
+
+    def result(self, path=None, error=None):
+        stats = self.builder.stats
+        # every GPS sample seen: the points built (fix or not), the ones dropped as empty
+        samples = stats['ok'] + stats['badfixskip'] + stats['empty']
+        located = self.fixed > 0
+
+        def value(v):
+            return v if located else None
+
+        return ClipSummary(
+            str(path) if path is not None else None, self.start, self.end,
+            (self.end - self.start).total_seconds() if located else None,
+            samples, self.fixed, self.fixed / samples if samples else None,
+            value(self.min_lat), value(self.min_lon), value(self.max_lat), value(self.max_lon),
+            value(self.min_elevation), value(self.max_elevation),
+            self.distance, self.max_speed, error)
+
+
+def summarize(source, chunk_size=None):
+    """
+    the ClipSummary of a source (a path, file object, bytes or chunks, see api.py)
+    """
+    from .api import CHUNK_SIZE, iter_devc
+    from .klv_extraction import parseStream
+
+    summarizer = Summarizer()
+    for raw, _, _ in iter_devc(source, chunk_size or CHUNK_SIZE):
+        klvlist, _ = parseStream(raw)
+        summarizer.add(klvlist)
+    return summarizer.result(source if isinstance(source, (str, Path)) else None)
+
+
+def _summarize_file(path):
+    try:
+        return summarize(path)
+    except Exception as e:
+        # a damaged clip doesn't stop the batch, its record says why
+        return ClipSummary(str(path), *([None] * (len(ClipSummary._fields) - 2)), f'{type(e).__name__}: {e}')
+
+
+def summarize_files(paths, jobs=1):
+    """
+    yields the ClipSummary of every path, in order, with jobs processes. a clip that can't be read gives a record with
+    its error
+    """
+    if jobs <= 1:
+        for path in paths:
+            yield _summarize_file(path)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        # small chunks: the clips are of very different lengths
+        yield from pool.map(_summarize_file, paths, chunksize=4)
+
+
+def write_csv(summaries, fd):
+    """
+    one CSV row per ClipSummary, written as they come
+    """
+    writer = csv.writer(fd)
+    writer.writerow(ClipSummary._fields)
+    count = 0
+    for s in summaries:
+        writer.writerow(['' if v is None else v.isoformat() if hasattr(v, 'isoformat') else v for v in s])
+        count += 1
+    return count
+
+
+class SummaryTest(unittest.TestCase):
+    SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+
+    def test_against_track(self):
+        from .geodesy import haversine
+        from .gopro2gpx import BuildGPSPoints
+        from .gpmf import Parser
+        from .config import setup_environment
+
+        path = self.SAMPLES / 'gopro7.bin'
+        config = setup_environment(argparse.Namespace(verbose=0, file=str(path), outputfile=None))
+        points = [p for p in BuildGPSPoints(Parser(config).readFromBinary()) if p.fix != 0]
+        summary = summarize(path)
+
+        self.assertEqual(summary.fixed, len(points))
+        self.assertEqual(summary.start, points[0].time)
+        self.assertEqual(summary.max_speed, max(p.speed for p in points))
+        self.assertEqual((summary.min_lat, summary.max_lon),
+                         (min(p.latitude for p in points), max(p.longitude for p in points)))
+        steps = [haversine(a.latitude, a.longitude, b.latitude, b.longitude) for a, b in zip(points, points[1:])]
+        self.assertAlmostEqual(summary.distance, sum(steps), places=6)
+        self.assertLess(summary.fix_ratio, 1.0)
+
+    def test_errors(self):
+        summaries = list(summarize_files([self.SAMPLES / 'hero5.bin', self.SAMPLES / 'missing.bin']))
+        self.assertIsNone(summaries[0].error)
+        self.assertEqual(summaries[0].fix_ratio, 1.0)
+        self.assertIn('missing.bin', summaries[1].error)
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="summary numbers of GoPro clips, without writing their tracks")
+    parser.add_argument("files", nargs='+', type=Path, help="GoPro video files (.mp4) or binary metadata dumps (.bin)")
+    parser.add_argument("-o", "--output", type=Path, help="CSV file (default: standard output)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="summarize N clips at once (processes)")
+    parser.add_argument('-l', '--loglevel', default='warning', help='Provide logging level. Example --loglevel debug')
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    logging.basicConfig(level=args.loglevel.upper())
+    logger = logging.getLogger(__name__)
+
+    summaries = summarize_files(args.files, args.jobs)
+    if args.output:
+        with open(args.output, "w", newline='') as fd:
+            count = write_csv(summaries, fd)
+        logger.info(f'Wrote {count} clips to {str(args.output)}')
+    else:
+        write_csv(summaries, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+helpers of the inline tests: GoPro-like MP4 files, for the code that needs a real container.
+
+write_test_video() writes a playable clip with PyAV (13 or later, see can_write_test_video()), write_gpmf_mp4() only
+the boxes of a GPMF track around the data, in pure python, for the MP4 parsers.
+
+    if not can_write_test_video():
+        self.skipTest('PyAV can not write data streams')
+    frames = write_test_video(path, (SAMPLES / 'hero6.bin').read_bytes())
+"""
+
+import struct
+
+
+def split_devc(gpmf):
+    """
+    the whole top level KLVs (DEVC) of gpmf, without a last one cut short
+    """
+    devcs = []
+    offset = 0
+    while offset + 8 <= len(gpmf):
+        _, _, length, repeat = struct.unpack_from('>4sBBH', gpmf, offset)
+        end = offset + 8 + -(-length * repeat // 4) * 4
+        if end > len(gpmf):
+            # a DEVC cut short: the clip ends before it
+            break
+        devcs.append(gpmf[offset:end])
+        offset = end
+    return devcs
+
+
+def _box(kind, *payload):
+    payload = b''.join(payload)
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def _full_box(kind, *payload):
+    # version 0, no flags
+    return _box(kind, b'\0' * 4, *payload)
+
+
+def write_gpmf_mp4(path, gpmf, timescale=1000, chunk_samples=(2, 1), co64=False):
+    """
+    an MP4 with only a 'GoPro MET' track: one sample per DEVC of gpmf, one second each. the samples are grouped in
+    chunks of chunk_samples[0] samples, the last ones of chunk_samples[1] (two stsc runs), with 64 bit chunk offsets
+    if co64. returns the DEVCs
+    """
+    devcs = split_devc(gpmf)
+    first, rest = chunk_samples
+    chunks = []
+    sample = 0
+    while sample < len(devcs):
+        count = first if sample + first <= len(devcs) // 2 else rest
+        chunks.append(devcs[sample:sample + count])
+        sample += count
+
+    ftyp = _box(b'ftyp', b'mp42', b'\0\0\0\0', b'mp42isom')
+    mdat_start = len(ftyp) + 8
+    offsets = []
+    offset = mdat_start
+    for chunk in chunks:
+        offsets.append(offset)
+        offset += sum(len(devc) for devc in chunk)
+    mdat = _box(b'mdat', *(devc for chunk in chunks for devc in chunk))
+
+    runs = [(1, len(chunks[0]))]
+    for number, chunk in enumerate(chunks[1:], 2):
+        if len(chunk) != runs[-1][1]:
+            runs.append((number, len(chunk)))
+    if co64:
+        chunk_offsets = _full_box(b'co64', struct.pack('>I%dQ' % len(offsets), len(offsets), *offsets))
+    else:
+        chunk_offsets = _full_box(b'stco', struct.pack('>I%dI' % len(offsets), len(offsets), *offsets))
+    stbl = _box(b'stbl',
+                _full_box(b'stsd', struct.pack('>I', 1), _box(b'gpmd', b'\0' * 6, struct.pack('>H', 1))),
+                _full_box(b'stts', struct.pack('>III', 1, len(devcs), timescale)),
+                _full_box(b'stsc', struct.pack('>I', len(runs)),
+                          *(struct.pack('>III', number, count, 1) for number, count in runs)),
+                _full_box(b'stsz', struct.pack('>II%dI' % len(devcs), 0, len(devcs), *map(len, devcs))),
+                chunk_offsets)
+    mdia = _box(b'mdia',
+                _full_box(b'mdhd', struct.pack('>IIIIHH', 0, 0, timescale, timescale * len(devcs), 0, 0)),
+                _full_box(b'hdlr', struct.pack('>I4s12x', 0, b'meta'), b'\tGoPro MET\0'),
+                _box(b'minf', stbl))
+    moov = _box(b'moov', _box(b'trak', mdia))
+
+    with open(str(path), 'wb') as fd:
+        fd.write(ftyp + mdat + moov)
+    return devcs
+
+
+def can_write_test_video():
+    try:
+        import av
+    except ImportError:
+        return False
+    return hasattr(av.container.OutputContainer, 'add_data_stream')
+
+
+def write_test_video(path, gpmf, fps=10, size=(64, 48)):
+    """
+    a tiny GoPro-like MP4 for the tests: a video track of fps gray frames per second and a 'GoPro MET' data track with
+    one whole DEVC of gpmf (a GPMF track, e.g. a sample .bin) per second. needs PyAV 13 or later (data streams can't be
+    written before, see can_write_test_video()). returns the number of frames
+    """
+    import fractions
+
+    import av
+    import numpy as np
+
+    devcs = split_devc(gpmf)
+    width, height = size
+    with av.open(str(path), 'w', format='mp4') as container:
+        video = container.add_stream('mpeg4', rate=fps)
+        video.width, video.height, video.pix_fmt = width, height, 'yuv420p'
+        data = container.add_data_stream(codec_name='bin_data')
+        data.metadata['handler_name'] = '\tGoPro MET'
+        data.time_base = fractions.Fraction(1, 1000)
+        for i, devc in enumerate(devcs):
+            for k in range(fps):
+                frame = av.VideoFrame.from_ndarray(np.full((height, width, 3), (i * fps + k) % 255, np.uint8),
+                                                   format='rgb24')
+                frame.pts = i * fps + k
+                container.mux(video.encode(frame))
+            packet = av.Packet(devc)
+            packet.stream = data
+            packet.pts = packet.dts = i * 1000
+            packet.duration = 1000
+            packet.time_base = data.time_base
+            container.mux(packet)
+        container.mux(video.encode())
+    return len(devcs) * fps
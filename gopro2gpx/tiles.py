@@ -0,0 +1,539 @@
+"""
+vector tiles (Mapbox Vector Tile, MVT) of a batch of tracks, for a web map.
+
+every track of the batch is cut into a z/x/y directory of .mvt tiles (one layer, one LineString/MultiLineString
+feature per track and tile, with the track name and start time), and a metadata.json (TileJSON) describing them.
+any MVT client (MapLibre, Leaflet.VectorGrid, OpenLayers) can serve the directory as static files.
+
+each zoom level is built for all the tracks at once, with numpy:
+
+  * the points are projected once to web mercator, then scaled to the tile grid of the zoom (EXTENT units per tile)
+  * simplification: the points are snapped to the grid and the repeated ones dropped, then Douglas-Peucker
+    (simplify.douglas_peucker_many, all the tracks at once) with a tolerance of a fraction of a screen pixel. the
+    zooms are built from the most detailed one down, each one starting from the points the previous one kept
+  * a segment crossing the antimeridian (more than half the world from one end to the other) is cut in two at the
+    edge of the world, instead of being drawn across it. segments longer than a tile are split, every segment is
+    paired with the tiles its buffered bounding box touches, and clipped to each tile (Liang-Barsky, vectorized over
+    all the pairs)
+  * the pairs are sorted by tile and the runs of consecutive segments become the lines of the features, encoded to
+    protobuf with vectorized varints
+
+so the cost is a few numpy passes per zoom over all the points of the batch, plus writing the files.
+
+usage:
+    python -m gopro2gpx.tiles tiles/ --max_zoom 16 -j 8 /archive/**/*.MP4
+    python -m gopro2gpx.tiles tiles/ fleet.geojsonl        # tracks written by gopro2gpx -f geojson
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import logging
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from .simplify import douglas_peucker_many
+
+# coordinates per tile side, and the margin (in the same units) drawn around every tile so lines join at the borders
+EXTENT = 4096
+BUFFER = 64
+# screen pixels per tile side, for the simplification tolerance
+TILE_PIXELS = 256
+MAX_LATITUDE = 85.0511287798
+LAYER = 'tracks'
+
+Track = collections.namedtuple("Track", "name start lat lon")
+
+_MOVE_TO = 1
+_LINE_TO = 2
+_LINESTRING = 2
+
+
+def mercator(lat, lon):
+    """
+    web mercator coordinates in [0, 1) of the world, x to the east and y to the south (the tile numbering of z/x/y)
+    """
+    lat = np.radians(np.clip(np.asarray(lat, dtype=float), -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(lon, dtype=float) + 180.0) / 360.0
+    y = 0.5 - np.arcsinh(np.tan(lat)) / (2 * np.pi)
+    return x, y
+
+
+# protobuf
+
+def _varint(n):
+    out = bytearray()
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _varints(values):
+    """
+    the varints of an array of unsigned integers (< 2**35), concatenated, without a loop over the values
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    if len(values) == 0:
+        return b''
+    shifts = np.arange(0, 35, 7, dtype=np.uint64)
+    groups = ((values[:, None] >> shifts) & np.uint64(0x7f)).astype(np.uint8)
+    count = 1 + (values[:, None] >= (np.uint64(1) << shifts[1:])).sum(axis=1)
+    used = np.arange(5) < count[:, None]
+    # the continuation bit on every byte but the last of each value
+    groups[np.arange(5) < (count - 1)[:, None]] |= 0x80
+    return groups[used].tobytes()
+
+
+def _zigzag(values):
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+
+def _field(number, payload):
+    # a length-delimited field
+    return _varint((number << 3) | 2) + _varint(len(payload)) + payload
+
+
+def _geometry(lines):
+    """
+    the geometry commands of a (multi)linestring, lines being (n, 2) integer arrays of tile coordinates
+    """
+    parts = []
+    cursor = np.zeros(2, dtype=np.int64)
+    for line in lines:
+        deltas = np.diff(line, axis=0, prepend=cursor[None, :])
+        cursor = line[-1]
+        zz = _zigzag(deltas.reshape(-1))
+        parts.append(np.array([_MOVE_TO | (1 << 3)], dtype=np.uint64))
+        parts.append(zz[:2])
+        parts.append(np.array([_LINE_TO | ((len(line) - 1) << 3)], dtype=np.uint64))
+        parts.append(zz[2:])
+    return np.concatenate(parts)
+
+
+def encode_tile(features, layer=LAYER, extent=EXTENT):
+    """
+    one MVT layer as bytes. features are (id, properties dict, [lines]) with lines as (n, 2) integer arrays
+    """
+    keys = {}
+    values = {}
+    encoded = []
+    for feature_id, properties, lines in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault(str(value), len(values)))
+        feature = (b'\x08' + _varint(feature_id) + _field(2, _varints(tags)) + b'\x18' + _varint(_LINESTRING) +
+                   _field(4, _varints(_geometry(lines))))
+        encoded.append(_field(2, feature))
+
+    body = b'x\x02' + _field(1, layer.encode())  # version 2 (field 15), name
+    body += b''.join(encoded)
+    body += b''.join(_field(3, key.encode()) for key in keys)
+    body += b''.join(_field(4, _field(1, value.encode())) for value in values)
+    body += b'\x28' + _varint(extent)
+    return _field(3, body)
+
+
+# tiling
+
+def _snap(x, y, track, tolerance):
+    """
+    per track: the indices of the points rounded to the tile grid, without the repeated ones and simplified with
+    Douglas-Peucker
+    """
+    x = np.round(x)
+    y = np.round(y)
+    first = np.ones(len(x), dtype=bool)
+    first[1:] = (track[1:] != track[:-1])
+    last = np.roll(first, -1)
+    moved = np.ones(len(x), dtype=bool)
+    moved[1:] = (x[1:] != x[:-1]) | (y[1:] != y[:-1])
+    kept = np.flatnonzero(moved | first | last)
+
+    if tolerance > 0:
+        track = track[kept]
+        bounds = np.flatnonzero(np.diff(track, prepend=-1, append=-1))
+        kept = kept[douglas_peucker_many(np.column_stack([x[kept], y[kept]]), bounds[:-1], bounds[1:], tolerance)]
+    return kept
+
+
+def _segments(x, y, track, extent, world):
+    """
+    the segments of every track as (x0, y0, x1, y1, track), none longer than one tile nor crossing the antimeridian.
+    world is the width of the world in the units of x
+    """
+    same = track[1:] == track[:-1]
+    x0, y0, x1, y1 = x[:-1][same], y[:-1][same], x[1:][same], y[1:][same]
+    seg_track = track[:-1][same]
+
+    # the short way round is across the antimeridian: to the edge of the world, and on from the other edge
+    east = x0 - x1 > world / 2
+    west = x1 - x0 > world / 2
+    wraps = east | west
+    if wraps.any():
+        ix = np.repeat(np.arange(len(x0)), np.where(wraps, 2, 1))
+        second = np.zeros(len(ix), dtype=bool)
+        second[1:] = ix[1:] == ix[:-1]
+        first = wraps[ix] & ~second
+        edge = np.where(east, world, 0.0)
+        # where the segment, unwrapped, meets the edge (it can start on it, after the rounding to the grid)
+        run = x1 + np.where(east, world, 0.0) - np.where(west, world, 0.0) - x0
+        f = np.divide(edge - x0, run, out=np.zeros(len(x0)), where=wraps & (run != 0))
+        y_edge = y0 + (y1 - y0) * f
+        x0, y0, x1, y1, seg_track = (
+            np.where(second, world - edge[ix], x0[ix]), np.where(second, y_edge[ix], y0[ix]),
+            np.where(first, edge[ix], x1[ix]), np.where(first, y_edge[ix], y1[ix]), seg_track[ix])
+
+    pieces = np.maximum(np.ceil(np.maximum(np.abs(x1 - x0), np.abs(y1 - y0)) / extent), 1).astype(np.int64)
+    if (pieces > 1).any():
+        ix = np.repeat(np.arange(len(pieces)), pieces)
+        # k / pieces for the k-th piece of every segment
+        k = np.arange(len(ix)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        f0 = k / pieces[ix]
+        f1 = (k + 1) / pieces[ix]
+        dx, dy = x1 - x0, y1 - y0
+        x0, y0, x1, y1 = (x0[ix] + dx[ix] * f0, y0[ix] + dy[ix] * f0, x0[ix] + dx[ix] * f1, y0[ix] + dy[ix] * f1)
+        seg_track = seg_track[ix]
+    return x0, y0, x1, y1, seg_track
+
+
+def _clip(x0, y0, x1, y1, xmin, ymin, xmax, ymax):
+    """
+    Liang-Barsky on arrays: the parameters (t0, t1) of the part of every segment inside its box, t0 > t1 if none
+    """
+    t0 = np.zeros(len(x0))
+    t1 = np.ones(len(x0))
+    dx = x1 - x0
+    dy = y1 - y0
+    for p, q in ((-dx, x0 - xmin), (dx, xmax - x0), (-dy, y0 - ymin), (dy, ymax - y0)):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = q / p
+        parallel = p == 0
+        # parallel to this edge: inside or outside for all t
+        t1 = np.where(parallel & (q < 0), -1.0, t1)
+        t0 = np.where(~parallel & (p < 0), np.maximum(t0, r), t0)
+        t1 = np.where(~parallel & (p > 0), np.minimum(t1, r), t1)
+    return t0, t1
+
+
+def tile_zoom(x, y, track, zoom, extent=EXTENT, buffer=BUFFER, tolerance=0.5):
+    """
+    the lines of every tile of one zoom level: {(x, y): {track: [lines]}}, lines as (n, 2) int arrays of tile
+    coordinates, and the indices of the points left after the simplification. x and y are the mercator coordinates of
+    all the points, track their track number (sorted by track). tolerance is in screen pixels
+    """
+    scale = float(1 << zoom) * extent
+    kept = _snap(x * scale, y * scale, track, tolerance * extent / TILE_PIXELS)
+    gx, gy, track = np.round(x[kept] * scale), np.round(y[kept] * scale), track[kept]
+    x0, y0, x1, y1, seg_track = _segments(gx, gy, track, extent, scale)
+    if len(x0) == 0:
+        return {}, kept
+
+    # every tile the buffered bounding box of a segment touches: at most 3 x 3 as no segment is longer than a tile
+    tx_min = np.floor((np.minimum(x0, x1) - buffer) / extent).astype(np.int64)
+    tx_max = np.floor((np.maximum(x0, x1) + buffer) / extent).astype(np.int64)
+    ty_min = np.floor((np.minimum(y0, y1) - buffer) / extent).astype(np.int64)
+    ty_max = np.floor((np.maximum(y0, y1) + buffer) / extent).astype(np.int64)
+    seg = np.arange(len(x0))
+    pairs_seg, pairs_tx, pairs_ty = [], [], []
+    for dx in range(3):
+        for dy in range(3):
+            ok = (tx_min + dx <= tx_max) & (ty_min + dy <= ty_max)
+            pairs_seg.append(seg[ok])
+            pairs_tx.append(tx_min[ok] + dx)
+            pairs_ty.append(ty_min[ok] + dy)
+    s = np.concatenate(pairs_seg)
+    tx = np.concatenate(pairs_tx)
+    ty = np.concatenate(pairs_ty)
+    tiles = 1 << zoom
+    inside = (tx >= 0) & (tx < tiles) & (ty >= 0) & (ty < tiles)
+    s, tx, ty = s[inside], tx[inside], ty[inside]
+
+    # clip to the buffered tile, in tile coordinates
+    ox = tx * extent
+    oy = ty * extent
+    ax, ay, bx, by = x0[s] - ox, y0[s] - oy, x1[s] - ox, y1[s] - oy
+    t0, t1 = _clip(ax, ay, bx, by, -buffer, -buffer, extent + buffer, extent + buffer)
+    hit = t0 <= t1
+    s, tx, ty, ax, ay, bx, by, t0, t1 = (v[hit] for v in (s, tx, ty, ax, ay, bx, by, t0, t1))
+    cx0 = np.round(ax + (bx - ax) * t0).astype(np.int64)
+    cy0 = np.round(ay + (by - ay) * t0).astype(np.int64)
+    cx1 = np.round(ax + (bx - ax) * t1).astype(np.int64)
+    cy1 = np.round(ay + (by - ay) * t1).astype(np.int64)
+
+    # by tile, then in track order: runs of consecutive, unclipped joints are one line (not across the antimeridian,
+    # where a segment doesn't start at the end of the one before it)
+    key = tx * tiles + ty
+    order = np.lexsort((s, key))
+    s, key, cx0, cy0, cx1, cy1, t0, t1 = (v[order] for v in (s, key, cx0, cy0, cx1, cy1, t0, t1))
+    new_run = np.ones(len(s), dtype=bool)
+    new_run[1:] = ((key[1:] != key[:-1]) | (s[1:] != s[:-1] + 1) | (seg_track[s[1:]] != seg_track[s[:-1]]) |
+                   (t1[:-1] < 1) | (t0[1:] > 0) | (x1[s[:-1]] != x0[s[1:]]) | (y1[s[:-1]] != y0[s[1:]]))
+    starts = np.flatnonzero(new_run)
+    ends = np.append(starts[1:], len(s))
+
+    result = {}
+    for start, end in zip(starts, ends):
+        line = np.empty((end - start + 1, 2), dtype=np.int64)
+        line[0] = cx0[start], cy0[start]
+        line[1:, 0] = cx1[start:end]
+        line[1:, 1] = cy1[start:end]
+        # rounding can repeat a point: drop the repeats, and the lines that collapse to a point
+        moved = np.ones(len(line), dtype=bool)
+        moved[1:] = (line[1:] != line[:-1]).any(axis=1)
+        line = line[moved]
+        if len(line) < 2:
+            continue
+        k = int(key[start])
+        tile = result.setdefault((k // tiles, k % tiles), {})
+        tile.setdefault(int(seg_track[s[start]]), []).append(line)
+    return result, kept
+
+
+def build_tiles(tracks, output_dir, min_zoom=0, max_zoom=14, tolerance=0.5, layer=LAYER, extent=EXTENT,
+                buffer=BUFFER):
+    """
+    write output_dir/z/x/y.mvt for every zoom in [min_zoom, max_zoom] and output_dir/metadata.json. tracks are
+    Track(name, start, lat, lon). returns the number of tiles written
+    """
+    logger = logging.getLogger(__name__)
+    output_dir = Path(output_dir)
+    tracks = [t for t in tracks if len(t.lat) > 1]
+    if not tracks:
+        logger.warning('No tracks to tile')
+        return 0
+
+    lat = np.concatenate([np.asarray(t.lat, dtype=float) for t in tracks])
+    lon = np.concatenate([np.asarray(t.lon, dtype=float) for t in tracks])
+    track = np.repeat(np.arange(len(tracks)), [len(t.lat) for t in tracks])
+    x, y = mercator(lat, lon)
+    properties = [{'name': t.name, 'start': t.start} for t in tracks]
+
+    written = 0
+    # from the most detailed zoom down, each zoom simplifying what the previous one kept
+    for zoom in range(max_zoom, min_zoom - 1, -1):
+        tiles, kept = tile_zoom(x, y, track, zoom, extent, buffer, tolerance)
+        x, y, track = x[kept], y[kept], track[kept]
+        for (tx, ty), lines in tiles.items():
+            path = output_dir / str(zoom) / str(tx) / f'{ty}.mvt'
+            path.parent.mkdir(parents=True, exist_ok=True)
+            features = [(number + 1, properties[number], lines[number]) for number in sorted(lines)]
+            with open(path, 'wb') as fd:
+                fd.write(encode_tile(features, layer, extent))
+        logger.info(f'zoom {zoom}: {len(tiles)} tiles')
+        written += len(tiles)
+
+    metadata = {
+        'tilejson': '3.0.0', 'name': layer, 'format': 'pbf', 'scheme': 'xyz', 'tiles': ['{z}/{x}/{y}.mvt'],
+        'minzoom': min_zoom, 'maxzoom': max_zoom,
+        'bounds': [float(lon.min()), float(lat.min()), float(lon.max()), float(lat.max())],
+        'vector_layers': [{'id': layer, 'minzoom': min_zoom, 'maxzoom': max_zoom,
+                           'fields': {'name': 'String', 'start': 'String'}}],
+    }
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with open(output_dir / 'metadata.json', 'w') as fd:
+        json.dump(metadata, fd, indent=1)
+    return written
+
+
+# inputs
+
+def read_geojsonseq(path):
+    """
+    the Track of every LineString feature of a newline-delimited GeoJSON file
+    """
+    with open(path) as fd:
+        for line in fd:
+            line = line.strip().lstrip('\x1e')
+            if not line:
+                continue
+            feature = json.loads(line)
+            geometry = feature.get('geometry') or {}
+            if geometry.get('type') != 'LineString':
+                continue
+            coordinates = np.asarray(geometry['coordinates'], dtype=float)
+            properties = feature.get('properties') or {}
+            yield Track(properties.get('name', Path(path).stem), properties.get('start'),
+                        coordinates[:, 1], coordinates[:, 0])
+
+
+def read_clip(path, skip=False):
+    """
+    the Track of a video (.mp4) or binary metadata dump (.bin), streamed one DEVC at a time
+    """
+    from .api import iter_points
+    from .gpshelper import UTCTime
+
+    lat, lon = [], []
+    start = None
+    for p in iter_points(path, skip=skip):
+        if start is None:
+            start = UTCTime(p.time)
+        lat.append(p.latitude)
+        lon.append(p.longitude)
+    return Track(Path(path).stem, start, np.array(lat), np.array(lon))
+
+
+def load_tracks(paths, skip=False, jobs=1):
+    """
+    the tracks of a batch of clips and GeoJSON-seq files, the clips parsed with jobs processes
+    """
+    geojson = [p for p in paths if Path(p).suffix.lower() in ('.geojsonl', '.geojsons', '.jsonl')]
+    clips = [p for p in paths if p not in geojson]
+    tracks = []
+    for path in geojson:
+        tracks.extend(read_geojsonseq(path))
+    if jobs > 1 and len(clips) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            tracks.extend(pool.map(read_clip, clips, [skip] * len(clips), chunksize=4))
+    else:
+        tracks.extend(read_clip(path, skip) for path in clips)
+    return tracks
+
+
+class TilesTest(unittest.TestCase):
+    SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+
+    @staticmethod
+    def _read_varint(data, offset):
+        value = shift = 0
+        while True:
+            byte = data[offset]
+            offset += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                return value, offset
+
+    def _fields(self, data):
+        # (field number, value) of a protobuf message, bytes for the length-delimited ones
+        offset = 0
+        while offset < len(data):
+            key, offset = self._read_varint(data, offset)
+            if key & 7 == 0:
+                value, offset = self._read_varint(data, offset)
+            else:
+                length, offset = self._read_varint(data, offset)
+                value, offset = data[offset:offset + length], offset + length
+            yield key >> 3, value
+
+    def _decode_geometry(self, data):
+        ints = []
+        offset = 0
+        while offset < len(data):
+            value, offset = self._read_varint(data, offset)
+            ints.append(value)
+        lines, x, y, i = [], 0, 0, 0
+        while i < len(ints):
+            command, count = ints[i] & 7, ints[i] >> 3
+            i += 1
+            if command == _MOVE_TO:
+                lines.append([])
+            for _ in range(count):
+                dx, dy = ((v >> 1) ^ -(v & 1) for v in ints[i:i + 2])
+                x, y = x + dx, y + dy
+                lines[-1].append([x, y])
+                i += 2
+        return lines
+
+    def test_varints(self):
+        values = [0, 1, 127, 128, 300, 16384, 2 ** 21, 2 ** 28 + 5, 2 ** 32 - 1]
+        self.assertEqual(_varints(values), b''.join(_varint(v) for v in values))
+        self.assertEqual(_zigzag([0, -1, 1, -2, 2]).tolist(), [0, 1, 2, 3, 4])
+
+    def test_round_trip(self):
+        line = np.array([[10, 20], [4000, 20], [4000, 4000], [-30, 4100]])
+        tile = encode_tile([(7, {'name': 'clip', 'start': None}, [line, line[::-1]])])
+        (number, layer), = self._fields(tile)
+        self.assertEqual(number, 3)
+        fields = list(self._fields(layer))
+        self.assertIn((15, 2), fields)
+        self.assertIn((5, EXTENT), fields)
+        self.assertIn((3, b'name'), fields)
+        feature = dict(self._fields(next(v for n, v in fields if n == 2)))
+        self.assertEqual(feature[1], 7)
+        self.assertEqual(self._decode_geometry(feature[4]), [line.tolist(), line[::-1].tolist()])
+
+    def test_tiles_cover_track(self):
+        track = read_clip(self.SAMPLES / 'gopro7.bin')
+        x, y = mercator(track.lat, track.lon)
+        numbers = np.zeros(len(x), dtype=np.int64)
+        zoom = 18
+        tiles, _ = tile_zoom(x, y, numbers, zoom, tolerance=0)
+        # every point of the track falls in a tile that has lines, at its own position
+        scale = float(1 << zoom) * EXTENT
+        for px, py in zip(np.round(x * scale).astype(np.int64), np.round(y * scale).astype(np.int64)):
+            key = (int(px // EXTENT), int(py // EXTENT))
+            self.assertIn(key, tiles)
+            points = np.concatenate(tiles[key][0])
+            local = np.array([px - key[0] * EXTENT, py - key[1] * EXTENT])
+            self.assertTrue((points == local).all(axis=1).any())
+
+    def test_antimeridian(self):
+        # eastwards and back westwards across the antimeridian: cut at the edge, in both directions
+        x = np.array([95.0, 5.0, 95.0])
+        segments = np.column_stack(_segments(x, np.array([10.0, 20.0, 30.0]), np.zeros(3, dtype=np.int64), 1000, 100))
+        self.assertEqual(segments.tolist(), [[95, 10, 100, 15, 0], [0, 15, 5, 20, 0],
+                                             [5, 20, 0, 25, 0], [100, 25, 95, 30, 0]])
+
+        lon = np.concatenate([np.linspace(179.0, 179.99, 50), np.linspace(-179.99, -179.0, 50)])
+        x, y = mercator(np.linspace(-16.0, -17.0, 100), lon)
+        numbers = np.zeros(len(x), dtype=np.int64)
+        for zoom in (0, 2, 8):
+            tiles, _ = tile_zoom(x, y, numbers, zoom, tolerance=0)
+            # only the tiles at both ends of the world, and no line across it
+            self.assertEqual({tx for tx, _ in tiles}, {0, (1 << zoom) - 1})
+            for lines in tiles.values():
+                for line in lines[0]:
+                    self.assertLess(np.abs(np.diff(line[:, 0])).max(), EXTENT / 2)
+
+    def test_simplified_zooms(self):
+        track = read_clip(self.SAMPLES / 'gopro7.bin')
+        x, y = mercator(track.lat, track.lon)
+        numbers = np.zeros(len(x), dtype=np.int64)
+        counts = [sum(len(line) for lines in tile_zoom(x, y, numbers, zoom)[0].values() for line in lines[0])
+                  for zoom in (10, 14, 18)]
+        self.assertEqual(counts, sorted(counts))
+        self.assertLess(counts[0], len(x) / 10)
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="vector tiles (MVT) of the tracks of a batch of GoPro clips")
+    parser.add_argument("output", type=Path, help="output directory (z/x/y.mvt and metadata.json)")
+    parser.add_argument("files", nargs='+', type=Path,
+                        help="GoPro videos (.mp4), binary metadata dumps (.bin) or GeoJSON-seq tracks (.geojsonl)")
+    parser.add_argument("--min_zoom", type=int, default=0)
+    parser.add_argument("--max_zoom", type=int, default=14)
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="simplification tolerance in screen pixels (default: %(default)s)")
+    parser.add_argument("--layer", default=LAYER, help="name of the tile layer (default: %(default)s)")
+    parser.add_argument("-s", "--skip", help="Skip bad points (GPSFIX=0)", action="store_true", default=False)
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="parse N clips at once (processes)")
+    parser.add_argument('-l', '--loglevel', default='info', help='Provide logging level. Example --loglevel debug')
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    logging.basicConfig(level=args.loglevel.upper())
+    logger = logging.getLogger(__name__)
+
+    tracks = load_tracks(args.files, skip=args.skip, jobs=args.jobs)
+    logger.info(f'{len(tracks)} tracks, {sum(len(t.lat) for t in tracks)} points')
+    count = build_tiles(tracks, args.output, args.min_zoom, args.max_zoom, args.tolerance, args.layer)
+    logger.info(f'Wrote {count} tiles to {str(args.output)}')
+
+
+if __name__ == "__main__":
+    main()
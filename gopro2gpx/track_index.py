@@ -0,0 +1,345 @@
+"""
+persistent spatial/temporal index over an archive of extracted tracks.
+
+each clip is stored once in a SQLite database with its bounding box, its time range and a downsampled copy of its
+geometry (packed numpy arrays in BLOBs). a query like "which clips passed within 50 m of this point between these
+dates" first narrows the candidates with the bounding boxes and time ranges (indexed columns), then checks the exact
+distances of the candidate clips with one vectorized pass each. the distance is to the segments between the stored
+samples, not to the samples themselves: a fast clip (a car, a drone) moves tens of metres between two samples and
+would otherwise slip through a small radius. the boxes hold the segments too, they span all the samples.
+
+a clip that crosses the antimeridian gets a wrapped longitude box, min_lon > max_lon (e.g. 179.9 .. -179.9): its
+box is the one that leaves out the largest gap between its longitudes, not the one spanning the whole world.
+
+usage:
+    python -m gopro2gpx.track_index archive.db add GH010198.MP4 GH010199.MP4 dump.bin
+    python -m gopro2gpx.track_index archive.db query 40.4168 -3.7038 --radius 50 --start 2020-01-01 --end 2020-02-01
+"""
+
+import argparse
+import collections
+import logging
+import math
+import sqlite3
+import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+
+from .config import setup_environment
+from .geodesy import EARTH_RADIUS, haversine
+from .gopro2gpx import BuildGPSPoints
+from . import gpmf, gpshelper
+
+ClipMatch = collections.namedtuple("ClipMatch", "path start offsets_ms min_distance")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clips (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    start_us INTEGER NOT NULL,
+    end_us INTEGER NOT NULL,
+    min_lat REAL NOT NULL,
+    max_lat REAL NOT NULL,
+    min_lon REAL NOT NULL,
+    max_lon REAL NOT NULL,
+    n_points INTEGER NOT NULL,
+    offsets_ms BLOB NOT NULL,
+    geometry BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS clips_time ON clips (start_us, end_us);
+CREATE INDEX IF NOT EXISTS clips_lat ON clips (min_lat, max_lat);
+"""
+
+
+def _to_us(t):
+    return int(np.datetime64(t, 'us').astype(np.int64))
+
+
+def _lon_bounds(lon):
+    # (min_lon, max_lon) leaving out the largest gap between the longitudes, min_lon > max_lon if it wraps at 180
+    lon = np.unique(lon)
+    gaps = np.diff(lon, append=lon[0] + 360)
+    i = int(np.argmax(gaps))
+    if i == len(lon) - 1:
+        return float(lon[0]), float(lon[-1])
+    return float(lon[i + 1]), float(lon[i])
+
+
+def _lon_ranges(lon, dlon):
+    # [lon - dlon, lon + dlon] as up to two ranges within [-180, 180], or None if it is all of them
+    if dlon >= 180:
+        return None
+    lon = (lon + 180) % 360 - 180
+    if lon - dlon < -180:
+        return [(lon - dlon + 360, 180.0), (-180.0, lon + dlon)]
+    if lon + dlon > 180:
+        return [(lon - dlon, 180.0), (-180.0, lon + dlon - 360)]
+    return [(lon - dlon, lon + dlon)]
+
+
+def _closest_approach(lat, lon, geometry, offsets, low_ms=-np.inf, high_ms=np.inf):
+    # (distance, offset) of the closest point of each segment of the track to (lat, lon), only looking at the part of
+    # the segment between the offsets low_ms and high_ms (inf distance if none of it is). a single sample is a segment
+    # of length 0. the closest point is found on a local equirectangular projection around (lat, lon)
+    if len(geometry) == 1:
+        a = b = geometry
+        o0 = o1 = offsets
+    else:
+        a, b = geometry[:-1], geometry[1:]
+        o0, o1 = offsets[:-1], offsets[1:]
+    kx = max(math.cos(math.radians(lat)), 1e-6)
+    ax = ((a[:, 1] - lon + 180) % 360 - 180) * kx
+    ay = a[:, 0] - lat
+    dx = ((b[:, 1] - a[:, 1] + 180) % 360 - 180) * kx
+    dy = b[:, 0] - a[:, 0]
+    length2 = dx * dx + dy * dy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(length2 > 0, -(ax * dx + ay * dy) / length2, 0.0)
+        dt = (o1 - o0).astype(float)
+        t_low = np.where(dt > 0, (low_ms - o0) / dt, 0.0)
+        t_high = np.where(dt > 0, (high_ms - o0) / dt, 1.0)
+    # the distance is convex along the segment: clamping to the time window gives the closest point within it
+    t = np.clip(t, np.clip(t_low, 0.0, 1.0), np.clip(t_high, 0.0, 1.0))
+    distance = haversine(lat, lon, a[:, 0] + t * dy, a[:, 1] + t * dx / kx)
+    distance[(o1 < low_ms) | (o0 > high_ms)] = np.inf
+    return distance, np.rint(o0 + t * dt).astype(np.int64)
+
+
+def load_points(path, skip=False):
+    """
+    extract the GPS points of a video (via ffmpeg) or of a binary metadata dump (.bin)
+    """
+    path = Path(path)
+    config = setup_environment(argparse.Namespace(verbose=0, file=str(path), outputfile=None))
+    parser = gpmf.Parser(config)
+    if path.suffix.lower() == '.bin':
+        data = parser.readFromBinary()
+    else:
+        data = parser.readFromMP4()
+    return BuildGPSPoints(data, skip=skip)
+
+
+class TrackIndex:
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(str(db_path))
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def add_clip(self, path, points, interval_s=1.0):
+        """
+        (re)index one clip from the output of BuildGPSPoints. the geometry is thinned to one sample per interval_s
+        """
+        path = str(Path(path).resolve())
+        if not points:
+            logging.getLogger(__name__).warning(f'No GPS points in {path}, not indexed')
+            return False
+
+        times = np.array([_to_us(p.time) for p in points], dtype=np.int64)
+        # in time order, so the offsets count from start_us, the earliest sample
+        order = np.argsort(times, kind='stable')
+        times = times[order]
+        lat = np.array([p.latitude for p in points])[order]
+        lon = np.array([p.longitude for p in points])[order]
+        min_lon, max_lon = _lon_bounds(lon)
+
+        offsets_ms = (times - times[0]) // 1000
+        bucket = offsets_ms // max(int(interval_s * 1000), 1)
+        keep = np.flatnonzero(np.diff(bucket, prepend=-1) != 0)
+        keep = np.union1d(keep, [len(points) - 1])
+
+        with self.db:
+            self.db.execute("DELETE FROM clips WHERE path = ?", (path,))
+            self.db.execute(
+                "INSERT INTO clips (path, start_us, end_us, min_lat, max_lat, min_lon, max_lon, n_points, "
+                "offsets_ms, geometry) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, int(times[0]), int(times[-1]),
+                 float(lat.min()), float(lat.max()), min_lon, max_lon, len(keep),
+                 offsets_ms[keep].astype('<i8').tobytes(),
+                 np.column_stack([lat[keep], lon[keep]]).astype('<f8').tobytes()))
+        return True
+
+    def add_file(self, path, skip=False, interval_s=1.0):
+        return self.add_clip(path, load_points(path, skip=skip), interval_s=interval_s)
+
+    def remove(self, path):
+        with self.db:
+            self.db.execute("DELETE FROM clips WHERE path = ?", (str(Path(path).resolve()),))
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM clips").fetchone()[0]
+
+    def query(self, lat, lon, radius, start=None, end=None):
+        """
+        clips that passed within radius metres of (lat, lon), optionally restricted to the [start, end] time range.
+        returns a list of ClipMatch with the matching offsets (milliseconds from the start of each clip): the time of
+        the closest approach on each segment of the track within the radius
+        """
+        dlat = math.degrees(radius / EARTH_RADIUS)
+        dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+        sql = "SELECT path, start_us, offsets_ms, geometry FROM clips WHERE min_lat <= ? AND max_lat >= ?"
+        params = [lat + dlat, lat - dlat]
+        ranges = _lon_ranges(lon, dlon)
+        if ranges is not None:
+            # a wrapped box (min_lon > max_lon) is [min_lon, 180] and [-180, max_lon]
+            overlap = ("(min_lon <= max_lon AND min_lon <= ? AND max_lon >= ?) OR "
+                       "(min_lon > max_lon AND (min_lon <= ? OR max_lon >= ?))")
+            sql += " AND (" + " OR ".join([overlap] * len(ranges)) + ")"
+            for low, high in ranges:
+                params += [high, low, high, low]
+        if start is not None:
+            sql += " AND end_us >= ?"
+            params.append(_to_us(start))
+        if end is not None:
+            sql += " AND start_us <= ?"
+            params.append(_to_us(end))
+
+        matches = []
+        for path, start_us, offsets_blob, geometry_blob in self.db.execute(sql + " ORDER BY start_us", params):
+            offsets = np.frombuffer(offsets_blob, dtype='<i8')
+            geometry = np.frombuffer(geometry_blob, dtype='<f8').reshape(-1, 2)
+
+            low_ms = -np.inf if start is None else (_to_us(start) - start_us) / 1000
+            high_ms = np.inf if end is None else (_to_us(end) - start_us) / 1000
+            distance, closest = _closest_approach(lat, lon, geometry, offsets, low_ms, high_ms)
+            hit = distance <= radius
+            if not hit.any():
+                continue
+
+            matches.append(ClipMatch(path, np.datetime64(start_us, 'us').astype(datetime),
+                                     np.unique(closest[hit]).tolist(), float(distance[hit].min())))
+        return matches
+
+
+class TrackIndexTest(unittest.TestCase):
+    SAMPLES = Path(__file__).resolve().parent.parent / 'samples'
+    T0 = datetime(2020, 1, 1, 12, 0, 0)
+
+    def _track(self, lat, lon, seconds):
+        return [gpshelper.GPSPoint(a, o, 0.0, self.T0 + timedelta(seconds=t)) for a, o, t in zip(lat, lon, seconds)]
+
+    def test_sample(self):
+        points = load_points(self.SAMPLES / 'gopro7.bin')
+        with TrackIndex(':memory:') as index:
+            self.assertTrue(index.add_clip('gopro7.bin', points, interval_s=0))
+            p = points[len(points) // 2]
+            matches = index.query(p.latitude, p.longitude, 1.0)
+            self.assertEqual(len(matches), 1)
+            m = matches[0]
+            self.assertEqual(m.start, points[0].time)
+            # the offsets are whole milliseconds
+            self.assertTrue(any(abs(m.start + timedelta(milliseconds=o) - p.time) < timedelta(milliseconds=1)
+                                for o in m.offsets_ms))
+            self.assertEqual(index.query(p.latitude, p.longitude, 1.0, start=p.time + timedelta(hours=1)), [])
+
+    def test_origin(self):
+        # the first point isn't the earliest one: the offsets count from the start all the same
+        points = self._track([10.0, 10.001, 10.002], [20.0, 20.0, 20.0], [5, 0, 10])
+        with TrackIndex(':memory:') as index:
+            index.add_clip('clip', points)
+            # in time order the track goes 10.001 -> 10.0 -> 10.002: it is back at 10.001 half way through the second
+            # segment, at 7.5 s
+            for p, again in zip(points, ([], [7500], [])):
+                m, = index.query(p.latitude, p.longitude, 1.0)
+                self.assertEqual(m.start, self.T0)
+                self.assertEqual(m.offsets_ms, sorted([(p.time - self.T0) // timedelta(milliseconds=1)] + again))
+            # only the sample in the time range
+            m, = index.query(10.001, 20.0, 200.0, start=self.T0, end=self.T0 + timedelta(seconds=1))
+            self.assertEqual(m.offsets_ms, [0])
+
+    def test_between_samples(self):
+        # 40 m/s due north, one sample per second: the samples are 40 m apart
+        step = math.degrees(40.0 / EARTH_RADIUS)
+        points = self._track(40.0 + step * np.arange(10), np.full(10, -3.0), range(10))
+        dlon = math.degrees(5.0 / EARTH_RADIUS) / math.cos(math.radians(40.0))
+        lat = 40.0 + step * 4.5
+        with TrackIndex(':memory:') as index:
+            index.add_clip('car', points)
+            # 5 m to the side of the track, 20 m from the closest samples
+            m, = index.query(lat, -3.0 + dlon, 10.0)
+            self.assertAlmostEqual(m.min_distance, 5.0, delta=0.01)
+            self.assertEqual(m.offsets_ms, [4500])
+            self.assertEqual(index.query(lat, -3.0 + 3 * dlon, 10.0), [])
+            # the closest point within the time range is the end of it
+            m, = index.query(lat, -3.0 + dlon, 15.0, end=self.T0 + timedelta(seconds=4.2))
+            self.assertEqual(m.offsets_ms, [4200])
+            self.assertAlmostEqual(m.min_distance, math.hypot(12.0, 5.0), delta=0.01)
+            self.assertEqual(index.query(lat, -3.0 + dlon, 10.0, end=self.T0 + timedelta(seconds=4.2)), [])
+            # across the antimeridian
+            index.add_clip('ferry', self._track([-16.5, -16.5], [179.9998, -179.9998], [0, 1]))
+            m, = index.query(-16.5, 180.0, 5.0)
+            self.assertEqual((m.path, m.offsets_ms), (str(Path('ferry').resolve()), [500]))
+            self.assertLess(m.min_distance, 0.01)
+
+    def test_antimeridian(self):
+        lon = np.concatenate([np.linspace(179.99, 179.9999, 10), np.linspace(-179.9999, -179.99, 10)])
+        points = self._track(np.full(20, -16.5), lon, range(20))
+        with TrackIndex(':memory:') as index:
+            index.add_clip('fiji', points)
+            bounds = index.db.execute("SELECT min_lon, max_lon FROM clips").fetchone()
+            self.assertEqual(bounds, (179.99, -179.99))
+            for q in (179.995, -179.995, 180.0, -180.0):
+                self.assertEqual(len(index.query(-16.5, q, 100.0)), 1, q)
+            self.assertEqual(index.query(-16.5, 179.9, 100.0), [])
+            self.assertEqual(index.query(-16.5, 0.0, 100.0), [])
+            # a query window wrapping at 180 finds the boxes that don't
+            index.add_clip('west', self._track([-16.5], [-179.9999], [0]))
+            self.assertEqual(len(index.query(-16.5, 179.9999, 100.0)), 2)
+
+    def test_lon_bounds(self):
+        self.assertEqual(_lon_bounds([-3.7, -3.6, -3.8]), (-3.8, -3.6))
+        self.assertEqual(_lon_bounds([170.0, -170.0, 175.0]), (170.0, -170.0))
+        self.assertEqual(_lon_ranges(0.0, 1.0), [(-1.0, 1.0)])
+        self.assertEqual(_lon_ranges(179.5, 1.0), [(178.5, 180.0), (-180.0, -179.5)])
+        self.assertIsNone(_lon_ranges(0.0, 180.0))
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="spatial and temporal index over extracted GoPro tracks")
+    parser.add_argument("database", help="index database file (SQLite)", type=Path)
+    parser.add_argument('-l', '--loglevel', default='info', help='Provide logging level. Example --loglevel debug')
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("add", help="index video files (.mp4) or binary metadata dumps (.bin)")
+    add.add_argument("files", nargs='+', type=Path)
+    add.add_argument("-s", "--skip", help="Skip bad points (GPSFIX=0)", action="store_true", default=False)
+    add.add_argument("-i", "--interval", type=float, default=1.0,
+                     help="keep one sample per INTERVAL seconds (default: 1.0)")
+
+    query = commands.add_parser("query", help="find clips that passed near a point")
+    query.add_argument("lat", type=float)
+    query.add_argument("lon", type=float)
+    query.add_argument("-r", "--radius", type=float, default=50.0, help="search radius in metres (default: 50)")
+    query.add_argument("--start", type=datetime.fromisoformat, help="only matches after this time (ISO format)")
+    query.add_argument("--end", type=datetime.fromisoformat, help="only matches before this time (ISO format)")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    logging.basicConfig(level=args.loglevel.upper())
+    logger = logging.getLogger(__name__)
+
+    with TrackIndex(args.database) as index:
+        if args.command == "add":
+            for f in args.files:
+                logger.info(f'Indexing {str(f)}')
+                index.add_file(f, skip=args.skip, interval_s=args.interval)
+        else:
+            for m in index.query(args.lat, args.lon, args.radius, args.start, args.end):
+                print("%s,%s,%.1f,%s" % (m.path, m.start.isoformat(), m.min_distance,
+                                         " ".join(str(o) for o in m.offsets_ms)))
+
+
+if __name__ == "__main__":
+    main()